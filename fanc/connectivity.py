@@ -1,7 +1,9 @@
 #!/usr/bin/env python3
 
+import os
 import json
 import re
+import shutil
 import warnings
 import sqlite3
 
@@ -15,29 +17,33 @@ def get_synapses(seg_ids,
                  direction='outputs',
                  threshold=3,
                  drop_duplicates=True,
+                 return_edges=False,
                  client=None):
     '''
     Find synapses that are either inputs to or outputs from a specified list of neurons
     args:
     seg_ids:          list, int root ids to query
     direction:        str, inputs or outputs
-    threshold:        int, synapse threshold to use. default is 3
-    drop_duplicates:  bool, whether to drop links between the same supervoxel pair 
+    threshold:        int, synapse threshold to use. default is 3. Applied
+                      separately to each (queried neuron, partner) pair.
+    drop_duplicates:  bool, whether to drop links between the same supervoxel pair
+                      (done before thresholding)
+    return_edges:     bool, if True also return the aggregated edge table
+                      (see threshold_synapses)
     client:           caveclient.CAVEclient or None
     
     returns:
     a pd.DataFrame of synapse information from CAVE, 
+    or a (synapses, edges) tuple of pd.DataFrames if return_edges is True
     '''
     if isinstance(seg_ids, (int, np.integer)):
         seg_ids = [seg_ids]
 
     if direction == 'inputs':
         to_find = 'post'
-        to_threshold = 'pre'
         
     elif direction == 'outputs':
         to_find = 'pre'   
-        to_threshold = 'post'
 
     if client is None:
         client = auth.get_caveclient()
@@ -53,16 +59,63 @@ def get_synapses(seg_ids,
         result.append(syn_i)
     
     result_c = pd.concat(result)
-    counts = result_c['{}_pt_root_id'.format(to_threshold)].value_counts()
-    t_idx = counts >= threshold
-    syn_table = result_c[result_c['{}_pt_root_id'.format(to_threshold)].isin(set(t_idx.index[t_idx==1]))]
-
+    # Drop duplicates first, so that they don't count towards the threshold
     if drop_duplicates:
-        syn_table.drop_duplicates(subset=['pre_pt_supervoxel_id',
-                                          'post_pt_supervoxel_id'],
-                                  inplace=True)
+        result_c = result_c.drop_duplicates(subset=['pre_pt_supervoxel_id',
+                                                    'post_pt_supervoxel_id'])
+
+    return threshold_synapses(result_c, threshold, return_edges=return_edges)
+
+
+def threshold_synapses(synapses: pd.DataFrame,
+                       threshold=3,
+                       pre_column='pre_pt_root_id',
+                       post_column='post_pt_root_id',
+                       return_edges=False):
+    """
+    Keep only the synapses belonging to connections (pairs of presynaptic and
+    postsynaptic neurons) made up of at least `threshold` synapses.
+
+    Synapses are counted per (pre, post) pair in a single grouped pass, so a
+    table containing the partners of many queried neurons is thresholded
+    correctly: each queried neuron's partners are judged only by their
+    synapses with that neuron, not by their synapses with all queried neurons.
+
+    Arguments
+    ---------
+    synapses: pd.DataFrame
+      Synapse table with one row per synapse.
+
+    threshold: int or None (default 3)
+      Minimum number of synapses a connection needs to be kept. If None,
+      nothing is removed.
 
-    return syn_table
+    pre_column, post_column: str
+      Names of the columns containing presynaptic and postsynaptic segment
+      IDs. Defaults match CAVE synapse tables. Use 'pre_root' and 'post_root'
+      for local synapse tables.
+
+    return_edges: bool (default False)
+      If True, also return the connections that passed the threshold.
+
+    Returns
+    -------
+    pd.DataFrame: the synapses that passed the threshold, OR
+    (pd.DataFrame, pd.DataFrame) if return_edges is True: the synapses that
+      passed the threshold, and an edge table with one row per connection
+      and columns [pre_column, post_column, 'weight'], sorted by pre then post.
+    """
+    if threshold is None:
+        threshold = 0
+    grouped = synapses.groupby([pre_column, post_column], sort=False)
+    counts = grouped[pre_column].transform('size').values
+    synapses = synapses.loc[counts >= threshold]
+    if not return_edges:
+        return synapses
+
+    edges = grouped.size()
+    edges = edges[edges >= threshold].sort_index()
+    return synapses, edges.rename('weight').reset_index()
 
 
 def get_adj(pre_ids,post_ids,symmetric = False):
@@ -85,61 +138,1470 @@ def get_adj(pre_ids,post_ids,symmetric = False):
 def get_partner_synapses_csv(root_id, 
                              df, 
                              direction='inputs', 
-                             threshold=None):
+                             threshold=None,
+                             return_edges=False):
+    """
+    Get the synapses in a local synapse table (a DataFrame with 'pre_root'
+    and 'post_root' columns) onto (direction='inputs') or from
+    (direction='outputs') one or more neurons. If threshold is given, only
+    keep partners connected to a given neuron by at least that many synapses.
+    See threshold_synapses for return_edges.
+    """
     if direction == 'inputs':
         to_find = 'post_root'
-        to_threshold = 'pre_root'
         
     elif direction == 'outputs':
         to_find = 'pre_root'   
-        to_threshold = 'post_root'
     
-    partners = df.loc[df[to_find]==root_id]
-        
-    if threshold is not None:
-        counts = partners[to_threshold].value_counts()
-        t_idx = counts >= threshold
+    if isinstance(root_id, (int, np.integer)):
+        partners = df.loc[df[to_find]==root_id]
+    else:
+        partners = df.loc[df[to_find].isin(root_id)]
         
-        partners = partners[partners[to_threshold].isin(set(t_idx.index[t_idx==1]))]
-    
-    return partners
+    return threshold_synapses(partners, threshold,
+                              pre_column='pre_root', post_column='post_root',
+                              return_edges=return_edges)
 
 
 def get_partner_synapses_sql(root_id, 
                          database='synapses.db', 
                          direction='inputs', 
-                         threshold=None):
-    
+                         threshold=None,
+                         return_edges=False):
+    """
+    Same as get_partner_synapses_csv, but query a local sqlite synapse
+    database with a table named 'synapses'.
+    """
     con = sqlite3.connect(database)
     if direction == 'inputs':
         to_find = 'post_root'
-        to_threshold = 'pre_root'
         
     elif direction == 'outputs':
         to_find = 'pre_root'   
-        to_threshold = 'post_root'
     
-    partners = pd.read_sql_query("SELECT * from synapses WHERE {} = {}".format(to_find,root_id),con)
+    if isinstance(root_id, (int, np.integer)):
+        root_id = [root_id]
+    root_ids = ','.join(str(int(i)) for i in root_id)
+    partners = pd.read_sql_query("SELECT * from synapses WHERE {} IN ({})".format(to_find,root_ids),con)
 
     con.close()   
-    if threshold is not None:
-        counts = partners[to_threshold].value_counts()
-        t_idx = counts >= threshold
-        
-        partners = partners[partners[to_threshold].isin(set(t_idx.index[t_idx==1]))]
-
 
-    return partners
+    return threshold_synapses(partners, threshold,
+                              pre_column='pre_root', post_column='post_root',
+                              return_edges=return_edges)
 
 
-def batch_partners(root_id, fname, direction, threshold=None):
-
-    result = pd.DataFrame(columns=['pre_SV','post_SV','pre_pt','post_pt','source','pre_root','post_root'])
+def batch_partners(root_id, fname, direction, threshold=None,
+                   return_edges=False):
+    """
+    Same as get_partner_synapses_csv, but read the synapse table from a .csv
+    file in chunks. The threshold is applied after all chunks are read, so
+    connections whose synapses are split across chunks are counted correctly.
+    """
+    result = []
 
     for chunk in pd.read_csv(fname, chunksize=1000000):
-        chunk_result = get_partner_synapses_csv(root_id,chunk,direction=direction,threshold=threshold)
+        chunk_result = get_partner_synapses_csv(root_id,chunk,direction=direction)
         if len(chunk_result) > 0:
-            result = result.append(chunk_result, ignore_index=True)
-    
+            result.append(chunk_result)
+    if result:
+        result = pd.concat(result, ignore_index=True)
+    else:
+        result = pd.DataFrame(columns=['pre_SV','post_SV','pre_pt','post_pt','source','pre_root','post_root'])
+
+    return threshold_synapses(result, threshold,
+                              pre_column='pre_root', post_column='post_root',
+                              return_edges=return_edges)
+
+
+def _count_edges(pre_ids, post_ids, weights=None) -> pd.DataFrame:
+    """
+    Collapse a list of (pre, post) pairs into unique edges, summing the
+    weights of repeated pairs. If weights is None, each pair counts as 1
+    (that is, each pair is one synapse).
+
+    Returns a DataFrame with columns 'pre', 'post', 'weight'.
+    """
+    edges = pd.DataFrame({'pre': np.asarray(pre_ids, dtype=np.int64),
+                          'post': np.asarray(post_ids, dtype=np.int64)})
+    if weights is None:
+        edges['weight'] = 1
+    else:
+        edges['weight'] = np.asarray(weights)
+    return edges.groupby(['pre', 'post'], sort=False,
+                         as_index=False)['weight'].sum()
+
+
+def _gather_rows(indptr, rows):
+    """
+    Given a CSR indptr array and an array of row numbers, return the
+    positions (into the CSR indices/data arrays) of every entry in those rows,
+    plus the row number each of those entries came from. Vectorized version of
+    concatenating `range(indptr[r], indptr[r+1])` for each row r.
+    """
+    rows = np.asarray(rows, dtype=np.int64)
+    starts = np.asarray(indptr[rows], dtype=np.int64)
+    lengths = np.asarray(indptr[rows + 1], dtype=np.int64) - starts
+    positions = (np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+                 + np.arange(lengths.sum()))
+    return positions, np.repeat(rows, lengths)
+
+
+class ConnectomeGraph(object):
+    """
+    A weighted, directed neuron-to-neuron connectivity graph.
+
+    Edges are stored twice as CSR arrays, once grouped by presynaptic neuron
+    (outputs) and once grouped by postsynaptic neuron (inputs), so that
+    partner lookups in either direction are a single array slice. Edge
+    weights are synapse counts.
+
+    Nodes are identified by segment IDs (root IDs), which are kept sorted in
+    `self.segids`. Internally, the position of a segment ID in that array is
+    its node index.
+
+    Build a graph with one of the `from_*` classmethods, for example:
+    >>> graph = ConnectomeGraph.from_csv('synapses.csv')
+    >>> graph.save('~/fanc-graphs/synapses')
+    and later reload it almost instantly (arrays are memory-mapped) with:
+    >>> graph = ConnectomeGraph.load('~/fanc-graphs/synapses')
+    >>> graph.partners(648518346486614449, direction='inputs', top_k=10)
+    """
+    _array_names = ['segids',
+                    'out_indptr', 'out_indices', 'out_weights',
+                    'in_indptr', 'in_indices', 'in_weights']
+
+    def __init__(self, segids, out_indptr, out_indices, out_weights,
+                 in_indptr, in_indices, in_weights):
+        self.segids = segids
+        self.out_indptr = out_indptr
+        self.out_indices = out_indices
+        self.out_weights = out_weights
+        self.in_indptr = in_indptr
+        self.in_indices = in_indices
+        self.in_weights = in_weights
+
+    def __len__(self):
+        return len(self.segids)
+
+    def __repr__(self):
+        return '<ConnectomeGraph: {} neurons, {} edges, {} synapses>'.format(
+            len(self), self.num_edges, int(self.out_weights.sum()))
+
+    @property
+    def num_edges(self):
+        return len(self.out_indices)
+
+    # --- Construction --- #
+    @classmethod
+    def _from_index_edges(cls, segids, pre_idx, post_idx, weights):
+        """
+        Build a graph from edges given as node indices into `segids`. Each
+        (pre_idx, post_idx) pair must appear at most once.
+        """
+        n = len(segids)
+        pre_idx = np.asarray(pre_idx, dtype=np.int64)
+        post_idx = np.asarray(post_idx, dtype=np.int64)
+        weights = np.asarray(weights, dtype=np.int32)
+
+        # Each (pre, post) pair is unique, so sorting packed keys sorts edges
+        # by pre then post (or post then pre) with a single argsort each
+        order = np.argsort(pre_idx * n + post_idx)
+        out_indptr = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(np.bincount(pre_idx, minlength=n), out=out_indptr[1:])
+
+        in_order = np.argsort(post_idx * n + pre_idx)
+        in_indptr = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(np.bincount(post_idx, minlength=n), out=in_indptr[1:])
+
+        return cls(np.asarray(segids, dtype=np.int64),
+                   out_indptr, post_idx[order].astype(np.int32), weights[order],
+                   in_indptr, pre_idx[in_order].astype(np.int32), weights[in_order])
+
+    @classmethod
+    def from_edges(cls, pre_ids, post_ids, weights=None):
+        """
+        Build a graph from arrays of presynaptic and postsynaptic segment IDs.
+
+        Arguments
+        ---------
+        pre_ids, post_ids: iterables of ints
+          Segment IDs of the presynaptic and postsynaptic partner of each
+          synapse (or each edge, if weights is given).
+
+        weights: None (default) OR iterable of ints
+          If None, each (pre, post) pair is one synapse, and repeated pairs
+          are counted. Otherwise, the weight of each pair. Weights of repeated
+          pairs are summed.
+        """
+        edges = _count_edges(pre_ids, post_ids, weights)
+        # Segment ID 0 means "no segment", so it never becomes a node
+        edges = edges.loc[(edges.pre != 0) & (edges.post != 0)]
+        segids, idx = np.unique(np.concatenate([edges.pre.values,
+                                                edges.post.values]),
+                                return_inverse=True)
+        return cls._from_index_edges(segids, idx[:len(edges)], idx[len(edges):],
+                                     edges.weight.values)
+
+    @classmethod
+    def from_synapses(cls, synapses: pd.DataFrame,
+                      pre_column='pre_pt_root_id',
+                      post_column='post_pt_root_id'):
+        """
+        Build a graph from a synapse table, with one row per synapse, such as
+        the DataFrames returned by `get_synapses`.
+        """
+        return cls.from_edges(synapses[pre_column].values,
+                              synapses[post_column].values)
+
+    @classmethod
+    def from_csv(cls, fname,
+                 pre_column='pre_root',
+                 post_column='post_root',
+                 chunksize=1000000):
+        """
+        Build a graph from a local synapse table .csv file (the same format
+        used by `batch_partners`), with one row per synapse. The file is
+        read in chunks, so only the edge list (not the synapse list) needs to
+        fit in memory.
+        """
+        chunks = [_count_edges(chunk[pre_column].values,
+                               chunk[post_column].values)
+                  for chunk in pd.read_csv(fname, chunksize=chunksize,
+                                           usecols=[pre_column, post_column])]
+        edges = pd.concat(chunks, ignore_index=True)
+        return cls.from_edges(edges.pre.values, edges.post.values,
+                              edges.weight.values)
+
+    @classmethod
+    def from_sql(cls, database='synapses.db',
+                 pre_column='pre_root',
+                 post_column='post_root'):
+        """
+        Build a graph from a local sqlite synapse database (the same format
+        used by `get_partner_synapses_sql`). Synapses are counted by sqlite, so
+        only the edge list is loaded into python.
+        """
+        con = sqlite3.connect(database)
+        edges = pd.read_sql_query(
+            'SELECT {0} AS pre, {1} AS post, COUNT(*) AS weight FROM synapses'
+            ' GROUP BY {0}, {1}'.format(pre_column, post_column), con)
+        con.close()
+        return cls.from_edges(edges.pre.values, edges.post.values,
+                              edges.weight.values)
+
+    @classmethod
+    def from_cave(cls, seg_ids=None,
+                  materialization_version=None,
+                  client=None):
+        """
+        Build a graph from the CAVE synapse table.
+
+        Arguments
+        ---------
+        seg_ids: None (default) OR int OR iterable of ints
+          If None, the whole synapse table is queried. (CAVE may limit how
+          many rows a single query can return, in which case a warning is
+          raised and you should build the graph from a local synapse table
+          instead.)
+          Otherwise, only synapses onto or from these segments are queried.
+
+        materialization_version: None (default) OR int
+          Which materialization to query. If None, use the latest one.
+
+        client: caveclient.CAVEclient or None
+        """
+        if client is None:
+            client = auth.get_caveclient()
+        synapse_table = client.info.get_datastack_info()['synapse_table']
+        columns = ['pre_pt_root_id', 'post_pt_root_id']
+
+        if seg_ids is None:
+            synapses = client.materialize.query_table(
+                synapse_table,
+                select_columns=columns,
+                materialization_version=materialization_version
+            )
+            if len(synapses) >= 200000:
+                warnings.warn('query may be maxed out')
+        else:
+            if isinstance(seg_ids, (int, np.integer)):
+                seg_ids = [seg_ids]
+            synapses = []
+            for column in columns:
+                for seg_id in seg_ids:
+                    syn = client.materialize.query_table(
+                        synapse_table,
+                        filter_equal_dict={column: seg_id},
+                        select_columns=['id'] + columns,
+                        materialization_version=materialization_version
+                    )
+                    if len(syn) >= 200000:
+                        warnings.warn('query is maxed out')
+                    synapses.append(syn)
+            # A synapse between two queried segments is returned by both its
+            # pre and its post query, so keep it once
+            synapses = pd.concat(synapses, ignore_index=True).drop_duplicates('id')
+
+        return cls.from_synapses(synapses)
+
+    # --- Saving & loading --- #
+    def save(self, path):
+        """
+        Save the graph's arrays as .npy files into the directory `path`, which
+        is created if needed. Reload with `ConnectomeGraph.load(path)`.
+        """
+        path = os.path.expanduser(path)
+        os.makedirs(path, exist_ok=True)
+        for name in self._array_names:
+            np.save(os.path.join(path, name + '.npy'), getattr(self, name))
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """
+        Load a graph saved by `save`. If mmap is True (default), the arrays are
+        memory-mapped read-only instead of read into memory, which makes
+        loading nearly instant regardless of graph size.
+        """
+        path = os.path.expanduser(path)
+        mmap_mode = 'r' if mmap else None
+        return cls(*[np.load(os.path.join(path, name + '.npy'),
+                             mmap_mode=mmap_mode)
+                     for name in cls._array_names])
+
+    # --- Queries --- #
+    def index(self, segids) -> np.ndarray:
+        """
+        Return the node indices for the given segment ID(s).
+        Raises KeyError if any segment ID isn't in the graph.
+        """
+        segids = np.atleast_1d(np.asarray(segids, dtype=np.int64))
+        idx = np.searchsorted(self.segids, segids)
+        idx[idx == len(self.segids)] = 0
+        missing = self.segids[idx] != segids
+        if missing.any():
+            raise KeyError('Segment IDs not in graph: {}'.format(
+                segids[missing]))
+        return idx
+
+    def __contains__(self, segid):
+        idx = np.searchsorted(self.segids, segid)
+        return idx < len(self.segids) and self.segids[idx] == segid
+
+    def _csr(self, direction):
+        if direction == 'outputs':
+            return self.out_indptr, self.out_indices, self.out_weights
+        elif direction == 'inputs':
+            return self.in_indptr, self.in_indices, self.in_weights
+        raise ValueError("direction must be 'inputs' or 'outputs' but was "
+                         "{}".format(direction))
+
+    def partners(self, segid, direction='outputs',
+                 threshold=1, top_k=None) -> pd.Series:
+        """
+        Find the synaptic partners of a neuron.
+
+        Arguments
+        ---------
+        segid: int
+          The segment ID to find partners of.
+
+        direction: 'outputs' (default) OR 'inputs'
+          Whether to find downstream ('outputs') or upstream ('inputs')
+          partners.
+
+        threshold: int (default 1)
+          Only return partners connected by at least this many synapses.
+
+        top_k: None (default) OR int
+          If given, only return the top_k strongest partners.
+
+        Returns
+        -------
+        pd.Series of synapse counts indexed by partner segment ID, sorted
+        from strongest to weakest connection.
+        """
+        indptr, indices, weights = self._csr(direction)
+        i = self.index(segid)[0]
+        partners = indices[indptr[i]:indptr[i+1]]
+        counts = weights[indptr[i]:indptr[i+1]]
+        keep = counts >= threshold
+        partners, counts = partners[keep], counts[keep]
+        order = np.argsort(-counts, kind='stable')
+        if top_k is not None:
+            order = order[:top_k]
+        return pd.Series(counts[order], index=self.segids[partners[order]],
+                         name='weight')
+
+    def _expand(self, segids, hops, direction, threshold, include_seeds):
+        indptr, indices, weights = self._csr(direction)
+        distance = np.full(len(self), -1, dtype=np.int32)
+        frontier = np.unique(self.index(segids))
+        distance[frontier] = 0
+        for hop in range(1, hops + 1):
+            positions, _ = _gather_rows(indptr, frontier)
+            positions = positions[weights[positions] >= threshold]
+            frontier = np.unique(indices[positions])
+            frontier = frontier[distance[frontier] == -1]
+            if len(frontier) == 0:
+                break
+            distance[frontier] = hop
+        reached = np.flatnonzero(distance >= (0 if include_seeds else 1))
+        return pd.Series(distance[reached], index=self.segids[reached],
+                         name='hops')
+
+    def downstream(self, segids, hops=1, threshold=1,
+                   include_seeds=False) -> pd.Series:
+        """
+        Find all neurons within `hops` synaptic steps downstream of the given
+        neuron(s), following only connections with at least `threshold`
+        synapses.
+
+        Returns
+        -------
+        pd.Series of hop distances (the smallest number of steps needed to
+        reach each neuron), indexed by segment ID.
+        """
+        return self._expand(segids, hops, 'outputs', threshold, include_seeds)
+
+    def upstream(self, segids, hops=1, threshold=1,
+                 include_seeds=False) -> pd.Series:
+        """
+        Find all neurons within `hops` synaptic steps upstream of the given
+        neuron(s), following only connections with at least `threshold`
+        synapses.
+
+        Returns
+        -------
+        pd.Series of hop distances (the smallest number of steps needed to
+        reach each neuron), indexed by segment ID.
+        """
+        return self._expand(segids, hops, 'inputs', threshold, include_seeds)
+
+    def shortest_path(self, source, target, cost='inverse',
+                      threshold=1) -> list:
+        """
+        Find the shortest directed path from `source` to `target`.
+
+        Arguments
+        ---------
+        source, target: int
+          Segment IDs of the start and end neurons.
+
+        cost: 'inverse' (default) OR 'hops'
+          'inverse': each edge costs 1/weight, so strong connections are
+            preferred over weak ones.
+          'hops': each edge costs 1, so the path with the fewest synaptic
+            steps is found.
+
+        threshold: int (default 1)
+          Only follow connections with at least this many synapses.
+
+        Returns
+        -------
+        list of segment IDs, starting with source and ending with target.
+        Empty if target can't be reached from source.
+        """
+        from scipy.sparse.csgraph import dijkstra
+
+        graph = self.threshold(threshold) if threshold > 1 else self
+        if cost == 'inverse':
+            costs = 1 / graph.out_weights.astype(np.float64)
+        elif cost == 'hops':
+            costs = np.ones(graph.num_edges)
+        else:
+            raise ValueError("cost must be 'inverse' or 'hops' but was "
+                             "{}".format(cost))
+        src, tgt = graph.index([source, target])
+        _, predecessors = dijkstra(graph.to_scipy(data=costs), directed=True,
+                                   indices=src, return_predecessors=True)
+        if src != tgt and predecessors[tgt] < 0:
+            return []
+        path = [tgt]
+        while path[-1] != src:
+            path.append(predecessors[path[-1]])
+        return graph.segids[np.array(path[::-1], dtype=np.int64)].tolist()
+
+    # --- New graphs --- #
+    def edges(self) -> pd.DataFrame:
+        """
+        Return all edges as a DataFrame with columns 'pre', 'post', 'weight'.
+        """
+        _, pre_idx = _gather_rows(self.out_indptr, np.arange(len(self)))
+        return pd.DataFrame({'pre': self.segids[pre_idx],
+                             'post': self.segids[self.out_indices],
+                             'weight': np.asarray(self.out_weights)})
+
+    def threshold(self, threshold):
+        """
+        Return a new graph containing only the connections with at least
+        `threshold` synapses. Neurons are kept even if they lose all edges.
+        """
+        _, pre_idx = _gather_rows(self.out_indptr, np.arange(len(self)))
+        keep = np.asarray(self.out_weights) >= threshold
+        return self._from_index_edges(self.segids, pre_idx[keep],
+                                      self.out_indices[keep],
+                                      self.out_weights[keep])
+
+    def subgraph(self, segids):
+        """
+        Return the subgraph induced by the given segment IDs: only these
+        neurons, and only the connections among them.
+        """
+        nodes = np.unique(self.index(segids))
+        new_index = np.full(len(self), -1, dtype=np.int64)
+        new_index[nodes] = np.arange(len(nodes))
+        positions, pre_idx = _gather_rows(self.out_indptr, nodes)
+        post_idx = new_index[self.out_indices[positions]]
+        keep = post_idx >= 0
+        return self._from_index_edges(self.segids[nodes],
+                                      new_index[pre_idx[keep]],
+                                      post_idx[keep],
+                                      self.out_weights[positions[keep]])
+
+    def to_scipy(self, data=None):
+        """
+        Return the outputs CSR arrays as a scipy.sparse.csr_matrix, with rows
+        as presynaptic and columns as postsynaptic node indices. If data is
+        given, it replaces the synapse counts as the matrix values.
+        """
+        from scipy import sparse
+
+        if data is None:
+            data = self.out_weights
+        return sparse.csr_matrix((data, self.out_indices, self.out_indptr),
+                                 shape=(len(self), len(self)))
+
+
+def align_neurons(anchors, materialization_versions, client=None) -> pd.DataFrame:
+    """
+    Find the segment ID of each of a set of neurons at several
+    materialization versions.
+
+    Segment IDs change every time a neuron is edited, so they can't be used to
+    match neurons across versions. Instead, each neuron is identified by an
+    anchor: a supervoxel (or a point, which is converted to the supervoxel at
+    that point) that belongs to the neuron in every version. Supervoxel IDs
+    never change, so looking up the segment containing the anchor supervoxel
+    at each version gives that neuron's segment ID at that version.
+    See `fanc.lookup.anchor_point` for a source of good anchor points.
+
+    Arguments
+    ---------
+    anchors: N-length iterable of supervoxel IDs, OR Nx3 iterable of points
+      Points should be in xyz order and in mip0 voxel coordinates.
+
+    materialization_versions: iterable of ints
+
+    client: caveclient.CAVEclient or None
+
+    Returns
+    -------
+    pd.DataFrame with one row per anchor (indexed 0 to N-1, in the order
+    given) and one column of segment IDs per materialization version.
+    """
+    from . import lookup
+
+    if client is None:
+        client = auth.get_caveclient()
+    anchors = np.asarray(anchors)
+    if anchors.ndim == 2:
+        svids = np.array(lookup.svid_from_pt(anchors), dtype=np.int64)
+    else:
+        svids = anchors.astype(np.int64)
+
+    neurons = pd.DataFrame(index=pd.RangeIndex(len(svids), name='neuron'))
+    for version in materialization_versions:
+        timestamp = client.materialize.get_timestamp(version)
+        neurons[version] = np.asarray(
+            client.chunkedgraph.get_roots(svids, timestamp=timestamp),
+            dtype=np.int64)
+    return neurons
+
+
+def _pack_edge_keys(pre, post):
+    return (pre.astype(np.uint64) << np.uint64(32)) | post.astype(np.uint64)
+
+
+def _unpack_edge_keys(keys):
+    return ((keys >> np.uint64(32)).astype(np.int64),
+            (keys & np.uint64(0xFFFFFFFF)).astype(np.int64))
+
+
+def _aligned_edge_stream(graph, roots, chunksize):
+    """
+    Yield the edges of `graph` between the given neurons as (keys, weights)
+    chunks, with keys packing the (pre, post) neuron numbers (positions in
+    `roots`) into uint64s. Keys are sorted across the whole stream, and only
+    `chunksize` neurons' edges are held in memory at once.
+    """
+    roots = np.asarray(roots, dtype=np.int64)
+    nodes = np.searchsorted(graph.segids, roots)
+    nodes[nodes == len(graph)] = 0
+    in_graph = np.flatnonzero(graph.segids[nodes] == roots)
+    # If several anchors ended up in the same segment, that segment's edges
+    # are assigned to the first of those anchors only.
+    nodes, first = np.unique(nodes[in_graph], return_index=True)
+    neuron_of_node = np.full(len(graph), -1, dtype=np.int64)
+    neuron_of_node[nodes] = in_graph[first]
+    node_of_neuron = np.full(len(roots), -1, dtype=np.int64)
+    node_of_neuron[in_graph[first]] = nodes
+
+    for start in range(0, len(roots), chunksize):
+        rows = node_of_neuron[start:start+chunksize]
+        positions, pre_nodes = _gather_rows(graph.out_indptr, rows[rows >= 0])
+        pre = neuron_of_node[pre_nodes]
+        post = neuron_of_node[graph.out_indices[positions]]
+        keep = post >= 0
+        keys = _pack_edge_keys(pre[keep], post[keep])
+        order = np.argsort(keys)
+        yield keys[order], np.asarray(graph.out_weights[positions[keep]])[order]
+
+
+def _merge_edge_streams(stream_a, stream_b):
+    """
+    Merge two streams of (keys, weights) chunks, each sorted by key across the
+    whole stream, yielding (keys, weights_a, weights_b) chunks that cover the
+    union of keys in sorted order, with a weight of 0 where a key is absent
+    from one stream. Only about one chunk per stream is held in memory.
+    """
+    empty = (np.array([], dtype=np.uint64), np.array([], dtype=np.int64))
+    streams = [iter(stream_a), iter(stream_b)]
+    buffers = [empty, empty]
+    exhausted = [False, False]
+    while True:
+        for i in (0, 1):
+            while not exhausted[i] and len(buffers[i][0]) == 0:
+                try:
+                    buffers[i] = next(streams[i])
+                except StopIteration:
+                    exhausted[i] = True
+        if all(exhausted) and not len(buffers[0][0]) and not len(buffers[1][0]):
+            return
+
+        # Keys up to the last buffered key of a stream are complete for that
+        # stream, so everything up to the smaller of those can be merged now.
+        bound = min([buffers[i][0][-1] for i in (0, 1) if not exhausted[i]],
+                    default=np.uint64(np.iinfo(np.uint64).max))
+        parts = []
+        for i in (0, 1):
+            keys, weights = buffers[i]
+            split = np.searchsorted(keys, bound, side='right')
+            parts.append((keys[:split], weights[:split]))
+            buffers[i] = (keys[split:], weights[split:])
+
+        (keys_a, weights_a), (keys_b, weights_b) = parts
+        keys = np.union1d(keys_a, keys_b)
+        merged_a = np.zeros(len(keys), dtype=np.int64)
+        merged_a[np.searchsorted(keys, keys_a)] = weights_a
+        merged_b = np.zeros(len(keys), dtype=np.int64)
+        merged_b[np.searchsorted(keys, keys_b)] = weights_b
+        yield keys, merged_a, merged_b
+
+
+def iter_connectivity_diff(graph_a, graph_b, roots_a, roots_b,
+                           chunksize=10000):
+    """
+    Compare the connectivity among a set of neurons in two graphs (usually
+    built from two materialization versions), yielding the edges that
+    appeared, disappeared, or changed weight as a series of DataFrames.
+
+    Both edge lists are streamed in chunks of `chunksize` neurons, sorted by
+    packed (pre, post) neuron keys, and compared in a single merge pass, so
+    memory use doesn't grow with the size of the connectome.
+
+    Arguments
+    ---------
+    graph_a, graph_b: ConnectomeGraph
+      The graphs to compare, e.g. `ConnectomeGraph.from_cave(
+      materialization_version=...)` or graphs reloaded with
+      `ConnectomeGraph.load`.
+
+    roots_a, roots_b: N-length iterables of ints
+      The segment ID of each of the N neurons to compare in graph_a and
+      graph_b respectively, such as two columns of the DataFrame returned by
+      `align_neurons`. Edges to or from segments not in these lists are
+      ignored.
+
+    chunksize: int (default 10000)
+
+    Yields
+    ------
+    pd.DataFrame with one row per changed edge and columns:
+      'pre', 'post': the neuron numbers (positions in roots_a/roots_b)
+      'pre_root_a', 'post_root_a', 'pre_root_b', 'post_root_b'
+      'weight_a', 'weight_b', 'delta' (weight_b - weight_a)
+      'change': 'added', 'removed', or 'changed'
+    """
+    roots_a = np.asarray(roots_a, dtype=np.int64)
+    roots_b = np.asarray(roots_b, dtype=np.int64)
+    if len(roots_a) != len(roots_b):
+        raise ValueError('roots_a and roots_b must have the same length')
+
+    for keys, weights_a, weights_b in _merge_edge_streams(
+            _aligned_edge_stream(graph_a, roots_a, chunksize),
+            _aligned_edge_stream(graph_b, roots_b, chunksize)):
+        changed = weights_a != weights_b
+        if not changed.any():
+            continue
+        pre, post = _unpack_edge_keys(keys[changed])
+        weights_a, weights_b = weights_a[changed], weights_b[changed]
+        change = np.where(weights_a == 0, 'added',
+                          np.where(weights_b == 0, 'removed', 'changed'))
+        yield pd.DataFrame({
+            'pre': pre,
+            'post': post,
+            'pre_root_a': roots_a[pre],
+            'post_root_a': roots_a[post],
+            'pre_root_b': roots_b[pre],
+            'post_root_b': roots_b[post],
+            'weight_a': weights_a,
+            'weight_b': weights_b,
+            'delta': weights_b - weights_a,
+            'change': change
+        })
+
+
+def connectivity_diff(graph_a, graph_b, roots_a, roots_b,
+                      chunksize=10000) -> pd.DataFrame:
+    """
+    Same as `iter_connectivity_diff`, but return all changed edges as a
+    single DataFrame.
+
+    Examples
+    --------
+    >>> neurons = align_neurons(anchor_svids, [v1, v2])
+    >>> diff = connectivity_diff(
+    ...     ConnectomeGraph.from_cave(materialization_version=v1),
+    ...     ConnectomeGraph.from_cave(materialization_version=v2),
+    ...     neurons[v1], neurons[v2])
+    """
+    chunks = list(iter_connectivity_diff(graph_a, graph_b, roots_a, roots_b,
+                                         chunksize=chunksize))
+    if not chunks:
+        return pd.DataFrame(columns=['pre', 'post',
+                                     'pre_root_a', 'post_root_a',
+                                     'pre_root_b', 'post_root_b',
+                                     'weight_a', 'weight_b', 'delta', 'change'])
+    return pd.concat(chunks, ignore_index=True)
+
+
+def _positions_from_column(synapses, position_column):
+    """
+    Return an Nx3 array of the points in a position column, which may be
+    either a single column of 3-length arrays (the CAVE default) or split into
+    '<column>_x', '<column>_y', '<column>_z' columns.
+    """
+    split_columns = [position_column + '_' + axis for axis in 'xyz']
+    if all(column in synapses.columns for column in split_columns):
+        return synapses[split_columns].values
+    if len(synapses) == 0:
+        return np.zeros((0, 3))
+    return np.vstack(synapses[position_column].values)
+
+
+class SynapseIndex(object):
+    """
+    A spatial index over the synapses of one or more neurons, for quickly
+    selecting the synapses of a neuron that are inside a box, within some
+    distance of a point, or inside a neuropil mesh.
+
+    Synapses are grouped by neuron, and their coordinates are converted once
+    from the DataFrame's position column into a single Nx3 array, so that
+    queries are vectorized array operations over all selected neurons at
+    once.
+
+    The selected synapses are returned as rows of the original synapse table,
+    so they can be passed on to e.g. `threshold_synapses` or
+    `ConnectomeGraph.from_synapses`.
+
+    Use `get_synapse_index` to build (and cache) the index for neurons in the
+    CAVE synapse table, or build one from any synapse DataFrame:
+    >>> index = SynapseIndex(synapses, direction='inputs')
+    >>> index.in_radius([48848, 114737, 2690], 5000)
+    """
+    def __init__(self, synapses: pd.DataFrame,
+                 direction='outputs',
+                 neuron_column=None,
+                 position_column=None,
+                 voxel_size=(4.3, 4.3, 45)):
+        """
+        Arguments
+        ---------
+        synapses: pd.DataFrame
+          Synapse table with one row per synapse.
+
+        direction: 'outputs' (default) OR 'inputs'
+          Whether the synapses are outputs of the indexed neurons (so the
+          neurons are the presynaptic partners and synapses are located at
+          their presynaptic points) or inputs (the reverse). Sets the defaults
+          for neuron_column and position_column.
+
+        neuron_column: str
+          Column with the segment IDs of the indexed neurons.
+
+        position_column: str
+          Column with synapse coordinates, in voxels.
+
+        voxel_size: 3-tuple (default (4.3, 4.3, 45))
+          Size in nm of the voxels that coordinates are given in, used for
+          radius and neuropil queries.
+        """
+        if direction == 'inputs':
+            to_find = 'post'
+        elif direction == 'outputs':
+            to_find = 'pre'
+        else:
+            raise ValueError("direction must be 'inputs' or 'outputs' but was "
+                             "{}".format(direction))
+        if neuron_column is None:
+            neuron_column = '{}_pt_root_id'.format(to_find)
+        if position_column is None:
+            position_column = '{}_pt_position'.format(to_find)
+
+        order = np.argsort(synapses[neuron_column].values, kind='stable')
+        self.synapses = synapses.iloc[order]
+        self.positions = _positions_from_column(self.synapses, position_column)
+        self.segids, starts = np.unique(self.synapses[neuron_column].values,
+                                        return_index=True)
+        self.offsets = np.append(starts, len(self.synapses))
+        self.direction = direction
+        self.neuron_column = neuron_column
+        self.position_column = position_column
+        self.voxel_size = np.asarray(voxel_size, dtype=np.float64)
+
+    def __len__(self):
+        return len(self.synapses)
+
+    def __repr__(self):
+        return '<SynapseIndex: {} synapses ({}) of {} neurons>'.format(
+            len(self), self.direction, len(self.segids))
+
+    @classmethod
+    def concatenate(cls, indices):
+        """
+        Combine several SynapseIndex objects that were built with the same
+        settings into one.
+        """
+        first = indices[0]
+        return cls(pd.concat([index.synapses for index in indices]),
+                   direction=first.direction,
+                   neuron_column=first.neuron_column,
+                   position_column=first.position_column,
+                   voxel_size=first.voxel_size)
+
+    def _rows(self, segids):
+        """
+        Return the row numbers of the synapses of the given neuron(s), or of
+        all neurons if segids is None.
+        """
+        if segids is None:
+            return np.arange(len(self))
+        segids = np.atleast_1d(np.asarray(segids, dtype=np.int64))
+        idx = np.searchsorted(self.segids, segids)
+        idx[idx == len(self.segids)] = 0
+        idx = idx[self.segids[idx] == segids]
+        positions, _ = _gather_rows(self.offsets, idx)
+        return positions
+
+    def _select(self, rows, return_mask):
+        if return_mask:
+            mask = np.zeros(len(self), dtype=bool)
+            mask[rows] = True
+            return mask
+        return self.synapses.iloc[np.sort(rows)]
+
+    def in_box(self, start, end, segids=None, return_mask=False):
+        """
+        Select the synapses inside the box from `start` (inclusive) to `end`
+        (exclusive), both given as xyz points in voxels.
+
+        Arguments
+        ---------
+        start, end: 3-length iterables
+
+        segids: None (default) OR int OR iterable of ints
+          Only consider synapses of these neurons. If None, consider all.
+
+        return_mask: bool (default False)
+          If True, return a boolean mask over `self.synapses` instead of the
+          selected rows.
+        """
+        rows = self._rows(segids)
+        points = self.positions[rows]
+        inside = ((points >= np.asarray(start)).all(axis=1)
+                  & (points < np.asarray(end)).all(axis=1))
+        return self._select(rows[inside], return_mask)
+
+    def in_radius(self, center, radius, segids=None, return_mask=False):
+        """
+        Select the synapses within `radius` nm of `center`, an xyz point in
+        voxels. See `in_box` for segids and return_mask.
+        """
+        rows = self._rows(segids)
+        vectors = (self.positions[rows] - np.asarray(center)) * self.voxel_size
+        inside = np.einsum('ij,ij->i', vectors, vectors) <= radius ** 2
+        return self._select(rows[inside], return_mask)
+
+    def in_mesh(self, mesh, segids=None, return_mask=False):
+        """
+        Select the synapses inside a mesh, such as one of the neuropil meshes
+        in data/volume_meshes/JRC2018_VNC_UNISEX_to_FANC. See `in_box` for
+        segids and return_mask.
+
+        Arguments
+        ---------
+        mesh: trimesh.Trimesh OR str
+          The mesh, or the path to a mesh file. Mesh vertices must be in nm.
+        """
+        if isinstance(mesh, str):
+            import trimesh
+            mesh = trimesh.load_mesh(mesh)
+        rows = self._rows(segids)
+        points = self.positions[rows] * self.voxel_size
+        # Only points inside the bounding box need the slow containment test
+        in_bbox = ((points >= mesh.bounds[0]).all(axis=1)
+                   & (points <= mesh.bounds[1]).all(axis=1))
+        rows = rows[in_bbox]
+        if len(rows):
+            rows = rows[mesh.contains(points[in_bbox])]
+        return self._select(rows, return_mask)
+
+    def in_region(self, region, segids=None, return_mask=False):
+        """
+        Select synapses with the query described by a dict, which must be one
+        of:
+          {'start': (x, y, z), 'end': (x, y, z)}  -> `in_box`
+          {'center': (x, y, z), 'radius': r}      -> `in_radius`
+          {'mesh': mesh or path to mesh}          -> `in_mesh`
+        """
+        if 'mesh' in region:
+            return self.in_mesh(region['mesh'], segids, return_mask)
+        if 'radius' in region:
+            return self.in_radius(region['center'], region['radius'],
+                                  segids, return_mask)
+        if 'start' in region:
+            return self.in_box(region['start'], region['end'],
+                               segids, return_mask)
+        raise ValueError('Unrecognized region: {}'.format(region))
+
+
+# To avoid re-downloading synapses for neurons that were already indexed,
+# keyed by (datastack, materialization version, segment ID, direction,
+# threshold)
+_synapse_indices = {}
+
+
+def clear_synapse_index_cache():
+    """Forget all synapse indices built by `get_synapse_index`"""
+    _synapse_indices.clear()
+
+
+def get_synapse_index(seg_ids,
+                      direction='outputs',
+                      threshold=3,
+                      client=None,
+                      refresh=False) -> SynapseIndex:
+    """
+    Get a SynapseIndex over the synapses of the given neuron(s), fetching
+    synapses with `get_synapses` only for neurons that haven't been indexed
+    before during this python session with the same direction, threshold,
+    datastack and materialization version.
+
+    Arguments
+    ---------
+    seg_ids, direction, threshold, client:
+      See `get_synapses`. The materialization version is the client's, so
+      pin the client to a version to keep reusing the same indices.
+
+    refresh: bool (default False)
+      If True, fetch the synapses again even for neurons already indexed,
+      e.g. after their partners have been proofread. Use
+      `clear_synapse_index_cache` to drop every cached index.
+    """
+    if isinstance(seg_ids, (int, np.integer)):
+        seg_ids = [seg_ids]
+    if client is None:
+        client = auth.get_caveclient()
+    version = (client.datastack_name, client.materialize.version)
+    keys = [version + (int(seg_id), direction, threshold) for seg_id in seg_ids]
+    missing = [key[2] for key in keys if refresh or key not in _synapse_indices]
+    if missing:
+        synapses = get_synapses(missing, direction=direction,
+                                threshold=threshold, client=client)
+        neuron_column = '{}_pt_root_id'.format(
+            'post' if direction == 'inputs' else 'pre')
+        by_neuron = dict(list(synapses.groupby(neuron_column)))
+        for seg_id in missing:
+            _synapse_indices[version + (seg_id, direction, threshold)] = SynapseIndex(
+                by_neuron.get(seg_id, synapses.iloc[:0]), direction=direction)
+
+    if len(keys) == 1:
+        return _synapse_indices[keys[0]]
+    return SynapseIndex.concatenate([_synapse_indices[key] for key in keys])
+
+
+DEFAULT_CONNECTIVITY_CACHE = os.path.expanduser('~/fanc-connectivity')
+
+
+def neuropil_labels(synapses: pd.DataFrame,
+                    prefix='is_in_',
+                    priority=None,
+                    unassigned='none') -> pd.Series:
+    """
+    Convert the boolean "is_in_<neuropil>" columns produced by
+    synapse_prediction/neuropil_identification/locate_neuropil.py into a
+    single column with one neuropil label per synapse.
+
+    Arguments
+    ---------
+    synapses: pd.DataFrame
+
+    prefix: str (default 'is_in_')
+      Prefix of the boolean columns to use.
+
+    priority: None (default) OR list of str
+      Neuropil names (without the prefix) in order of priority, used to pick
+      a label for synapses inside several overlapping neuropils. If None, all
+      columns with the prefix are used, in the order they appear.
+
+    unassigned: str (default 'none')
+      Label for synapses that aren't in any neuropil.
+    """
+    if priority is None:
+        priority = [column[len(prefix):] for column in synapses.columns
+                    if column.startswith(prefix)]
+    masks = synapses[[prefix + name for name in priority]].values.astype(bool)
+    labels = np.array(priority + [unassigned], dtype=object)
+    first = np.where(masks.any(axis=1), masks.argmax(axis=1), len(priority))
+    return pd.Series(labels[first], index=synapses.index, name='neuropil')
+
+
+class NeuropilConnectivity(object):
+    """
+    Synapse counts between pairs of neurons, split by the neuropil the
+    synapses are in. Think of it as a sparse (pre, post, neuropil) tensor,
+    stored as one list of nonzero entries sorted by neuropil, then pre, then
+    post, so that the matrix for any one neuropil is a contiguous slice.
+
+    Build one with `neuropil_connectivity`.
+    """
+    _array_names = ['pre_segids', 'post_segids',
+                    'neuropil_idx', 'pre_idx', 'post_idx', 'weights']
+
+    def __init__(self, pre_segids, post_segids, neuropils,
+                 neuropil_idx, pre_idx, post_idx, weights):
+        self.pre_segids = pre_segids
+        self.post_segids = post_segids
+        self.neuropils = list(neuropils)
+        self.neuropil_idx = neuropil_idx
+        self.pre_idx = pre_idx
+        self.post_idx = post_idx
+        self.weights = weights
+
+    def __repr__(self):
+        return ('<NeuropilConnectivity: {} presynaptic x {} postsynaptic'
+                ' neurons in {} neuropils, {} synapses>').format(
+                    len(self.pre_segids), len(self.post_segids),
+                    len(self.neuropils), int(self.weights.sum()))
+
+    @property
+    def shape(self):
+        return len(self.pre_segids), len(self.post_segids), len(self.neuropils)
+
+    @classmethod
+    def from_synapses(cls, synapses: pd.DataFrame,
+                      neuropil_column='neuropil',
+                      pre_column='pre_pt_root_id',
+                      post_column='post_pt_root_id'):
+        """
+        Count synapses per (pre, post, neuropil) in one grouped pass.
+        """
+        pre_segids, pre_idx = np.unique(synapses[pre_column].values,
+                                        return_inverse=True)
+        post_segids, post_idx = np.unique(synapses[post_column].values,
+                                          return_inverse=True)
+        neuropils, neuropil_idx = np.unique(
+            synapses[neuropil_column].values.astype(str), return_inverse=True)
+
+        n_pre, n_post = len(pre_segids), len(post_segids)
+        keys = ((neuropil_idx.astype(np.int64) * n_pre + pre_idx) * n_post
+                + post_idx)
+        keys, weights = np.unique(keys, return_counts=True)
+        pre_idx, post_idx = np.divmod(keys % (n_pre * n_post), n_post)
+        return cls(pre_segids.astype(np.int64), post_segids.astype(np.int64),
+                   neuropils.tolist(),
+                   (keys // (n_pre * n_post)).astype(np.int32),
+                   pre_idx.astype(np.int32), post_idx.astype(np.int32),
+                   weights.astype(np.int32))
+
+    def _slice(self, neuropil):
+        try:
+            i = self.neuropils.index(neuropil)
+        except ValueError:
+            raise KeyError('{} not in neuropils {}'.format(neuropil,
+                                                           self.neuropils))
+        return slice(*np.searchsorted(self.neuropil_idx, [i, i + 1]))
+
+    def matrix(self, neuropil=None):
+        """
+        Return a (pre x post) scipy.sparse.csr_matrix of synapse counts in the
+        given neuropil, or summed over all neuropils if neuropil is None. Rows
+        and columns correspond to `self.pre_segids` and `self.post_segids`.
+        """
+        from scipy import sparse
+
+        s = slice(None) if neuropil is None else self._slice(neuropil)
+        return sparse.csr_matrix((self.weights[s],
+                                  (self.pre_idx[s], self.post_idx[s])),
+                                 shape=self.shape[:2])
+
+    def edges(self, neuropil=None) -> pd.DataFrame:
+        """
+        Return the nonzero entries as a DataFrame with columns 'pre', 'post',
+        'neuropil', 'weight', for one neuropil or (if None) all of them.
+        """
+        s = slice(None) if neuropil is None else self._slice(neuropil)
+        return pd.DataFrame({
+            'pre': self.pre_segids[self.pre_idx[s]],
+            'post': self.post_segids[self.post_idx[s]],
+            'neuropil': np.array(self.neuropils, dtype=object)[self.neuropil_idx[s]],
+            'weight': np.asarray(self.weights[s])
+        })
+
+    def adjacency(self, pre_ids, post_ids, neuropil=None) -> pd.DataFrame:
+        """
+        Return a dense (pre_ids x post_ids) DataFrame of synapse counts in the
+        given neuropil (or all neuropils if None), like `get_adj`.
+        """
+        pre_ids = np.asarray(pre_ids, dtype=np.int64)
+        post_ids = np.asarray(post_ids, dtype=np.int64)
+        rows = np.searchsorted(self.pre_segids, pre_ids).clip(0, len(self.pre_segids) - 1)
+        cols = np.searchsorted(self.post_segids, post_ids).clip(0, len(self.post_segids) - 1)
+        counts = self.matrix(neuropil)[rows][:, cols].toarray()
+        counts[self.pre_segids[rows] != pre_ids, :] = 0
+        counts[:, self.post_segids[cols] != post_ids] = 0
+        return pd.DataFrame(counts, index=pre_ids, columns=post_ids)
+
+    def save(self, path):
+        """
+        Save as .npy files (plus neuropils.json) into the directory `path`.
+        """
+        path = os.path.expanduser(path)
+        os.makedirs(path, exist_ok=True)
+        for name in self._array_names:
+            np.save(os.path.join(path, name + '.npy'), getattr(self, name))
+        with open(os.path.join(path, 'neuropils.json'), 'w') as f:
+            json.dump(self.neuropils, f)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """
+        Load a NeuropilConnectivity saved by `save`, memory-mapping the arrays
+        if mmap is True (default).
+        """
+        path = os.path.expanduser(path)
+        mmap_mode = 'r' if mmap else None
+        arrays = {name: np.load(os.path.join(path, name + '.npy'),
+                                mmap_mode=mmap_mode)
+                  for name in cls._array_names}
+        with open(os.path.join(path, 'neuropils.json'), 'r') as f:
+            neuropils = json.load(f)
+        return cls(neuropils=neuropils, **arrays)
+
+
+def neuropil_connectivity(synapses: pd.DataFrame,
+                          neuropil_column='neuropil',
+                          pre_column='pre_pt_root_id',
+                          post_column='post_pt_root_id',
+                          materialization_version=None,
+                          cache_dir=DEFAULT_CONNECTIVITY_CACHE,
+                          overwrite=False) -> NeuropilConnectivity:
+    """
+    Aggregate a synapse table into connectivity split by neuropil.
+
+    Arguments
+    ---------
+    synapses: pd.DataFrame
+      Synapse table with one row per synapse and a column giving the neuropil
+      each synapse is in. See `neuropil_labels` for making that column from
+      the output of locate_neuropil.py.
+
+    neuropil_column, pre_column, post_column: str
+      Names of the neuropil label, presynaptic and postsynaptic segment ID
+      columns.
+
+    materialization_version: None (default) OR int
+      The materialization version the synapse table came from. If given, the
+      result is cached under cache_dir, and later calls with the same version,
+      neuropil_column and synapses load the cached result instead of
+      recomputing it.
+
+    cache_dir: str (default ~/fanc-connectivity)
+
+    overwrite: bool (default False)
+      If True, recompute and re-cache even if a cached result exists.
+
+    Returns
+    -------
+    NeuropilConnectivity
+    """
+    if materialization_version is None:
+        return NeuropilConnectivity.from_synapses(
+            synapses, neuropil_column=neuropil_column,
+            pre_column=pre_column, post_column=post_column)
+
+    # Key the cache on the synapses too, so that different subsets of the
+    # same version don't share a cached result
+    columns = [pre_column, post_column, neuropil_column]
+    synapses_hash = pd.util.hash_pandas_object(synapses[columns],
+                                               index=False).values.sum()
+    path = os.path.join(cache_dir, 'v{}'.format(materialization_version),
+                        'by_{}'.format(neuropil_column),
+                        '{:016x}_{}'.format(synapses_hash, len(synapses)))
+    if not overwrite and os.path.exists(os.path.join(path, 'neuropils.json')):
+        return NeuropilConnectivity.load(path)
+    result = NeuropilConnectivity.from_synapses(
+        synapses, neuropil_column=neuropil_column,
+        pre_column=pre_column, post_column=post_column)
+    result.save(path)
+    return result
+
+
+def _iter_synapse_partners(source, segids, chunksize,
+                           materialization_version=None, client=None):
+    """
+    Yield (pre_root_ids, post_root_ids) array pairs, one per chunk of
+    synapses, from a synapse source.
+
+    source: 'cave' OR path to a local .csv or sqlite synapse table
+      For 'cave', the outputs of `segids` are queried in batches of
+      `chunksize` neurons. Local tables are read `chunksize` rows at a time.
+    """
+    if source == 'cave':
+        if client is None:
+            client = auth.get_caveclient()
+        synapse_table = client.info.get_datastack_info()['synapse_table']
+        for start in range(0, len(segids), chunksize):
+            batch = segids[start:start+chunksize]
+            synapses = client.materialize.query_table(
+                synapse_table,
+                filter_in_dict={'pre_pt_root_id': batch.tolist()},
+                select_columns=['pre_pt_root_id', 'post_pt_root_id'],
+                materialization_version=materialization_version
+            )
+            if len(synapses) >= 200000:
+                warnings.warn('query is maxed out, use a smaller chunksize')
+            yield synapses.pre_pt_root_id.values, synapses.post_pt_root_id.values
+    elif source.endswith('.csv'):
+        for chunk in pd.read_csv(source, chunksize=chunksize,
+                                 usecols=['pre_root', 'post_root']):
+            yield chunk.pre_root.values, chunk.post_root.values
+    else:
+        con = sqlite3.connect(source)
+        for chunk in pd.read_sql_query('SELECT pre_root, post_root FROM synapses',
+                                       con, chunksize=chunksize):
+            yield chunk.pre_root.values, chunk.post_root.values
+        con.close()
+
+
+def export_connectivity_matrix(path,
+                               synapse_source='cave',
+                               segids=None,
+                               materialization_version=None,
+                               chunksize=None,
+                               client=None):
+    """
+    Build the neuron-by-neuron synapse count matrix among a set of neurons
+    (by default, all proofread neurons) and write it to disk as a compressed
+    sparse matrix.
+
+    Synapses are streamed in chunks and reduced to per-chunk edge counts right
+    away, so memory use is set by the number of connections among the chosen
+    neurons rather than by the number of synapses.
+
+    Arguments
+    ---------
+    path: str
+      Where to write the matrix. The format is chosen by extension:
+        '.npz': a single compressed file. The matrix can be read with
+          scipy.sparse.load_npz, and the 'segids' array in the same file
+          gives the segment ID of each row/column.
+        '.zarr': a directory of chunked, compressed arrays, readable from
+          any language with a zarr library. Requires `pip install zarr`.
+      Use `load_connectivity_matrix` to read either.
+
+    synapse_source: 'cave' (default) OR str
+      'cave' to query the CAVE synapse table, or the path to a local synapse
+      table (.csv, or a sqlite database with a 'synapses' table) with
+      'pre_root' and 'post_root' columns.
+
+    segids: None (default) OR iterable of ints
+      The neurons to include. If None, use all neurons in the proofreading
+      tables (see `fanc.lookup.proofread_neurons`) at the time of the
+      materialization version.
+
+    materialization_version: None (default) OR int
+      Materialization version to query. If None, use the latest one.
+
+    chunksize: None (default) OR int
+      Number of neurons per CAVE query (default 20), or number of rows per
+      chunk for local tables (default 5,000,000).
+
+    client: caveclient.CAVEclient or None
+
+    Returns
+    -------
+    (scipy.sparse.csr_matrix, np.ndarray): the matrix (rows presynaptic,
+    columns postsynaptic) and the segment IDs of its rows/columns.
+    """
+    from scipy import sparse
+    from . import lookup
+
+    if client is None and (synapse_source == 'cave' or segids is None):
+        client = auth.get_caveclient()
+    if materialization_version is None and client is not None:
+        materialization_version = client.materialize.version
+    if segids is None:
+        timestamp = client.materialize.get_timestamp(materialization_version)
+        segids = lookup.proofread_neurons(timestamp=timestamp)
+    segids = np.unique(np.asarray(segids, dtype=np.int64))
+    if chunksize is None:
+        chunksize = 20 if synapse_source == 'cave' else 5_000_000
+
+    n = len(segids)
+    keys, counts = [], []
+    pending = 0
+    for pre, post in _iter_synapse_partners(synapse_source, segids, chunksize,
+                                            materialization_version, client):
+        pre_idx = np.searchsorted(segids, pre).clip(0, n - 1)
+        post_idx = np.searchsorted(segids, post).clip(0, n - 1)
+        keep = (segids[pre_idx] == pre) & (segids[post_idx] == post)
+        chunk_keys, chunk_counts = np.unique(pre_idx[keep] * n + post_idx[keep],
+                                             return_counts=True)
+        keys.append(chunk_keys)
+        counts.append(chunk_counts)
+        pending += len(chunk_keys)
+        # Merge the per-chunk counts every so often to bound memory
+        if pending > 50_000_000:
+            keys, inverse = np.unique(np.concatenate(keys), return_inverse=True)
+            counts = [np.bincount(inverse, weights=np.concatenate(counts))]
+            keys, pending = [keys], len(keys)
+
+    keys, inverse = np.unique(np.concatenate(keys or [np.array([], dtype=np.int64)]),
+                              return_inverse=True)
+    counts = np.bincount(inverse, weights=np.concatenate(counts or [[]]),
+                         minlength=len(keys)).astype(np.int32)
+    pre_idx, post_idx = np.divmod(keys, n)
+    indptr = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(np.bincount(pre_idx, minlength=n), out=indptr[1:])
+    matrix = sparse.csr_matrix((counts, post_idx.astype(np.int32), indptr),
+                               shape=(n, n))
+
+    attrs = {'materialization_version': materialization_version,
+             'synapse_source': synapse_source,
+             'rows': 'presynaptic', 'columns': 'postsynaptic'}
+    # Remove the arrays unpacked by load_connectivity_matrix from any
+    # previous export to this path, so the next load unpacks this one
+    shutil.rmtree(path.rstrip('/') + '.mmap', ignore_errors=True)
+    if path.endswith('.npz'):
+        # Same keys as scipy.sparse.save_npz, plus the segids and attrs
+        np.savez_compressed(path, format='csr', shape=matrix.shape,
+                            data=matrix.data, indices=matrix.indices,
+                            indptr=matrix.indptr, segids=segids,
+                            attrs=json.dumps(attrs))
+    elif path.rstrip('/').endswith('.zarr'):
+        import zarr
+        group = zarr.open_group(path, mode='w')
+        create_array = getattr(group, 'create_array', None) or group.create_dataset
+        for name, array in [('indptr', matrix.indptr), ('indices', matrix.indices),
+                            ('data', matrix.data), ('segids', segids)]:
+            create_array(name=name, data=array,
+                         chunks=(min(max(len(array), 1), 1_000_000),))
+        group.attrs.update(dict(attrs, format='csr', shape=list(matrix.shape)))
+    else:
+        raise ValueError('path must end with .npz or .zarr but was ' + path)
+
+    return matrix, segids
+
+
+def _export_fingerprint(path):
+    """Size and modification time of each file of an exported matrix"""
+    path = path.rstrip('/')
+    if not os.path.isdir(path):
+        stat = os.stat(path)
+        return [['', stat.st_size, stat.st_mtime_ns]]
+    fingerprint = []
+    for root, _, names in os.walk(path):
+        for name in names:
+            stat = os.stat(os.path.join(root, name))
+            fingerprint.append([os.path.relpath(os.path.join(root, name), path),
+                                stat.st_size, stat.st_mtime_ns])
+    return sorted(fingerprint)
+
+
+def load_connectivity_matrix(path, mmap=True):
+    """
+    Load a matrix written by `export_connectivity_matrix`.
+
+    If mmap is True (default), the first load unpacks the matrix's arrays
+    into a directory of .npy files next to the export (named like the export
+    with '.mmap' appended), and every load memory-maps those files, so
+    reloading is nearly instant and pages are read from disk only as
+    needed. The directory records the size and modification time of the
+    export, and is unpacked again if the export changes (e.g. is copied
+    over). If the directory can't be written, the matrix is loaded into
+    memory instead.
+
+    Returns
+    -------
+    (scipy.sparse.csr_matrix, np.ndarray): the matrix (rows presynaptic,
+    columns postsynaptic) and the segment IDs of its rows/columns.
+    """
+    import tempfile
+    from scipy import sparse
+
+    names = ['data', 'indices', 'indptr', 'segids']
+    mmap_dir = path.rstrip('/') + '.mmap'
+    source_file = os.path.join(mmap_dir, 'source.json')
+    fingerprint = _export_fingerprint(path)
+    unpacked = None
+    if mmap and os.path.exists(source_file):
+        with open(source_file, 'r') as f:
+            unpacked = json.load(f)
+    if unpacked == fingerprint:
+        arrays = {name: np.load(os.path.join(mmap_dir, name + '.npy'),
+                                mmap_mode='r') for name in names}
+    else:
+        if path.endswith('.npz'):
+            with np.load(path) as f:
+                arrays = {name: f[name] for name in names}
+        else:
+            import zarr
+            group = zarr.open_group(path, mode='r')
+            arrays = {name: group[name][:] for name in names}
+        if mmap:
+            # Unpack into a temporary directory, then swap it in, so a
+            # half-written directory is never used
+            try:
+                tmp_dir = tempfile.mkdtemp(prefix=os.path.basename(mmap_dir) + '.',
+                                           dir=os.path.dirname(os.path.abspath(mmap_dir)))
+            except OSError:
+                tmp_dir = None  # e.g. a read-only location: keep it in memory
+            if tmp_dir is not None:
+                try:
+                    for name in names:
+                        np.save(os.path.join(tmp_dir, name + '.npy'), arrays[name])
+                    with open(os.path.join(tmp_dir, 'source.json'), 'w') as f:
+                        json.dump(fingerprint, f)
+                    shutil.rmtree(mmap_dir, ignore_errors=True)
+                    os.rename(tmp_dir, mmap_dir)
+                except OSError:
+                    shutil.rmtree(tmp_dir, ignore_errors=True)
+                else:
+                    return load_connectivity_matrix(path, mmap=True)
 
-    return result 
+    n = len(arrays['segids'])
+    matrix = sparse.csr_matrix((arrays['data'], arrays['indices'],
+                                arrays['indptr']), shape=(n, n))
+    return matrix, arrays['segids']
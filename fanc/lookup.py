@@ -88,18 +88,40 @@ def proofreading_status(segids: int or list[int],
     return results.loc[segids].to_list()
 
 
-def num_proofread_neurons(source_tables: str or list[str] = default_proofreading_tables,
-                          timestamp='now') -> int:
+def proofread_neurons(source_tables: str or list[str] = default_proofreading_tables,
+                      timestamp='now') -> np.ndarray:
     """
-    Count the number of unique neurons that have been marked as proofread.
+    Get the segment IDs of all neurons that have been marked as proofread.
+
+    Arguments
+    ---------
+    source_tables: str, or list of str
+      The name(s) of the CAVE proofreading table(s) to query
+
+    timestamp: 'now' (default) OR datetime
+      The timestamp at which to query the proofreading tables.
+
+    Returns
+    -------
+    np.ndarray of the unique segment IDs, sorted, as int64
     """
+    if isinstance(source_tables, str):
+        source_tables = [source_tables]
     if timestamp in ['now', 'live']:
         timestamp = datetime.utcnow()
 
     client = auth.get_caveclient()
     tables = [client.materialize.live_live_query(table_name, timestamp)
               for table_name in source_tables]
-    return pd.concat(tables).pt_root_id.nunique()
+    return np.unique(pd.concat(tables).pt_root_id.values.astype(np.int64))
+
+
+def num_proofread_neurons(source_tables: str or list[str] = default_proofreading_tables,
+                          timestamp='now') -> int:
+    """
+    Count the number of unique neurons that have been marked as proofread.
+    """
+    return len(proofread_neurons(source_tables, timestamp=timestamp))
 
 
 def cells_annotated_with(tags: str or list[str],
@@ -7,6 +7,7 @@ import csv
 from secrets import token_hex
 import random
 import sqlite3
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import pandas as pd
@@ -67,7 +68,53 @@ def downscale(array, scale_factor, inplace=True):
         return array
 
 
-def load(fn, convention='xyz', units='voxels', voxel_size=None, verbose=False, threshold = 12):
+# Record layout of the binary files written by
+# synapse_prediction/detection/synful_extract.py:
+# post coord(x,y,z), pre coord(x,y,z), mean, max, area, 4x4x4 moments
+binary_link_dtype = np.dtype("6f8,3f8,(4,4,4)f8")
+# Named version of the score fields of each record. moments[0, 0, 0] is the
+# "sum" score, the sum of the prediction values in the detected blob.
+score_dtype = np.dtype([('mean', 'f8'), ('max', 'f8'), ('area', 'f8'),
+                        ('sum', 'f8'), ('moments', 'f8', (4, 4, 4))])
+
+
+def _binary_dtype(score_columns=None):
+    """
+    Record layout of binary link files. Files written with synful_extract's
+    score_columns parameter hold only those scores, in that order, after the
+    coordinates.
+    """
+    if score_columns is None:
+        return binary_link_dtype
+    return np.dtype([('f0', 'f8', (6,)), ('scores', 'f8', (len(score_columns),))])
+
+
+def _load_binary(fn, threshold, score_columns=None):
+    """
+    Memory-map one binary link file and return the records whose "sum" score
+    passes the threshold (or all of them if threshold is None).
+    """
+    dtype = _binary_dtype(score_columns)
+    size = os.path.getsize(fn)
+    if size == 0:
+        # Blocks without any links are saved as empty files
+        return np.zeros(0, dtype=dtype)
+    if size % dtype.itemsize:
+        raise ValueError(f'{fn} is not a whole number of {dtype.itemsize}-byte'
+                         ' records. If it was written with a subset of score'
+                         ' columns, pass the same list as score_columns.')
+    data = np.memmap(fn, dtype=dtype, mode='r')
+    if threshold is None:
+        return np.array(data)
+    if score_columns is None:
+        sums = data['f2'][:, 0, 0, 0]
+    else:
+        sums = data['scores'][:, list(score_columns).index('sum')]
+    return np.array(data[sums > threshold])
+
+
+def load(fn, convention='xyz', units='voxels', voxel_size=None, verbose=False, threshold = 12,
+         return_scores=False, parallel=8, score_columns=None):
     """
     Given a filename of a file containing synaptic links, load the links and
     return them as an Nx6 numpy array representing the N links.  The first 3
@@ -88,9 +135,31 @@ def load(fn, convention='xyz', units='voxels', voxel_size=None, verbose=False, t
         knows what default voxel size to use for different file formats.
 
     threshold: int, threshold to apply based on "sum"
+
+    The following apply to binary files only:
+    threshold may also be None to keep every link.
+    fn may also be a directory, in which case every file in it is loaded (in
+        parallel) and all links are returned together.
+    return_scores: bool (default False)
+        If True, return a tuple (links, scores), with scores being a
+        structured array of dtype `score_dtype` aligned with links.
+    parallel: int (default 8)
+        Number of files to load at once when fn is a directory.
+    score_columns: None (default) or list of str
+        For files written by synful_extract with its score_columns parameter,
+        the same list of columns, which determines the record layout. The
+        threshold needs 'sum' to be one of them (or use threshold=None), and
+        scores are returned with one field per column instead of
+        `score_dtype`.
     """
     assert convention in ['xyz', 'zyx']
     assert units in ['voxels', 'nm', 'nanometers']
+    if return_scores and fn.endswith(('.npy', '.csv')):
+        raise ValueError('return_scores is only supported for binary files')
+    if (score_columns is not None and threshold is not None
+            and 'sum' not in score_columns):
+        raise ValueError("Thresholding needs the 'sum' score column. Pass"
+                         " threshold=None to load these links unthresholded.")
 
     if fn.endswith('.npy'):
         if verbose: print('Mode 1: npy')
@@ -140,14 +209,31 @@ def load(fn, convention='xyz', units='voxels', voxel_size=None, verbose=False, t
     else:
         if verbose: print('Mode 3: binary')
         # For opening binary files saved by ../detection/worker.py
-        # post coord(x,y,z), pre coord(x,y,z), mean, max, area, 4x4x4 moments
-        data = np.fromfile(fn, dtype=np.dtype("6f8,3f8,(4,4,4)f8"))
-
-        # Apply threshold based on "sum" and return links that pass.
-        try:
-            links = np.stack([x[0].astype("int32") for x in data if x[2][0][0][0] > threshold])
-        except:
-            return np.array([])
+        if os.path.isdir(fn):
+            files = sorted(os.path.join(fn, f) for f in os.listdir(fn))
+            files = [f for f in files if os.path.isfile(f)]
+            with ThreadPoolExecutor(max_workers=parallel) as executor:
+                data = list(executor.map(
+                    lambda f: _load_binary(f, threshold, score_columns), files))
+            data = (np.concatenate(data) if data
+                    else np.zeros(0, dtype=_binary_dtype(score_columns)))
+        else:
+            data = _load_binary(fn, threshold, score_columns)
+
+        # Threshold based on "sum" was applied above, keep links that passed.
+        links = data['f0'].astype('int32')
+
+        if return_scores and score_columns is not None:
+            scores = np.zeros(len(data), dtype=[(name, 'f8') for name in score_columns])
+            for i, name in enumerate(score_columns):
+                scores[name] = data['scores'][:, i]
+        elif return_scores:
+            scores = np.zeros(len(data), dtype=score_dtype)
+            scores['mean'] = data['f1'][:, 0]
+            scores['max'] = data['f1'][:, 1]
+            scores['area'] = data['f1'][:, 2]
+            scores['sum'] = data['f2'][:, 0, 0, 0]
+            scores['moments'] = data['f2']
 
         if True:  # The Feb 7 predictions were saved in post-pre order
             flip_pre_post_order(links)
@@ -170,9 +256,43 @@ def load(fn, convention='xyz', units='voxels', voxel_size=None, verbose=False, t
     if convention == 'zyx':
         flip_xyz_zyx_convention(links)
 
+    if return_scores:
+        return links, scores
     return links
 
 
+def _prepare_ng_links(synapses, input_order='xyz', input_units=(1, 1, 1),
+                      voxel_mip_center=None):
+    """
+    Convert synaptic links to an xyz-ordered Nx6 array in units of voxels,
+    optionally shifted to voxel centers. See to_ng_annotations for a
+    description of the arguments.
+    """
+    assert input_order in ['xyz', 'zyx']
+
+    if isinstance(synapses, str):
+        synapses = load(synapses)
+
+    if isinstance(synapses, pd.DataFrame):
+        synapses = np.hstack([np.vstack(synapses.pre_pt_position.values),
+                              np.vstack(synapses.post_pt_position.values)])
+
+    synapses = np.asarray(synapses)
+    if tuple(input_units) != (1, 1, 1):
+        synapses = downscale(synapses.astype(float), input_units, inplace=False)
+        # Now synapses are in units of voxels
+
+    if input_order == 'zyx':
+        synapses = flip_xyz_zyx_convention(synapses, inplace=False)
+
+    if voxel_mip_center is not None:
+        delta = 0.5 * 2**voxel_mip_center
+        adjustment = (delta, delta, 0, delta, delta, 0)
+        synapses = synapses.astype(float) + adjustment
+
+    return synapses
+
+
 def to_ng_annotations(synapses, input_order='xyz', input_units=(1, 1, 1),
                       voxel_mip_center=None):
     """
@@ -202,8 +322,6 @@ def to_ng_annotations(synapses, input_order='xyz', input_units=(1, 1, 1),
         The z coordinate is not changed no matter what, since mips only
         downsample x and y.
     """
-    assert input_order in ['xyz', 'zyx']
-
     def line_anno(pre, post):
         return {
             'pointA': [x for x in pre],
@@ -214,24 +332,8 @@ def to_ng_annotations(synapses, input_order='xyz', input_units=(1, 1, 1),
             'id': token_hex(40)
         }
 
-    if isinstance(synapses, str):
-        synapses = load(synapses)
-
-    if isinstance(synapses, pd.DataFrame):
-        synapses = np.hstack([np.vstack(synapses.pre_pt_position.values),
-                              np.vstack(synapses.post_pt_position.values)])
-
-    if tuple(input_units) != (1, 1, 1):
-        synapses = downscale(synapses.astype(float), input_units, inplace=False)
-        # Now synapses are in units of voxels
-
-    if input_order == 'zyx':
-        synapses = flip_xyz_zyx_convention(synapses, inplace=False)
-
-    if voxel_mip_center is not None:
-        delta = 0.5 * 2**voxel_mip_center
-        adjustment = (delta, delta, 0, delta, delta, 0)
-        synapses = synapses.astype(float) + adjustment
+    synapses = _prepare_ng_links(synapses, input_order, input_units,
+                                 voxel_mip_center)
 
     annotations = [line_anno(synapses[i, 0:3].tolist(),
                              synapses[i, 3:6].tolist())
@@ -249,3 +351,441 @@ def to_ng_annotations(synapses, input_order='xyz', input_units=(1, 1, 1),
     except:
         print("Install pyperclip (pip install pyperclip) for the option to"
               " programmatically copy the output above to the clipboard")
+
+
+_hex_digits = np.array(['{:02x}'.format(i) for i in range(256)], dtype='S2')
+
+
+def _random_hex_ids(n, nbytes=40):
+    """
+    Generate n random hex strings of 2*nbytes characters each, equivalent to
+    calling secrets.token_hex(nbytes) n times but without a Python loop.
+    """
+    raw = np.frombuffer(os.urandom(n * nbytes), dtype=np.uint8)
+    return _hex_digits[raw].view('S{}'.format(2 * nbytes)).astype(str)
+
+
+def _format_coordinates(values):
+    """
+    Convert a 1D array of coordinates to strings, the same way json.dumps
+    would. Integer and half-integer values (the common case for voxel
+    coordinates, with or without voxel_mip_center) are formatted through
+    integer conversion, which is several times faster than float repr.
+    """
+    if values.dtype.kind in 'iu':
+        return values.astype(str)
+    magnitude = np.abs(values)
+    whole = np.floor(magnitude)
+    fraction = magnitude - whole
+    if not (np.isfinite(values).all() and np.isin(fraction, (0, 0.5)).all()):
+        return values.astype(str)
+    strings = np.char.add(np.where(np.signbit(values), '-', ''),
+                          whole.astype(np.int64).astype(str))
+    return np.char.add(strings, np.where(fraction == 0, '.0', '.5'))
+
+
+def _format_ng_line_annotations(links, nbytes=40):
+    """
+    Format an Nx6 array of xyz-ordered voxel coordinates as an array of
+    compact JSON strings, one neuroglancer line annotation per row.
+    """
+    coords = [_format_coordinates(links[:, i]) for i in range(6)]
+    pieces = ['{"pointA":[', coords[0], ',', coords[1], ',', coords[2],
+              '],"pointB":[', coords[3], ',', coords[4], ',', coords[5],
+              '],"type":"line","id":"', _random_hex_ids(len(links), nbytes),
+              '"}']
+    annotations = pieces[0]
+    for piece in pieces[1:]:
+        annotations = np.char.add(annotations, piece)
+    return annotations
+
+
+def write_ng_annotations(synapses, out, input_order='xyz',
+                         input_units=(1, 1, 1), voxel_mip_center=None,
+                         chunksize=100000, id_bytes=40):
+    """
+    Write synaptic links as a json list of neuroglancer line annotations,
+    the same format as to_ng_annotations produces but without indentation
+    or any interactive prompts. Annotations are formatted and written one
+    chunk at a time, so memory use does not grow with the number of links.
+
+    Arguments
+    ---------
+    synapses: np.array, pd.DataFrame, str, or iterable of these
+        Nx6 numpy array representing N pre-post point pairs, DataFrame with
+        columns 'pre_pt_position' and 'post_pt_position', or a filename that
+        can be read by load(). Can also be an iterable (e.g. a generator)
+        yielding any of these, to export links that don't fit in memory.
+    out: str or file-like
+        Filename to write to, or an open text stream such as sys.stdout.
+    input_order, input_units, voxel_mip_center:
+        See to_ng_annotations.
+    chunksize: int
+        Number of annotations to format and write at a time.
+    id_bytes: int
+        Number of random bytes in each annotation ID. The default of 40
+        matches to_ng_annotations.
+
+    Returns
+    -------
+    int: Number of annotations written.
+    """
+    if isinstance(out, (str, Path)):
+        with open(out, 'w') as f:
+            return write_ng_annotations(synapses, f, input_order=input_order,
+                                        input_units=input_units,
+                                        voxel_mip_center=voxel_mip_center,
+                                        chunksize=chunksize, id_bytes=id_bytes)
+
+    if isinstance(synapses, (np.ndarray, pd.DataFrame, str, Path)):
+        synapses = [synapses]
+
+    n_written = 0
+    out.write('[')
+    for links in synapses:
+        if isinstance(links, Path):
+            links = str(links)
+        links = _prepare_ng_links(links, input_order, input_units,
+                                  voxel_mip_center)
+        for start in range(0, len(links), chunksize):
+            annotations = _format_ng_line_annotations(
+                links[start:start + chunksize], nbytes=id_bytes)
+            out.write(',\n' if n_written else '\n')
+            out.write(',\n'.join(annotations.tolist()))
+            n_written += len(annotations)
+    out.write('\n]\n')
+    return n_written
+
+
+_precomputed_property_types = {
+    np.dtype('float32'): 'float32',
+    np.dtype('uint8'): 'uint8',
+    np.dtype('int8'): 'int8',
+    np.dtype('uint16'): 'uint16',
+    np.dtype('int16'): 'int16',
+    np.dtype('uint32'): 'uint32',
+    np.dtype('int32'): 'int32',
+}
+
+
+def _precomputed_property(name, values):
+    """
+    Choose the neuroglancer precomputed property type for an array of values,
+    returning (property spec, values cast to that type).
+    """
+    values = np.asarray(values)
+    if values.dtype.kind == 'f':
+        values = values.astype(np.float32)
+    elif values.dtype.kind == 'b':
+        values = values.astype(np.uint8)
+    elif values.dtype not in _precomputed_property_types:
+        if values.dtype.kind not in 'iu':
+            raise TypeError(f'Property "{name}" has unsupported dtype {values.dtype}')
+        for dtype in ('uint8', 'uint16', 'uint32') if values.min() >= 0 else ('int8', 'int16', 'int32'):
+            info = np.iinfo(dtype)
+            if values.min() >= info.min and values.max() <= info.max:
+                values = values.astype(dtype)
+                break
+        else:
+            raise ValueError(f'Property "{name}" does not fit in 32 bits, which is'
+                             ' the largest integer type neuroglancer supports')
+    spec = {'id': name, 'type': _precomputed_property_types[values.dtype]}
+    return spec, values
+
+
+def _precomputed_sharding(n_keys, keys_per_shard=100000, keys_per_minishard=1000):
+    """
+    Sharding specification for a precomputed annotation index holding
+    n_keys entries, sized so each shard holds roughly keys_per_shard entries.
+    """
+    from cloudvolume.datasource.precomputed.sharding import ShardingSpecification
+    shard_bits = int(np.ceil(np.log2(max(n_keys / keys_per_shard, 1))))
+    minishard_bits = int(np.ceil(np.log2(max(
+        n_keys / 2**shard_bits / keys_per_minishard, 1))))
+    return ShardingSpecification(
+        type='neuroglancer_uint64_sharded_v1',
+        preshift_bits=0,
+        hash='murmurhash3_x86_128',
+        minishard_bits=minishard_bits,
+        shard_bits=shard_bits,
+        minishard_index_encoding='gzip',
+        data_encoding='gzip',
+    )
+
+
+def _encode_annotation_list(records, ids):
+    """
+    Encode annotations in the format used by precomputed spatial and
+    relationship index files: a uint64 count, the annotation records, then
+    the uint64 annotation ids.
+    """
+    return b''.join([np.uint64(len(records)).tobytes(), records.tobytes(),
+                     ids.astype('<u8').tobytes()])
+
+
+def _iter_groups(keys):
+    """
+    Given an array of keys, yield (key, indices) for each unique key, with
+    indices in their original relative order.
+    """
+    order = np.argsort(keys, kind='stable')
+    unique_keys, starts = np.unique(keys[order], return_index=True)
+    bounds = np.append(starts, len(order))
+    for i, key in enumerate(unique_keys):
+        yield key, order[bounds[i]:bounds[i + 1]]
+
+
+def _spatial_levels(lower, upper, voxel_size, max_levels):
+    """
+    Chunk sizes for each level of a precomputed annotation spatial index.
+    Level 0 is a single chunk covering the whole bounding box, and each
+    subsequent level halves the chunk size along whichever axes are within a
+    factor of 2 of the largest chunk dimension in physical units, so chunks
+    become approximately isotropic at the finer levels.
+    """
+    chunk_size = np.maximum(upper - lower, 1).astype(float)
+    levels = []
+    for level in range(max_levels):
+        grid_shape = np.maximum(np.ceil((upper - lower) / chunk_size), 1).astype(int)
+        levels.append((chunk_size.copy(), grid_shape))
+        physical = chunk_size * voxel_size
+        chunk_size[physical > physical.max() / 2] /= 2
+    return levels
+
+
+def write_precomputed_annotations(synapses, path, annotation_type='line',
+                                  point='pre', ids=None, pre_root_ids=None,
+                                  post_root_ids=None, properties=None,
+                                  voxel_size=(4.3, 4.3, 45), input_order='xyz',
+                                  input_units=(1, 1, 1), voxel_mip_center=None,
+                                  limit=10000, max_levels=10, sharded=True,
+                                  seed=0):
+    """
+    Write synaptic links in neuroglancer's precomputed annotation format,
+    which neuroglancer streams chunk by chunk instead of holding every
+    annotation in the viewer state. Add the result to a neuroglancer state
+    as an annotation layer with source 'precomputed://<path>'.
+
+    The output has a multi-level spatial index (level 0 is a random subset of
+    at most `limit` annotations covering the whole dataset, and each finer
+    level holds at most `limit` of the remaining annotations per chunk), an
+    index by annotation ID, and optionally indices by pre- and postsynaptic
+    root ID, so that selecting a segment in neuroglancer shows its synapses.
+
+    Arguments
+    ---------
+    synapses: np.array, pd.DataFrame, or str
+        Nx6 numpy array representing N pre-post point pairs, a filename that
+        can be read by load(), or a DataFrame with columns 'pre_pt_position'
+        and 'post_pt_position'. If a DataFrame has 'id', 'pre_pt_root_id' or
+        'post_pt_root_id' columns, they are used as the defaults for `ids`,
+        `pre_root_ids` and `post_root_ids`.
+    path: str
+        Local directory or CloudFiles path (e.g. gs://bucket/synapses) to
+        write to.
+    annotation_type: 'line' (default) or 'point'
+        Write each link as a line, or as a single point (see `point`).
+    point: 'pre' (default) or 'post'
+        For annotation_type='point', which end of each link to write.
+    ids: None or array of N ints
+        Annotation IDs. Defaults to 0 through N-1.
+    pre_root_ids, post_root_ids: None or array of N ints
+        Segment IDs of the pre- and postsynaptic neurons. If given, they are
+        written as the 'pre_segment' and 'post_segment' relationships. Zeros
+        are treated as "no segment".
+    properties: None, dict, or list of str
+        Numeric properties to attach to each annotation, e.g.
+        {'score': scores}. If synapses is a DataFrame, can also be a list of
+        column names. Floats are stored as float32 and integers as the
+        smallest neuroglancer-supported integer type that fits them.
+    voxel_size: 3-tuple
+        Size of a voxel in nm, in xyz order. Annotation coordinates are
+        stored in units of these voxels.
+    input_order, input_units, voxel_mip_center:
+        See to_ng_annotations.
+    limit: int
+        Maximum number of annotations in each spatial index chunk, except at
+        the finest level, which holds whatever remains.
+    max_levels: int
+        Maximum number of spatial index levels.
+    sharded: bool
+        If True (default), write the by-ID and relationship indices as
+        sharded files. Otherwise write one file per annotation and per
+        segment, which is simpler but impractical beyond a few thousand
+        annotations.
+    seed: int
+        Random seed for choosing which annotations go into coarser levels.
+
+    Returns
+    -------
+    dict: The info file that was written.
+    """
+    from cloudfiles import CloudFiles
+
+    assert annotation_type in ['line', 'point']
+    assert point in ['pre', 'post']
+
+    if isinstance(synapses, pd.DataFrame):
+        if ids is None and 'id' in synapses.columns:
+            ids = synapses['id'].values
+        if pre_root_ids is None and 'pre_pt_root_id' in synapses.columns:
+            pre_root_ids = synapses['pre_pt_root_id'].values
+        if post_root_ids is None and 'post_pt_root_id' in synapses.columns:
+            post_root_ids = synapses['post_pt_root_id'].values
+        if isinstance(properties, (list, tuple)):
+            properties = {name: synapses[name].values for name in properties}
+    links = _prepare_ng_links(synapses, input_order, input_units,
+                              voxel_mip_center).astype(np.float32)
+    n = len(links)
+    if n == 0:
+        raise ValueError('No synapses to write')
+
+    if annotation_type == 'point':
+        geometry = links[:, 0:3] if point == 'pre' else links[:, 3:6]
+    else:
+        geometry = links
+    if ids is None:
+        ids = np.arange(n, dtype=np.uint64)
+    ids = np.asarray(ids).astype(np.uint64)
+    if len(np.unique(ids)) != n:
+        raise ValueError('Annotation IDs must be unique')
+
+    # Annotation records: geometry followed by properties, largest types
+    # first, padded to a multiple of 4 bytes
+    if properties is None:
+        properties = {}
+    property_specs, property_values = [], []
+    for name, values in properties.items():
+        spec, values = _precomputed_property(name, values)
+        if len(values) != n:
+            raise ValueError(f'Property "{name}" has {len(values)} values, expected {n}')
+        property_specs.append(spec)
+        property_values.append(values)
+    order = sorted(range(len(property_specs)),
+                   key=lambda i: -property_values[i].dtype.itemsize)
+    fields = [('geometry', '<f4', (geometry.shape[1],))]
+    fields += [(property_specs[i]['id'], property_values[i].dtype.newbyteorder('<'))
+               for i in order]
+    record_size = np.dtype(fields).itemsize
+    if record_size % 4:
+        fields.append(('padding', 'u1', (4 - record_size % 4,)))
+    records = np.zeros(n, dtype=fields)
+    records['geometry'] = geometry
+    for i in order:
+        records[property_specs[i]['id']] = property_values[i]
+    property_specs = [property_specs[i] for i in order]
+
+    relationships = []
+    for name, roots in (('pre_segment', pre_root_ids),
+                        ('post_segment', post_root_ids)):
+        if roots is not None:
+            roots = np.asarray(roots).astype(np.uint64)
+            if len(roots) != n:
+                raise ValueError(f'{name} has {len(roots)} IDs, expected {n}')
+            relationships.append((name, roots))
+
+    points = links.reshape(-1, 3) if annotation_type == 'line' else geometry
+    lower = np.floor(points.min(axis=0)).astype(float)
+    upper = np.floor(points.max(axis=0)).astype(float) + 1
+    voxel_size = np.asarray(voxel_size, dtype=float)
+
+    info = {
+        '@type': 'neuroglancer_annotations_v1',
+        'dimensions': {axis: [size / 1e9, 'm']
+                       for axis, size in zip('xyz', voxel_size)},
+        'lower_bound': lower.tolist(),
+        'upper_bound': upper.tolist(),
+        'annotation_type': annotation_type,
+        'properties': property_specs,
+        'relationships': [],
+        'by_id': {'key': 'by_id'},
+        'spatial': [],
+    }
+
+    cf = CloudFiles(path)
+
+    def put(files):
+        cf.puts(files, content_type='application/octet-stream', compress=None)
+
+    def put_index(key, entries):
+        """Write a dict of {uint64 key: bytes}, sharded if requested"""
+        if sharded:
+            spec = _precomputed_sharding(len(entries))
+            put((f'{key}/{filename}', content) for filename, content
+                in spec.synthesize_shards(entries).items())
+            return json.loads(spec.to_json())
+        put((f'{key}/{k}', content) for k, content in entries.items())
+        return None
+
+    # Spatial index. Annotations are placed by their first point.
+    rng = np.random.default_rng(seed)
+    remaining = rng.permutation(n)
+    levels = _spatial_levels(lower, upper, voxel_size, max_levels)
+    for level, (chunk_size, grid_shape) in enumerate(levels):
+        cells = np.floor((geometry[remaining, 0:3] - lower) / chunk_size).astype(int)
+        cells = np.clip(cells, 0, grid_shape - 1)
+        cell_keys = np.ravel_multi_index(cells.T, grid_shape)
+        finest = level == len(levels) - 1
+        chunks = []
+        keep = np.zeros(len(remaining), dtype=bool)
+        for cell_key, idx in _iter_groups(cell_keys):
+            if not finest:
+                idx = idx[:limit]
+            keep[idx] = True
+            cell = np.unravel_index(cell_key, grid_shape)
+            chunks.append(('_'.join(str(c) for c in cell), remaining[idx]))
+        # Each level past the first only needs to exist if annotations remain
+        # after filling the coarser ones
+        finest = finest or keep.all()
+        max_count = max(len(idx) for _, idx in chunks)
+        key = f'spatial{level}'
+        put((f'{key}/{name}', _encode_annotation_list(records[idx], ids[idx]))
+            for name, idx in chunks)
+        info['spatial'].append({
+            'key': key,
+            'grid_shape': grid_shape.tolist(),
+            'chunk_size': chunk_size.tolist(),
+            'limit': max_count if finest else limit,
+        })
+        remaining = remaining[~keep]
+        if finest:
+            break
+
+    # Index by annotation ID: each record followed by its related segments
+    rel_fields = [('record', records.dtype)]
+    for i, _ in enumerate(relationships):
+        rel_fields += [(f'count{i}', '<u4'), (f'segment{i}', '<u8')]
+    by_id = np.zeros(n, dtype=rel_fields)
+    by_id['record'] = records
+    for i, (_, roots) in enumerate(relationships):
+        by_id[f'count{i}'] = 1
+        by_id[f'segment{i}'] = roots
+    raw = by_id.tobytes()
+    size = by_id.dtype.itemsize
+    entries = {int(annotation_id): raw[i * size:(i + 1) * size]
+               for i, annotation_id in enumerate(ids)}
+    if relationships:
+        missing = np.flatnonzero(np.any([roots == 0 for _, roots in relationships], axis=0))
+        for i in missing:
+            entries[int(ids[i])] = records[i].tobytes() + b''.join(
+                np.uint32(0).tobytes() if roots[i] == 0 else
+                np.uint32(1).tobytes() + roots[i].astype('<u8').tobytes()
+                for _, roots in relationships)
+    sharding = put_index('by_id', entries)
+    if sharding is not None:
+        info['by_id']['sharding'] = sharding
+    del entries, raw, by_id
+
+    # Index by related segment
+    for name, roots in relationships:
+        key = f'rel_{name}'
+        entries = {int(segid): _encode_annotation_list(records[idx], ids[idx])
+                   for segid, idx in _iter_groups(roots) if segid != 0}
+        relationship = {'id': name, 'key': key}
+        sharding = put_index(key, entries)
+        if sharding is not None:
+            relationship['sharding'] = sharding
+        info['relationships'].append(relationship)
+
+    cf.put_json('info', info)
+    return info
@@ -26,6 +26,7 @@ def plot_neurons(segment_ids,
                  plot_synapses=False,
                  synapse_type='all',
                  synapse_threshold=3,
+                 synapse_region=None,
                  plot_soma=False,
                  show_outlines=False,
                  scale_bar_origin_3D=None,
@@ -57,6 +58,9 @@ def plot_neurons(segment_ids,
         json state id of neuroglancer scene. required to plot scale bar
     plot_synapses :  bool
         visualize synapses
+    synapse_region :  dict
+        only visualize synapses inside this box, sphere or neuropil mesh.
+        See connectivity.SynapseIndex.in_region for the format
     plot_soma : bool
         visualize soma
     show_outlines :  bool
@@ -122,35 +126,21 @@ def plot_neurons(segment_ids,
 
         # get synapses
         if plot_synapses is True:
-            if synapse_type == 'inputs':
-                input_table = connectivity.get_synapses(j[1],
-                                                          direction='inputs',
-                                                          threshold=synapse_threshold)
+            if synapse_type not in ['inputs', 'outputs', 'all']:
+                raise Exception('incorrect synapse type, use: "inputs", "outputs", or "all"')
 
+            if synapse_type in ['inputs', 'all']:
+                input_table = _get_synapses_in_region(j[1], 'inputs',
+                                                      synapse_threshold,
+                                                      synapse_region)
                 neuron.add_annotations('syn_in', input_table, point_column='post_pt')
 
-
-            elif synapse_type == 'outputs':
-                input_table = None
-                output_table = connectivity.get_synapses(j[1],
-                                                           direction='outputs',
-                                                           threshold=synapse_threshold)
-            elif synapse_type == 'all':
-                input_table = connectivity.get_synapses(j[1],
-                                                          direction='inputs',
-                                                          threshold=synapse_threshold)
-
-                output_table = connectivity.get_synapses(j[1],
-                                                           direction='outputs',
-                                                           threshold=synapse_threshold)
-
-                neuron.add_annotations('syn_in', input_table, point_column='post_pt')
+            if synapse_type in ['outputs', 'all']:
+                output_table = _get_synapses_in_region(j[1], 'outputs',
+                                                       synapse_threshold,
+                                                       synapse_region)
                 neuron.add_annotations('syn_out', output_table, point_column='pre_pt')
 
-
-            else:
-                raise Exception('incorrect synapse type, use: "inputs", "outputs", or "all"')
-
         # Plot
 
         if 'mesh' in plot_type:
@@ -237,6 +227,15 @@ def plot_neurons(segment_ids,
                                     scale=1, video_width=width, video_height=height)
 
 
+def _get_synapses_in_region(segment_id, direction, threshold, region=None):
+    index = connectivity.get_synapse_index(segment_id,
+                                           direction=direction,
+                                           threshold=threshold)
+    if region is None:
+        return index.synapses
+    return index.in_region(region)
+
+
 def scale_bar_actor_2D(center, camera, view='X', length=10000, color=(0, 0, 0), linewidth=5, font_size=20):
     """
     Creates a scale bar actor very similar to trimesh_vtk.scale_bar_actor(), but on a specific plane with
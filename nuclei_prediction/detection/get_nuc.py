@@ -154,6 +154,14 @@ def task_get_nuc_info(i): # use i = 7817 for test, close to [7953 118101 2584]
 
         if arr.ndim == 2:
             arr2 = np.hstack((arr.copy().astype('int64'), np.zeros((arr.shape[0],5), dtype='int64'))) # array to store output
+
+            # read nucIDs for the whole block once instead of one voxel at a time
+            nuc_seg = nuclei_seg_cv.download_point(block_centers[i], mip=[68.8,68.8,45.0], size=(block_x, block_y, block_z) )
+            nuc_seg_offset = np.array(nuclei.bounds.minpt - nuc_seg.bounds.minpt, dtype='int64') # zero unless autocrop cut the two differently
+            nuc_seg = np.squeeze(nuc_seg[:,:,:], axis=3)
+            sampled_obj = [] # label of each voxel whose nucID is used
+            sampled_vox = [] # and its location in the block, mip4
+
             for obj in range(N):
                 center_mip0 = mip4_to_mip0_array(arr[obj,1:4], nuclei)
                 vinside = np.argwhere(cc_out == int(arr[obj,0]))
@@ -165,24 +173,27 @@ def task_get_nuc_info(i): # use i = 7817 for test, close to [7953 118101 2584]
                     lrandom = vinside
 
                 lrandom_mip0 = np.apply_along_axis(mip4_to_mip0_array, 1, lrandom, nuclei)
-                lrandom_mip4 = lrandom + nuclei.bounds.minpt
 
                 segIDs = IDlook.segIDs_from_pts_cv(pts=lrandom_mip0, cv=seg, progress=False) # segIDs_from_pts_cv uses mip0 for pt
                 nuc_segID = find_most_frequent_ID(segIDs)
                 nuc_svID,nuc_xyz = segID_to_svID(nuc_segID, segIDs, lrandom_mip0, reverse=False)
 
-                nucIDs_list = []
-                for k in range(len(lrandom_mip4)):
-                    nucID_temp = nuclei_seg_cv.download_point(lrandom_mip4[k], mip=[68.8,68.8,45.0], size=(1, 1, 1) ) # download_point uses mip4 for pt
-                    nucIDs_list.append(np.squeeze(nucID_temp))
-                nucID = find_most_frequent_ID(np.array(nucIDs_list, dtype='int64'))
+                sampled_obj.append(np.full(len(lrandom), obj + 1, dtype='int64'))
+                sampled_vox.append(lrandom + nuc_seg_offset)
 
                 arr2[obj,1:4] = center_mip0 # change xyz from mip4 to mip0
                 arr2[obj,10] = nuc_svID # insert
-                arr2[obj,11] = nucID # insert
                 arr2[obj,12:15] = nuc_xyz # insert
                 arr2[obj,0] = i # no longer need ccid
 
+            if N > 0:
+                sampled_obj = np.concatenate(sampled_obj)
+                sampled_vox = np.concatenate(sampled_vox)
+                inside = np.all((sampled_vox >= 0) & (sampled_vox < nuc_seg.shape), axis=1) # outside the nuclei_seg volume counts as 0
+                nucIDs = np.zeros(len(sampled_vox), dtype=nuc_seg.dtype)
+                nucIDs[inside] = nuc_seg[tuple(sampled_vox[inside].T)]
+                arr2[:N,11] = find_most_frequent_ID_per_label(sampled_obj, nucIDs, N) # insert
+
         else:
             arr2 = np.zeros(15, dtype = 'int64')
             arr2[0] = i
@@ -105,6 +105,21 @@ def find_most_frequent_ID(array):
     return topID
 
 
+def find_most_frequent_ID_per_label(labels, IDs, N):
+    # most frequent nonzero ID among the voxels of each label 1..N, in one bincount
+    labels = np.asarray(labels, dtype='int64').ravel()
+    IDs = np.asarray(IDs).ravel()
+    keep = (labels > 0) & (labels <= N) & (IDs != 0) # no zero
+    uniqueID, inverse = np.unique(IDs[keep], return_inverse=True)
+    if uniqueID.size == 0:
+        return np.zeros(N, dtype='int64') # empty then zero
+    counts = np.bincount((labels[keep] - 1) * uniqueID.size + inverse.ravel(), minlength=N*uniqueID.size).reshape(N, uniqueID.size)
+    top = counts.argmax(axis=1)
+    topID = np.where(counts[np.arange(N), top] > 0, uniqueID[top], 0)
+
+    return topID.astype('int64')
+
+
 def segID_to_svID(segID, ID_array, location_array_mip0, cv, reverse=False):
     indices = np.where(ID_array == segID)[0]
     pts = location_array_mip0[indices]
@@ -0,0 +1,393 @@
+#!/usr/bin/env python3
+"""
+Benchmark synapse extraction and filtering on synthetic data.
+
+Everything runs on generated data in memory or in a temporary directory, so
+no network access or cloud credentials are needed. Three benchmarks are run:
+  extraction  For each block size, a postsynaptic probability map with
+              Gaussian blobs at known locations and a direction vector field
+              pointing from each blob to a known presynaptic site are
+              generated. synful_extract.find_locations and find_targets are
+              timed on them, and the extracted links are matched against the
+              known ones.
+  worker      (with --worker) The same blocks are written as local
+              precomputed volumes and processed end to end by a
+              synful_extract.SynfulWorker, including reads and writes.
+  filters     A table of links with a known number of low scores, autapses,
+              duplicates and nearby duplicates is run through the nov2022
+              filters (filter_pipeline.py), and the number of links each
+              filter removes is checked.
+Times are wall-clock seconds. With --memory, each step is run a second time
+under tracemalloc to find its peak memory use. This covers numpy arrays but
+not memory that C extensions allocate internally. (Tracing slows allocation
+down a lot, so it is kept out of the timed run.)
+
+Usage:
+    python synthetic_benchmark.py --sizes 128x128x32 256x256x64 512x512x128
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+from scipy import ndimage, spatial
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(here, '..', 'detection'))
+sys.path.append(os.path.join(here, '..', 'nov2022_filters'))
+import synful_extract
+import filter_pipeline
+
+
+voxel_size = (8.6, 8.6, 45)
+scaling_factor = (8, 8, 40)
+
+
+def measure(func, *args, memory=False, **kwargs):
+    """
+    Run func, returning its result, the seconds it took and, if memory is
+    True, the peak memory traced while running it again, in bytes (else
+    None).
+    """
+    t0 = time.perf_counter()
+    result = func(*args, **kwargs)
+    elapsed = time.perf_counter() - t0
+    peak = None
+    if memory:
+        tracemalloc.start()
+        try:
+            func(*args, **kwargs)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+    return result, elapsed, peak
+
+
+def _mb(n_bytes):
+    return None if n_bytes is None else n_bytes / 2**20
+
+
+def _greedy_separated(points, min_separation):
+    """Indices of a subset of points with no two closer than min_separation,
+    taking points in order"""
+    pairs = spatial.cKDTree(points).query_pairs(min_separation, output_type='ndarray')
+    earlier = [[] for _ in range(len(points))]
+    for i, j in pairs:
+        earlier[max(i, j)].append(min(i, j))
+    keep = np.zeros(len(points), dtype=bool)
+    for i in range(len(points)):
+        keep[i] = not any(keep[j] for j in earlier[i])
+    return np.flatnonzero(keep)
+
+
+def synthetic_block(shape, density=20, blob_sigma_nm=40, link_length_nm=(100, 400),
+                    min_separation_nm=300, seed=0):
+    """
+    Generate a synthetic postsynaptic probability map and direction vector
+    field, in the formats synful_extract reads.
+
+    Each synapse is a Gaussian blob whose peak is 1.2-3x saturation, so the
+    probability map has a saturated core like the real predictions. Blob
+    centers are kept at least min_separation_nm apart and 3 sigma from the
+    block edges. Within each blob, the vector field points to the blob's
+    presynaptic site, at a random distance in link_length_nm.
+
+    Arguments
+    ---------
+    shape: (x, y, z) block size in voxels at voxel_size
+    density: synapses per million voxels (before enforcing separation)
+
+    Returns
+    -------
+    dict with
+        pos: uint8 array of shape `shape`, probabilities * 255
+        vec: float32 array of shape `shape` + (3,), in nm at scaling_factor
+             resolution, in z, y, x order like the real vector predictions
+        post, pre: (N, 3) int arrays of the true postsynaptic (blob center)
+             and presynaptic voxel locations
+    """
+    rng = np.random.default_rng(seed)
+    shape = np.array(shape)
+    sigma = blob_sigma_nm / np.array(voxel_size)
+    margin = np.ceil(3 * sigma).astype(int)
+    n = max(1, int(density * np.prod(shape) / 1e6))
+    post = rng.integers(margin, np.maximum(shape - margin, margin + 1), size=(n, 3))
+    post = post[_greedy_separated(post * voxel_size, min_separation_nm)]
+
+    direction = rng.normal(size=post.shape)
+    direction /= np.linalg.norm(direction, axis=1, keepdims=True)
+    length = rng.uniform(*link_length_nm, size=(len(post), 1))
+    pre = post + np.round(direction * length / voxel_size).astype(int)
+
+    peaks = np.zeros(tuple(shape), dtype=np.float32)
+    peaks[tuple(post.T)] = rng.uniform(1.2, 3, size=len(post))
+    delta = np.zeros(tuple(2 * margin + 1), dtype=np.float32)
+    delta[tuple(margin)] = 1
+    kernel_peak = ndimage.gaussian_filter(delta, sigma)[tuple(margin)]
+    probs = ndimage.gaussian_filter(peaks, sigma) / kernel_peak
+    pos = (np.clip(probs, 0, 1) * 255).astype(np.uint8)
+
+    # Point every voxel of each blob at its presynaptic site
+    vec = np.zeros(tuple(shape) + (3,), dtype=np.float32)
+    voxels = np.argwhere(pos > 0)
+    if len(voxels):
+        _, nearest = spatial.cKDTree(post * voxel_size).query(voxels * voxel_size)
+        vec[tuple(voxels.T)] = ((pre[nearest] - voxels) * scaling_factor)[:, ::-1]
+    return {'pos': pos, 'vec': vec, 'post': post, 'pre': pre}
+
+
+def match_links(predicted, true, tolerance_nm=100):
+    """
+    Match predicted links to true ones by postsynaptic location. Each
+    predicted link is matched to the nearest true link within tolerance_nm
+    that isn't claimed by a closer prediction. (With well separated
+    synthetic synapses this is the same as an optimal assignment.)
+
+    Returns a dict with precision, recall, the mean postsynaptic location
+    error of matched links, and the fraction of matched links whose
+    presynaptic location is also within tolerance_nm.
+    """
+    scale = np.array(voxel_size)
+    n_pred, n_true = len(predicted), len(true)
+    matched = np.zeros(0, dtype=int)
+    distances = np.zeros(0)
+    if n_pred and n_true:
+        distance, nearest = spatial.cKDTree(true[:, 0:3] * scale).query(
+            predicted[:, 0:3] * scale, distance_upper_bound=tolerance_nm)
+        candidates = np.flatnonzero(np.isfinite(distance))
+        # Closest first, then keep the first claim on each true link
+        candidates = candidates[np.argsort(distance[candidates], kind='stable')]
+        _, first = np.unique(nearest[candidates], return_index=True)
+        matched = candidates[first]
+        distances = distance[matched]
+        pre_error = np.linalg.norm((predicted[matched, 3:6]
+                                    - true[nearest[matched], 3:6]) * scale, axis=1)
+    n_matched = len(matched)
+    return {
+        'predicted': n_pred,
+        'true': n_true,
+        'precision': n_matched / n_pred if n_pred else 1.0,
+        'recall': n_matched / n_true if n_true else 1.0,
+        'post_error_nm': float(distances.mean()) if n_matched else 0.0,
+        'pre_within_tolerance': float((pre_error <= tolerance_nm).mean()) if n_matched else 1.0,
+    }
+
+
+def bench_extraction(block, score_columns=None, memory=False):
+    parameters = synful_extract.SynapseExtractionParameters(
+        score_columns=score_columns, **synful_extract.default_parameters)
+    probmap = block['pos'].astype(np.float32) / 255
+    (locs, scores), locations_s, locations_peak = measure(
+        synful_extract.find_locations, probmap, parameters, voxel_size=voxel_size,
+        memory=memory)
+    targets, targets_s, targets_peak = measure(
+        synful_extract.find_targets, locs, block['vec'], voxel_size=scaling_factor,
+        memory=memory)
+    result = {
+        'find_locations_s': locations_s,
+        'find_locations_peak_mb': _mb(locations_peak),
+        'find_targets_s': targets_s,
+        'find_targets_peak_mb': _mb(targets_peak),
+    }
+    result.update(match_links(np.concatenate([locs, targets], axis=1),
+                              np.concatenate([block['post'], block['pre']], axis=1)))
+    return result
+
+
+def bench_worker(block, tmp_dir, memory=False):
+    """Write a block as local precomputed volumes and extract it end to end"""
+    from cloudvolume import CloudVolume
+
+    shape = block['pos'].shape
+    paths = {}
+    for name, data in [('pos', block['pos'][..., None]), ('vec', block['vec'])]:
+        paths[name] = 'file://' + os.path.join(tmp_dir, name)
+        info = CloudVolume.create_new_info(
+            data.shape[3], 'image', data.dtype.name, 'raw', voxel_size,
+            [0, 0, 0], shape, chunk_size=[min(s, 128) for s in shape[:2]] + [min(shape[2], 32)])
+        cv = CloudVolume(paths[name], info=info)
+        cv.commit_info()
+        cv[:, :, :] = data
+
+    msg = {'voxel_size': list(voxel_size), 'scaling_factor': list(scaling_factor),
+           'param': synful_extract.default_parameters,
+           'cv_pos': paths['pos'], 'cv_vec': paths['vec'],
+           'cv_out': 'file://' + os.path.join(tmp_dir, 'links'),
+           'data_bbox': [0, 0, 0] + list(shape), 'padding': [32, 32, 4]}
+    chunk_size = [max(1, s // 2) for s in shape]
+    tasks = [task for _, task in synful_extract.generate_tasks(msg, chunk_size)]
+    worker = synful_extract.SynfulWorker(verbose=False)
+    _, elapsed, peak = measure(lambda: list(worker.run(tasks)), memory=memory)
+    timings = worker.timings[:len(tasks)]
+    result = {key: sum(t[key] for t in timings)
+              for key in ['read_s', 'compute_s', 'write_s', 'bytes_read', 'n_links']}
+    result.update({'tasks': len(tasks), 'worker_s': elapsed, 'worker_peak_mb': _mb(peak)})
+    return result
+
+
+def synthetic_links(n, seed=0):
+    """
+    Generate a link table for the nov2022 filters with a known number of
+    links that each filter should remove. Base links (~70%) have distinct
+    supervoxel pairs and presynaptic points on a 500nm lattice, so they never
+    duplicate each other. The rest are split evenly between:
+      low_score       sum <= 12
+      autapse         pre_sv_id == post_sv_id
+      duplicate       same supervoxel pair as an earlier base link, with a
+                      lower score
+      near_duplicate  same neuron pair as an earlier base link, with a
+                      presynaptic point 50nm away
+
+    Returns a dict of column name -> array (filter_pipeline.input_columns)
+    and a dict of the expected number of links each filter removes.
+    """
+    rng = np.random.default_rng(seed)
+    side = int(np.ceil(n ** (1 / 3)))
+    lattice = np.stack(np.unravel_index(rng.choice(side ** 3, n, replace=False),
+                                        (side, side, side)), axis=1)
+    pre_nm = lattice * 500.0 + 1000
+    post_nm = pre_nm + rng.uniform(-200, 200, size=(n, 3))
+    pre_sv = np.arange(1, n + 1, dtype=np.uint64) * 2
+    post_sv = pre_sv + 1
+    pre_root = rng.integers(1, 1000, n).astype(np.uint64)
+    post_root = rng.integers(1000, 2000, n).astype(np.uint64)
+    score = rng.uniform(13, 200, n)
+
+    kind = rng.choice(5, size=n, p=[0.7, 0.075, 0.075, 0.075, 0.075])
+    # Duplicates copy a random earlier base link, so a link with no base
+    # link before it has to be a base link itself
+    base = np.flatnonzero(kind == 0)
+    n_earlier = np.searchsorted(base, np.arange(n))
+    kind[(n_earlier == 0) & (kind != 0)] = 0
+    base = np.flatnonzero(kind == 0)
+    n_earlier = np.searchsorted(base, np.arange(n))
+    source = base[(rng.random(n) * n_earlier).astype(int)]
+
+    low_score = kind == 1
+    score[low_score] = rng.uniform(0, 12, low_score.sum())
+    autapse = kind == 2
+    post_sv[autapse] = pre_sv[autapse]
+    dup = kind == 3
+    pre_sv[dup], post_sv[dup] = pre_sv[source[dup]], post_sv[source[dup]]
+    score[dup] = 12 + (score[source[dup]] - 12) / 2
+    near = kind == 4
+    pre_root[near], post_root[near] = pre_root[source[near]], post_root[source[near]]
+    pre_nm[near] = pre_nm[source[near]] + [50, 0, 0]
+
+    expected = {'low_score': int(low_score.sum()), 'autapses': int(autapse.sum()),
+                'duplicates': int(dup.sum()), 'near_duplicates': int(near.sum())}
+    columns = {}
+    voxels = np.array(filter_pipeline.voxel_dims)
+    for prefix, coords in [('pre', pre_nm), ('post', post_nm)]:
+        for i, axis in enumerate('xyz'):
+            columns[f'{prefix}_{axis}'] = np.round(coords[:, i] / voxels[i]).astype(np.int64)
+    columns.update({'sum': np.round(score, 3), 'pre_sv_id': pre_sv, 'post_sv_id': post_sv,
+                    'pre_segment_id': pre_root, 'post_segment_id': post_root})
+    return columns, expected
+
+
+def bench_filters(n, tmp_dir, n_workers=1, memory=False):
+    """Run filter_pipeline on a synthetic link table of n links"""
+    import pandas as pd
+
+    columns, expected = synthetic_links(n)
+    input_csv = os.path.join(tmp_dir, 'links.csv')
+    pd.DataFrame(columns)[filter_pipeline.input_columns].to_csv(input_csv, index=False)
+    work_dirs = []
+
+    def run_filters():
+        # A fresh work directory, so no stage is skipped as up to date
+        work_dirs.append(tempfile.mkdtemp(dir=tmp_dir))
+        filter_pipeline.run(input_csv, work_dirs[-1], os.path.join(work_dirs[-1], 'out'),
+                            n_workers=n_workers, file_format='csv')
+    _, elapsed, peak = measure(run_filters, memory=memory)
+    work_dir = work_dirs[0]
+    with open(os.path.join(work_dir, 'manifest.json')) as f:
+        stages = json.load(f)
+    removed = {
+        'low_score': stages['threshold']['result']['read'] - stages['threshold']['result']['kept'],
+        'autapses': stages['deduplicate']['result']['autapses'],
+        'duplicates': stages['deduplicate']['result']['duplicates'],
+        'near_duplicates': (stages['deduplicate']['result']['kept']
+                            - stages['distance_filter']['result']['kept']),
+    }
+    return {'links': n, 'filters_s': elapsed, 'filters_peak_mb': _mb(peak),
+            'links_per_s': n / elapsed, 'expected_removed': expected,
+            'removed': removed, 'correct': removed == expected}
+
+
+def parse_size(text):
+    return tuple(int(s) for s in text.split('x'))
+
+
+def _peak(mb):
+    return '' if mb is None else f' (peak {mb:.0f} MB)'
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--sizes', type=parse_size, nargs='+',
+                        default=[(128, 128, 32), (256, 256, 64), (512, 512, 128)],
+                        help='Block sizes to extract, like 512x512x128')
+    parser.add_argument('--density', type=float, default=50,
+                        help='Synapses per million voxels')
+    parser.add_argument('--worker', action='store_true',
+                        help='Also run extraction end to end through local volumes')
+    parser.add_argument('--links', type=int, default=1_000_000,
+                        help='Number of links in the filter benchmark (0 to skip)')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Processes used by the filters')
+    parser.add_argument('--memory', action='store_true',
+                        help='Also measure peak memory, in a second run of each step')
+    parser.add_argument('--json', help='Also save the results to this file')
+    args = parser.parse_args()
+
+    results = {'extraction': [], 'worker': [], 'filters': None}
+    tmp_dir = tempfile.mkdtemp(prefix='synapse_benchmark_')
+    try:
+        for size in args.sizes:
+            block = synthetic_block(size, density=args.density)
+            for columns in [None, ['mean', 'max', 'area', 'sum']]:
+                result = bench_extraction(block, score_columns=columns, memory=args.memory)
+                result.update(size=list(size), score_columns=columns or 'all')
+                results['extraction'].append(result)
+                print('extraction {size} score_columns={score_columns}: '
+                      'find_locations {find_locations_s:.2f}s'.format(**result)
+                      + _peak(result['find_locations_peak_mb'])
+                      + ', find_targets {find_targets_s:.3f}s; {predicted}/{true} links, '
+                      'precision {precision:.3f}, recall {recall:.3f}, '
+                      'pre correct {pre_within_tolerance:.3f}'.format(**result))
+            if args.worker:
+                block_dir = os.path.join(tmp_dir, 'x'.join(map(str, size)))
+                result = bench_worker(block, block_dir, memory=args.memory)
+                result.update(size=list(size))
+                results['worker'].append(result)
+                print('worker {size}: {tasks} tasks in {worker_s:.2f}s'.format(**result)
+                      + _peak(result['worker_peak_mb'])
+                      + ', read {read_s:.2f}s, compute {compute_s:.2f}s, write {write_s:.2f}s, '
+                      '{n_links} links'.format(**result))
+                shutil.rmtree(block_dir)
+        if args.links:
+            with contextlib.redirect_stdout(io.StringIO()):
+                result = bench_filters(args.links, tmp_dir, n_workers=args.workers,
+                                       memory=args.memory)
+            results['filters'] = result
+            print('filters: {links} links in {filters_s:.2f}s ({links_per_s:.0f} links/s)'.format(**result)
+                  + _peak(result['filters_peak_mb'])
+                  + '; removed {removed}, {status}'.format(
+                      status='as expected' if result['correct'] else
+                      'EXPECTED {}'.format(result['expected_removed']), **result))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+"""
+Gather the per-chunk outputs of synful_extract.process_task into a single
+columnar table of synaptic links.
+
+process_task writes one file per task bounding box, named like
+"{x0}-{x1}_{y0}-{y1}_{z0}-{z1}", containing raw float64 records of the form
+post coord (x, y, z), pre coord (x, y, z), score(s). Chunks without any links
+are saved as empty files. This script lists and downloads those files in
+parallel through CloudFiles (so both gs:// and local file:// paths work),
+decodes the records in bulk, and writes them as a directory of Parquet (or
+Arrow IPC) files, one per batch of chunks, with columns
+    pre_x, pre_y, pre_z, post_x, post_y, post_z (int32)
+followed by the score columns (float32). For score_type 'all' these are
+mean, max, area and sum (plus the 64 moments if keep_moments=True); for
+other score types there is a single column named after the score type.
+If extraction was run with a subset of score columns (the score_columns
+parameter), pass the same list as columns.
+Coordinates are left in the units synful_extract saves them in, which is
+voxels at the extraction mip (8.6, 8.6, 45nm for the 2022 run).
+
+Usage:
+    python consolidate_links.py gs://.../synful_extraction/<run>/8.6_8.6_45 file:///data/links_table
+"""
+
+import argparse
+import io
+import re
+
+import numpy as np
+from cloudfiles import CloudFiles
+
+
+chunk_name_pattern = re.compile(r'^\d+-\d+_\d+-\d+_\d+-\d+$')
+coordinate_columns = ['post_x', 'post_y', 'post_z', 'pre_x', 'pre_y', 'pre_z']
+# The 'all' score type saves mean, max, area, then the 4x4x4 weighted central
+# moments, whose first element is the 'sum' score.
+all_score_columns = ['mean', 'max', 'area', 'sum']
+
+
+def score_columns(score_type='all', keep_moments=False, columns=None):
+    """Names of the score columns saved by process_task for a score type"""
+    if columns is not None:
+        return list(columns)
+    if score_type != 'all':
+        return [score_type]
+    if keep_moments:
+        return all_score_columns + [f'moment_{i}_{j}_{k}' for i in range(4)
+                                    for j in range(4) for k in range(4)][1:]
+    return all_score_columns
+
+
+def record_width(score_type='all', columns=None):
+    """Number of float64 values in each record saved by process_task"""
+    if columns is not None:
+        return 6 + len(columns)
+    return 6 + (3 + 64 if score_type == 'all' else 1)
+
+
+def list_chunks(cf):
+    """List the chunk files in a synful_extract output folder"""
+    return sorted(name for name in cf.list(flat=True)
+                  if chunk_name_pattern.match(name))
+
+
+def decode_chunks(contents, score_type='all', keep_moments=False, columns=None):
+    """
+    Decode the raw contents of a list of chunk files into a dict of column
+    name -> numpy array.
+    """
+    width = record_width(score_type, columns)
+    buffer = b''.join(c for c in contents if c)
+    if len(buffer) % (8 * width):
+        raise ValueError(f'Chunk data is not a whole number of {width}-value'
+                         ' records. Are score_type and columns set correctly?')
+    records = np.frombuffer(buffer, dtype='<f8').reshape(-1, width)
+
+    decoded = {}
+    for name in ['pre_x', 'pre_y', 'pre_z', 'post_x', 'post_y', 'post_z']:
+        decoded[name] = records[:, coordinate_columns.index(name)].astype(np.int32)
+    scores = records[:, 6:]
+    if score_type == 'all' and not keep_moments and columns is None:
+        scores = scores[:, :4]
+    for i, name in enumerate(score_columns(score_type, keep_moments, columns)):
+        decoded[name] = scores[:, i].astype(np.float32)
+    return decoded
+
+
+def consolidate(source, destination, score_type='all', keep_moments=False,
+                chunks_per_file=10000, file_format='parquet', progress=True,
+                columns=None):
+    """
+    Consolidate the chunk outputs of synful_extract into a partitioned table.
+
+    Arguments
+    ---------
+    source: str
+        CloudFiles path of the folder synful_extract wrote to, including the
+        voxel size subfolder (e.g. gs://bucket/run/8.6_8.6_45).
+    destination: str
+        CloudFiles path of the folder to write the table to. One file named
+        part-NNNNN.parquet (or .arrow) is written per batch of chunks.
+    score_type: str
+        The score_type used when extracting, which determines the record size.
+    keep_moments: bool
+        For score_type 'all', whether to keep the 63 weighted central moments
+        other than 'sum'.
+    chunks_per_file: int
+        Number of chunk files to download and decode at a time. Each batch
+        is written as one output file.
+    file_format: 'parquet' (default) or 'arrow'
+    columns: list of str
+        The score_columns used when extracting, if not all of them.
+
+    Returns
+    -------
+    int: Total number of links written.
+    """
+    import pyarrow as pa
+
+    assert file_format in ['parquet', 'arrow']
+    cf_in = CloudFiles(source)
+    cf_out = CloudFiles(destination)
+    names = list_chunks(cf_in)
+
+    n_links = 0
+    n_parts = 0
+    for start in range(0, len(names), chunks_per_file):
+        batch = names[start:start + chunks_per_file]
+        files = cf_in.get(batch, progress=False)
+        missing = [f['path'] for f in files if f['error'] is not None]
+        if missing:
+            raise IOError(f'Failed to download {len(missing)} chunks, e.g. {missing[0]}')
+        decoded = decode_chunks([f['content'] for f in files],
+                                score_type=score_type, keep_moments=keep_moments,
+                                columns=columns)
+        table = pa.table(decoded)
+
+        buffer = io.BytesIO()
+        if file_format == 'parquet':
+            import pyarrow.parquet as pq
+            pq.write_table(table, buffer)
+        else:
+            with pa.ipc.new_file(buffer, table.schema) as writer:
+                writer.write_table(table)
+        cf_out.put(f'part-{n_parts:05d}.{file_format}', buffer.getvalue(),
+                   content_type='application/octet-stream', compress=None)
+
+        n_parts += 1
+        n_links += table.num_rows
+        if progress:
+            print(min(start + chunks_per_file, len(names)), '/', len(names),
+                  'chunks,', n_links, 'links')
+    return n_links
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('source', help='Folder that synful_extract wrote chunks to')
+    parser.add_argument('destination', help='Folder to write the table to')
+    parser.add_argument('--score-type', default='all')
+    parser.add_argument('--keep-moments', action='store_true')
+    parser.add_argument('--columns', nargs='+', default=None,
+                        help='Score columns extraction was run with, if not all of them')
+    parser.add_argument('--chunks-per-file', type=int, default=10000)
+    parser.add_argument('--format', default='parquet', choices=['parquet', 'arrow'])
+    args = parser.parse_args()
+    n = consolidate(args.source, args.destination, score_type=args.score_type,
+                    keep_moments=args.keep_moments,
+                    chunks_per_file=args.chunks_per_file,
+                    file_format=args.format, columns=args.columns)
+    print('Wrote', n, 'links')
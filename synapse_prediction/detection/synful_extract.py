@@ -1,10 +1,10 @@
 import numpy as np
-import numpy.ma as ma
 from scipy import ndimage
-from skimage import measure
 import edt
 import os
 import json
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
 from cloudvolume import CloudVolume
 from cloudfiles import CloudFiles
 
@@ -35,7 +35,16 @@ class SynapseExtractionParameters(object):
 
         score_type (``string``, optional):
 
-            How to calculate the score. Possible options: sum, mean, max, count.
+            How to calculate the score. Possible options: sum, mean, max, count,
+            all.
+
+        score_columns (``list``, optional):
+
+            For score_type all, which of all_score_columns to compute and
+            save. Defaults to all of them. Leaving out the moments other
+            than sum avoids computing them. Files saved this way have a
+            shorter record, so pass the same list as score_columns to
+            fanc.synaptic_links.load or as columns to consolidate_links.py.
 
 
     '''
@@ -48,7 +57,8 @@ class SynapseExtractionParameters(object):
             # How to extract location from blob: edt --> euclidean distance transform
             score_thr=None,  # If locs should be filtered with threshold
             score_type=None,  # What kind of score to use.
-            nms_radius=None
+            nms_radius=None,
+            score_columns=None
     ):
         # assert extract_type == 'cc', 'Synapse Detection currently only ' \
         #                              'implemented with option cc'  # TODO: Implement nms
@@ -60,6 +70,7 @@ class SynapseExtractionParameters(object):
         self.score_type = score_type if extract_type == 'cc' else None
         self.score_thr = score_thr
         self.nms_radius = nms_radius if extract_type == 'nms' else None
+        self.score_columns = score_columns
 
 
 def __from_labels_to_edt(labels, voxel_size):
@@ -86,7 +97,7 @@ def __find_boundaries(labels):
     in_shape = labels.shape
     out_shape = tuple(2 * s - 1 for s in in_shape)
 
-    boundaries = np.zeros(out_shape, dtype=np.bool)
+    boundaries = np.zeros(out_shape, dtype=bool)
 
     for d in range(dims):
         shift_p = [slice(None)] * dims
@@ -113,85 +124,188 @@ def __from_probmap_to_labels(probmap, threshold):
         threshold (int/float): threshold
 
     Returns:
-        regions:
+        num_labels: number of connected components.
         res: numpy array in which each disconnected region has a unique ID.
 
     """
-    res = np.zeros_like(probmap, dtype=np.uint8)
-    res[probmap > threshold] = 1
-    res, num_labels = ndimage.label(res)
-    regions = measure.regionprops(res, probmap)
-    return regions, res
+    res, num_labels = ndimage.label(probmap > threshold)
+    return num_labels, res
+
+
+def __labeled_maximum(values, labels, num_labels):
+    """Maximum of values for each label from 1 to num_labels. Much faster than
+    ndimage.maximum when there are many labels."""
+    maxima = np.full(num_labels + 1, -np.inf, dtype=values.dtype)
+    np.maximum.at(maxima, labels, values)
+    return maxima[1:]
 
 
-def __from_labels_to_locs(labels, regions, voxel_size,
+def __weighted_moments_central(coords, weights, labels, num_labels, order=3):
+    """Intensity weighted central moments of every label at once, matching
+    skimage regionprops' weighted_moments_central.
+
+    Args:
+        coords (np.array): (N, 3) voxel coordinates of all labeled voxels.
+        weights (np.array): (N,) intensity of each voxel.
+        labels (np.array): (N,) label of each voxel, from 1 to num_labels.
+
+    Returns:
+        moments: (num_labels, order + 1, order + 1, order + 1) array.
+
+    """
+    total = np.bincount(labels, weights=weights, minlength=num_labels + 1)
+    total[0] = 1  # Background, avoid dividing by 0
+    deltas = []
+    for d in range(3):
+        centroid = np.bincount(labels, weights=weights * coords[:, d],
+                               minlength=num_labels + 1) / total
+        delta = coords[:, d] - centroid[labels]
+        deltas.append([delta ** p for p in range(order + 1)])
+
+    moments = np.zeros((num_labels + 1,) + (order + 1,) * 3)
+    for i in range(order + 1):
+        for j in range(order + 1):
+            w_ij = weights * deltas[0][i] * deltas[1][j]
+            for k in range(order + 1):
+                moments[:, i, j, k] = np.bincount(labels, weights=w_ij * deltas[2][k],
+                                                  minlength=num_labels + 1)
+    return moments[1:]
+
+
+# Names of the score columns for score_type 'all': mean, max, area, then the
+# 4x4x4 intensity weighted central moments, the first of which is the sum
+all_score_columns = ['mean', 'max', 'area', 'sum'] + [
+    f'moment_{i}_{j}_{k}' for i in range(4) for j in range(4) for k in range(4)][1:]
+
+
+def __from_labels_to_locs(labels, num_labels, voxel_size,
                           intensity_vol=None,
                           score_vol=None,
-                          score_type=None):
+                          score_type=None,
+                          score_thr=None,
+                          bounds=None,
+                          score_columns=None):
     """Function that extracts locations from connected components.
 
+    All components are processed together with vectorized per-label
+    reductions rather than one regionprops region at a time. Components
+    are filtered by score_thr and bounds as soon as their location and
+    cheap scores are known, so the weighted moments are only computed for
+    the components that are kept.
+
     Args:
         labels (np.array): The array with connecected components (each marked
         with an unique ID).
 
-        regions (regionsprops.regions): The regionsprops extracted from labels.
+        num_labels (int): Number of connected components, labeled 1 to
+        num_labels.
 
         voxel_size (np.array): voxel size
 
         intensity_vol (np.array): an array with the same shape as labels.
         If given, the maxima of this array represent the locations. If this
-        is set to None, edt is calculated for the connected component itself
-        and used for location extraction.
+        is set to None, edt is calculated from the label boundaries and used
+        for location extraction.
 
         score_vol (np.array): array to use to calculate the score from.
 
         score_type (str): how to combine the score values.
 
+        score_thr (float): only keep components whose score is greater than
+        this. For score_type 'all', the 'sum' score is compared.
+
+        bounds (tuple): (start, end) voxel coordinates. Only keep components
+        located at start <= loc < end.
+
+        score_columns (list): for score_type 'all', the names from
+        all_score_columns to return, in that order. Defaults to all of them.
+
     Returns:
-        locs: list of locations in world units.
+        locs: (N, 3) array of locations in voxels.
+        scores: (N,) array, or (N, len(score_columns)) for score_type
+        'all', if score_vol is given.
 
     """
-
-    locs = []
-    scores = []
-    for reg in regions:
-        label_id = reg['label']
-        z1, y1, x1, z2, y2, x2 = reg['bbox']
-        crop = labels[z1:z2, y1:y2, x1:x2]
-        if intensity_vol is None:
-            lab_edt = __from_labels_to_edt(crop, voxel_size)
-        else:
-            lab_edt = intensity_vol[z1:z2, y1:y2, x1:x2]
-        reg_mask = crop != label_id
-        crop = ma.masked_array(lab_edt, reg_mask)
-        loc_local = np.unravel_index(crop.argmax(), crop.shape)
-        loc_abs = np.array(loc_local) + np.array([z1, y1, x1])
-        # Obtain score based on score_vol.
-        if score_vol is not None:
-            if score_type == 'sum':
-                score = reg.mean_intensity * reg.area
-            elif score_type == 'mean':
-                score = reg.mean_intensity
-            elif score_type == 'max':
-                score = reg.max_intensity
-            elif score_type == 'count':
-                score = reg['area']
-            elif score_type == 'all':
-                score = np.array([reg.mean_intensity, reg.max_intensity, reg.area])
-                score = np.concatenate((score, reg.weighted_moments_central.flatten())).astype(np.float32)
+    if intensity_vol is None:
+        intensity_vol = __from_labels_to_edt(labels, voxel_size)
+
+    # Flat indices of all labeled voxels, in C order
+    voxels = np.flatnonzero(labels)
+    voxel_labels = labels.ravel()[voxels]
+
+    # Location of each component: the first voxel, in C order, at which
+    # intensity_vol reaches its maximum within the component
+    intensity = intensity_vol.ravel()[voxels]
+    maxima = __labeled_maximum(intensity, voxel_labels, num_labels)
+    at_max = intensity == maxima[voxel_labels - 1]
+    _, first = np.unique(voxel_labels[at_max], return_index=True)
+    locs = np.stack(np.unravel_index(voxels[at_max][first], labels.shape), axis=1)
+
+    keep = np.ones(num_labels, dtype=bool)
+    if bounds is not None:
+        keep &= np.all((locs >= bounds[0]) & (locs < bounds[1]), axis=1)
+
+    if score_vol is None:
+        return locs[keep]
+
+    values = score_vol.ravel()[voxels].astype(np.float64)
+    area = np.bincount(voxel_labels, minlength=num_labels + 1)[1:].astype(np.float64)
+    total = np.bincount(voxel_labels, weights=values, minlength=num_labels + 1)[1:]
+
+    def simple_scores(score_type):
+        if score_type == 'sum':
+            return total
+        elif score_type == 'mean':
+            return total / area
+        elif score_type == 'max':
+            return __labeled_maximum(values, voxel_labels, num_labels)
+        elif score_type == 'count' or score_type == 'area':
+            return area
+        raise RuntimeError('score not defined')
+
+    if score_thr is not None:
+        thr_scores = simple_scores('sum' if score_type == 'all' else score_type)
+        if score_type == 'all':
+            # Compare the values as they are saved, so this matches
+            # thresholding the output
+            thr_scores = thr_scores.astype(np.float32)
+        keep &= thr_scores > score_thr
+
+    if not keep.all():
+        # Drop the voxels of discarded components and renumber the rest
+        relabel = np.zeros(num_labels + 1, dtype=voxel_labels.dtype)
+        relabel[1:][keep] = np.arange(1, keep.sum() + 1)
+        kept_voxels = keep[voxel_labels - 1]
+        voxels = voxels[kept_voxels]
+        voxel_labels = relabel[voxel_labels[kept_voxels]]
+        values = values[kept_voxels]
+        locs, area, total = locs[keep], area[keep], total[keep]
+        num_labels = len(locs)
+
+    if score_type == 'all':
+        if score_columns is None:
+            score_columns = all_score_columns
+        columns = {}
+        for name in score_columns:
+            if name.startswith('moment_'):
+                if 'moments' not in columns:
+                    coords = np.stack(np.unravel_index(voxels, labels.shape), axis=1)
+                    columns['moments'] = __weighted_moments_central(
+                        coords, values, voxel_labels, num_labels).reshape(num_labels, 64)
+                columns[name] = columns['moments'][:, all_score_columns.index(name) - 3]
+            elif name in all_score_columns:
+                columns[name] = simple_scores(name)
             else:
-                raise RuntimeError('score not defined')
-            scores.append(score)
-        locs.append(loc_abs)
-    if score_vol is not None:
-        assert len(locs) == len(scores)
-        return locs, scores
+                raise RuntimeError('score not defined: {}'.format(name))
+        scores = np.stack([columns[name] for name in score_columns], axis=1).astype(np.float32)
     else:
-        return locs
+        scores = simple_scores(score_type)
+    assert len(locs) == len(scores)
+    return locs, scores
 
 
 def find_locations(probmap, parameters,
-                   voxel_size=(1, 1, 1)):
+                   voxel_size=(1, 1, 1), bounds=None):
     """Function that extracts locations from an intensity / probability map.
 
     Args:
@@ -202,15 +316,20 @@ def find_locations(probmap, parameters,
 
         voxel_size (np.array): voxel size
 
+        bounds (tuple): (start, end) voxel coordinates. Only locations with
+        start <= loc < end are returned.
+
     Returns:
 
-        locs: list of locations in world units.
+        locs: (N, 3) array of locations in voxels.
+        scores: scores of the locations. Locations whose score is not above
+        parameters.score_thr are dropped.
 
     """
     voxel_size = np.array(voxel_size)
     if parameters.extract_type == 'cc':
-        regions, pred_labels = __from_probmap_to_labels(probmap,
-                                                        parameters.cc_threshold)
+        num_labels, pred_labels = __from_probmap_to_labels(probmap,
+                                                           parameters.cc_threshold)
     else:
         raise RuntimeError(
             'unknown extract_type option set: {}'.format(parameters.loc_type))
@@ -218,75 +337,76 @@ def find_locations(probmap, parameters,
     if parameters.extract_type == 'cc':
         assert parameters.loc_type == 'edt', 'unknown loc_type option set: {}'.format(parameters.loc_type)
         pred_locs, scorelist = __from_labels_to_locs(pred_labels,
-                                                     regions,
+                                                     num_labels,
                                                      voxel_size,
                                                      intensity_vol=edt.edt(pred_labels, anisotropy=voxel_size),
                                                      score_vol=probmap,
-                                                     score_type=parameters.score_type)
-    pred_locs = [loc.astype(np.int64) for loc in pred_locs]
+                                                     score_type=parameters.score_type,
+                                                     score_thr=parameters.score_thr,
+                                                     bounds=bounds,
+                                                     score_columns=parameters.score_columns)
+    pred_locs = pred_locs.astype(np.int64)
     return pred_locs, scorelist
 
 
 def find_targets(source_locs, dirvectors,
-                 voxel_size=[1., 1., 1.], min_dist=0):
+                 voxel_size=[1., 1., 1.], min_dist=0, return_mask=False):
     """Function that finds target position based on a direction vector map.
 
     Args:
-        source_locs (list): list with source locations in world units.
-        dirvectors (np.array): map with [dim, source_locs.shape]
+        source_locs (np.array): (N, 3) array with source locations in voxels.
+        dirvectors (np.array): map with [source_locs.shape, dim]
         voxel_size (np.array): voxel size
         min_dist (float/int): threshold to filter target locations based on
-        the distance of dir vector. This modifies the source_locs input.
+        the distance of dir vector. Targets closer than this to their source
+        are dropped.
+        return_mask (bool): also return a boolean mask over source_locs
+        marking which sources have a target in the output.
     Returns:
-        locs: List of locations in world units.
+        locs: (M, 3) int64 array of target locations in voxels, one for each
+        source location that passed min_dist.
 
     """
-    target_locs = []
-    distances = []
-    for loc in source_locs:
-        loc_voxel = loc.astype(np.uint32)
-        dirvector = dirvectors[loc_voxel[0], loc_voxel[1], loc_voxel[2], :]
-        target_loc = loc + dirvector[::-1] / voxel_size
-        target_locs.append(target_loc)
-        dist = np.linalg.norm(np.array(list(loc)) - np.array(list(target_loc)))
-        distances.append(dist)
-    to_remove = []
-    for ii, dist in enumerate(distances):
-        if dist < min_dist:
-            to_remove.append(ii)
-
-    # Delete items in reversed order such that the indeces stay correct
-    for index in sorted(to_remove, reverse=True):
-        del source_locs[index]
-        del target_locs[index]
-
-    target_locs = [loc.astype(np.int64) for loc in target_locs]
+    source_locs = np.asarray(source_locs).reshape(-1, 3)
+    loc_voxels = source_locs.astype(np.uint32)
+    dirvecs = dirvectors[loc_voxels[:, 0], loc_voxels[:, 1], loc_voxels[:, 2], :]
+    target_locs = source_locs + dirvecs[:, ::-1] / np.asarray(voxel_size)
+    distances = np.linalg.norm(source_locs - target_locs, axis=1)
+    keep = distances >= min_dist
+
+    target_locs = target_locs[keep].astype(np.int64)
+    if return_mask:
+        return target_locs, keep
     return target_locs
 
 
-def process_task(msg):
-    msg = json.loads(msg)
+def task_cutout_bounds(task):
+    """Start and end (exclusive) of the padded cutout read for a task,
+    clipped to data_bbox"""
+    data_bbox, bbox, padding = task["data_bbox"], task["bbox"], task["padding"]
+    start_pos = [max(d, b - p) for d, b, p in zip(data_bbox[0:3], bbox[0:3], padding)]
+    end_pos = [min(d, b + p) for d, b, p in zip(data_bbox[3:6], bbox[3:6], padding)]
+    return start_pos, end_pos
 
-    cv_pos = msg["cv_pos"]
-    cv_vec = msg["cv_vec"]
-    cv_out = msg["cv_out"]
-    voxel_size = msg["voxel_size"]
-    scaling_factor = msg["scaling_factor"]
-    data_bbox = msg["data_bbox"]
-    bbox = msg["bbox"]
-    padding = msg["padding"]
-    param = msg["param"]
 
-    vol_pos = CloudVolume(cv_pos, mip=voxel_size)
-    vol_vec = CloudVolume(cv_vec, mip=voxel_size)
+def read_task_cutouts(task, vol_pos, vol_vec):
+    """Download the padded position and direction vector cutouts for a task"""
+    start_pos, end_pos = task_cutout_bounds(task)
+    cutout = np.s_[start_pos[0]:end_pos[0], start_pos[1]:end_pos[1], start_pos[2]:end_pos[2], :]
+    return start_pos, np.squeeze(vol_pos[cutout]), np.squeeze(vol_vec[cutout])
 
 
-    start_pos = [max(d, b - p) for d, b, p in zip(data_bbox[0:3], bbox[0:3], padding)]
-    end_pos = [min(d, b + p) for d, b, p in zip(data_bbox[3:6], bbox[3:6], padding)]
-    print(start_pos)
-    print(end_pos)
+def extract_links(task, start_pos, pos_data, vec_data):
+    """
+    Find the synaptic links whose postsynaptic location lies inside the
+    task's bbox, given its padded cutouts starting at start_pos.
 
-    pos_data = np.squeeze(vol_pos[start_pos[0]:end_pos[0],start_pos[1]:end_pos[1],start_pos[2]:end_pos[2], :]).astype(np.float32)/255
+    Returns the records process_task saves: one row per link, holding the
+    post coord (x, y, z), pre coord (x, y, z) and score(s).
+    """
+    bbox = task["bbox"]
+    param = task["param"]
+    pos_data = pos_data.astype(np.float32)/255
 
     parameters = SynapseExtractionParameters(
             extract_type=param['extract_type'],
@@ -294,65 +414,243 @@ def process_task(msg):
             loc_type=param['loc_type'],
             score_thr=param['score_thr'],
             score_type=param['score_type'],
-            nms_radius=param['nms_radius']
+            nms_radius=param['nms_radius'],
+            score_columns=param.get('score_columns')
     )
 
-    predicted_syns, scores = find_locations(pos_data, parameters, voxel_size=voxel_size)
-
-    new_scorelist = []
-    filtered_list = []
-    for ii, loc in enumerate(predicted_syns):
-        if (all(b1 <= p < b2 for b1, p, b2 in zip(bbox[0:3], loc+start_pos, bbox[3:6]))):
-            score = scores[ii]
-            if parameters.score_thr is not None:
-                if score > parameters.score_thr:
-                    filtered_list.append(loc)
-                    new_scorelist.append(score)
-            else:
-                filtered_list.append(loc)
-                new_scorelist.append(score)
+    # Only keep locations in the bbox, so each link is found by one task
+    bounds = (np.array(bbox[0:3]) - start_pos, np.array(bbox[3:6]) - start_pos)
+    predicted_syns, scores = find_locations(pos_data, parameters, voxel_size=task["voxel_size"],
+                                            bounds=bounds)
+    if len(predicted_syns) == 0:
+        return None
+
+    target_sites = find_targets(predicted_syns, vec_data, voxel_size=task["scaling_factor"])
+
+    return np.concatenate(((predicted_syns+start_pos).astype(np.int32),
+                           (target_sites+start_pos).astype(np.int32),
+                           np.reshape(scores, (len(scores), -1))), axis=1).astype(np.float64)
 
-    predicted_syns = filtered_list
-    scores = new_scorelist
 
-    vec_data = np.squeeze(vol_vec[start_pos[0]:end_pos[0],start_pos[1]:end_pos[1],start_pos[2]:end_pos[2], :])
-    target_sites = find_targets(predicted_syns, vec_data, voxel_size=scaling_factor)
+def task_output_bboxes(task):
+    """
+    The bboxes a task saves links for. This is just the task bbox, unless
+    the task is a super-block (has a chunk_size), in which case it is the
+    blocks of chunk_size its bbox is split into.
+    """
+    bbox = task["bbox"]
+    chunk_size = task.get("chunk_size")
+    if chunk_size is None:
+        return [bbox]
+    return [[x, y, z,
+             min(bbox[3], x+chunk_size[0]),
+             min(bbox[4], y+chunk_size[1]),
+             min(bbox[5], z+chunk_size[2])]
+            for x in range(bbox[0], bbox[3], chunk_size[0])
+            for y in range(bbox[1], bbox[4], chunk_size[1])
+            for z in range(bbox[2], bbox[5], chunk_size[2])]
 
-    pairs = []
-    for post, pre, score in zip(predicted_syns, target_sites, scores):
-        pairs.append(np.concatenate(((post+start_pos).astype(np.int32), (pre+start_pos).astype(np.int32), score)))
 
+def output_filename(bbox):
+    return f"{bbox[0]}-{bbox[3]}_{bbox[1]}-{bbox[4]}_{bbox[2]}-{bbox[5]}"
 
-    filename = f"{bbox[0]}-{bbox[3]}_{bbox[1]}-{bbox[4]}_{bbox[2]}-{bbox[5]}"
-    folder = "_".join(str(x) for x in voxel_size)
-    path = os.path.join(cv_out, folder)
+
+def save_links(task, links):
+    """
+    Write a task's links to cv_out, one file per bbox in
+    task_output_bboxes, as an empty file if there are none. Links are
+    assigned to the bbox containing their postsynaptic location, with the
+    same b1 <= p < b2 bounds as the filter in extract_links.
+    """
+    folder = "_".join(str(x) for x in task["voxel_size"])
+    path = os.path.join(task["cv_out"], folder)
     cf = CloudFiles(path)
-    if pairs:
-        out = np.stack(pairs)
-        cf.put(filename, out.tobytes())
-    else:
-        cf.put(filename, "")
+    files = []
+    for bbox in task_output_bboxes(task):
+        content = b""
+        if links is not None:
+            post = links[:, 0:3]
+            owned = np.all((post >= bbox[0:3]) & (post < bbox[3:6]), axis=1)
+            if owned.any():
+                content = links[owned].tobytes()
+        files.append((output_filename(bbox), content))
+    cf.puts(files)
 
 
-def submit_tasks():
+def process_task(msg):
+    SynfulWorker(prefetch=False).process(msg)
+
+
+class SynfulWorker(object):
+    '''Long-lived runner for many extraction tasks.
+
+    Keeps one CloudVolume handle per (path, mip) for its whole life instead
+    of opening new ones for each task, and while a task is being processed,
+    downloads the next task's cutouts on a background thread. With
+    prefetching, the cutouts of two tasks are held in memory at once.
+
+    Each processed task is timed, and the timings are kept in
+    ``self.timings`` as dicts with:
+        bbox: the task bbox
+        read_s: seconds spent downloading the cutouts
+        wait_s: seconds the compute thread waited for those downloads
+        compute_s: seconds spent in extract_links
+        write_s: seconds spent saving the links
+        bytes_read: size of the downloaded cutouts
+        n_links: number of links saved
+
+    Example:
+        worker = SynfulWorker()
+        for timing in worker.run(tasks):
+            pass
+        print(worker.summary())
+    '''
+
+    def __init__(self, prefetch=True, verbose=True):
+        self.prefetch = prefetch
+        self.verbose = verbose
+        self.timings = []
+        self._volumes = {}
+
+    def volume(self, path, mip):
+        key = (path, tuple(mip) if isinstance(mip, list) else mip)
+        if key not in self._volumes:
+            self._volumes[key] = CloudVolume(path, mip=mip)
+        return self._volumes[key]
+
+    def _read(self, task):
+        t0 = time.perf_counter()
+        cutouts = read_task_cutouts(task,
+                                    self.volume(task["cv_pos"], task["voxel_size"]),
+                                    self.volume(task["cv_vec"], task["voxel_size"]))
+        return cutouts, time.perf_counter() - t0
+
+    def _process(self, task, read):
+        t0 = time.perf_counter()
+        (start_pos, pos_data, vec_data), read_s = read.result()
+        t1 = time.perf_counter()
+        links = extract_links(task, start_pos, pos_data, vec_data)
+        t2 = time.perf_counter()
+        save_links(task, links)
+        t3 = time.perf_counter()
+        timing = {
+            "bbox": task["bbox"],
+            "read_s": read_s,
+            "wait_s": t1 - t0,
+            "compute_s": t2 - t1,
+            "write_s": t3 - t2,
+            "bytes_read": int(pos_data.nbytes + vec_data.nbytes),
+            "n_links": 0 if links is None else len(links),
+        }
+        self.timings.append(timing)
+        if self.verbose:
+            print("{bbox}: {n_links} links, read {read_s:.2f}s (waited {wait_s:.2f}s), "
+                  "compute {compute_s:.2f}s, write {write_s:.2f}s".format(**timing))
+        return timing
+
+    def process(self, msg):
+        """Process one task (a JSON message or dict) without prefetching"""
+        task = json.loads(msg) if isinstance(msg, str) else msg
+        read = Future()
+        read.set_result(self._read(task))
+        return self._process(task, read)
+
+    def run(self, msgs):
+        """
+        Process tasks in order, yielding each one's timing as it finishes.
+        msgs can be any iterable of JSON messages or dicts, including a
+        generator.
+        """
+        tasks = (json.loads(msg) if isinstance(msg, str) else msg for msg in msgs)
+        if not self.prefetch:
+            for task in tasks:
+                yield self.process(task)
+            return
+        with ThreadPoolExecutor(max_workers=1) as reader:
+            task = next(tasks, None)
+            read = reader.submit(self._read, task) if task is not None else None
+            while task is not None:
+                next_task = next(tasks, None)
+                next_read = reader.submit(self._read, next_task) if next_task is not None else None
+                try:
+                    yield self._process(task, read)
+                except BaseException:
+                    if next_read is not None:
+                        next_read.cancel()
+                    raise
+                task, read = next_task, next_read
+
+    def summary(self):
+        """Totals over the tasks processed so far"""
+        totals = {key: sum(t[key] for t in self.timings)
+                  for key in ["read_s", "wait_s", "compute_s", "write_s", "bytes_read", "n_links"]}
+        totals["tasks"] = len(self.timings)
+        return totals
+
+
+default_parameters = {
+        "extract_type": "cc",
+        "cc_threshold": 0.97,
+        "loc_type": "edt",
+        "score_thr": None,
+        "score_type": "all",
+        "nms_radius": None
+}
+
+
+def generate_tasks(msg, chunk_size, superblock=None, start=0, stop=None):
+    """
+    Lazily generate the extraction task messages covering msg['data_bbox'].
+
+    Tasks are numbered in x, y, z order (z fastest), and only those with
+    index start <= i < stop are generated, so a run can be resumed from an
+    offset or split between machines without building the whole list.
+
+    msg: dict
+        Every key of a task message except 'bbox' (and 'chunk_size', which
+        is added for super-blocks).
+    chunk_size: [x, y, z]
+        Size of the blocks whose links are saved in one file.
+    superblock: [nx, ny, nz] or None
+        If given, each task covers nx*ny*nz neighbouring chunks. Its padded
+        cutout is downloaded and searched once, and its links are split back
+        into the usual per-chunk output files. Far fewer voxels in the
+        overlapping padding are read, at the cost of more memory per task.
+
+    Yields (index, JSON message) pairs.
+    """
+    msg = dict(msg)
+    data_bbox = msg['data_bbox']
+    task_size = chunk_size
+    if superblock is not None:
+        msg['chunk_size'] = chunk_size
+        task_size = [c * n for c, n in zip(chunk_size, superblock)]
+
+    grid = [len(range(data_bbox[i], data_bbox[i+3], task_size[i])) for i in range(3)]
+    n_tasks = grid[0] * grid[1] * grid[2]
+    stop = n_tasks if stop is None else min(stop, n_tasks)
+    for i in range(start, stop):
+        ix, iy, iz = np.unravel_index(i, grid)
+        x, y, z = [int(data_bbox[d] + j * task_size[d]) for d, j in enumerate((ix, iy, iz))]
+        msg['bbox'] = [x, y, z,
+                min(data_bbox[3],x+task_size[0]),
+                min(data_bbox[4],y+task_size[1]),
+                min(data_bbox[5],z+task_size[2])]
+        yield i, json.dumps(msg)
+
+
+def submit_tasks(superblock=None, start=0, stop=None):
+    """
+    Generate the extraction task messages for the whole volume. See
+    generate_tasks for the arguments.
+    """
     from secrets import token_hex
     from slack_message import slack_message
-    from copy import deepcopy
-
-    parameter_dic = {
-            "extract_type": "cc",
-            "cc_threshold": 0.97,
-            "loc_type": "edt",
-            "score_thr": None,
-            "score_type": "all",
-            "nms_radius": None
-    }
-
 
     msg = {
         "voxel_size" : [8.6, 8.6, 45],
         "scaling_factor" : [8, 8, 40],
-        "param": parameter_dic,
+        "param": default_parameters,
         "cv_pos" : "gs://zetta_lee_fly_vnc_001_alignment_temp/v4/fill_nearest_mip1/img/img_seethrough/synful_200520/c8005c1beb91671c6578071cfcd77051",
         "cv_vec" : "gs://zetta_lee_fly_vnc_001_alignment_temp/v4/fill_nearest_mip1/img/img_seethrough/synful_vec_200523/9c49ec144a1f1be6e238ea2da578447e",
     }
@@ -370,21 +668,152 @@ def submit_tasks():
     msg['padding'] = padding
     msg['cv_out'] = output_path
 
-    tasks = []
+    return (task for _, task in generate_tasks(msg, chunk_size, superblock=superblock,
+                                               start=start, stop=stop))
+
+
+def task_is_done(msg):
+    """Whether all of a task's output files exist"""
+    task = json.loads(msg) if isinstance(msg, str) else msg
+    folder = "_".join(str(x) for x in task["voxel_size"])
+    cf = CloudFiles(os.path.join(task["cv_out"], folder))
+    exists = cf.exists([output_filename(bbox) for bbox in task_output_bboxes(task)])
+    return all(exists.values())
+
+
+_local_worker = None
+
 
-    for x in range(data_bbox[0], data_bbox[3], chunk_size[0]):
-        for y in range(data_bbox[1], data_bbox[4], chunk_size[1]):
-            for z in range(data_bbox[2], data_bbox[5], chunk_size[2]):
-                payload = deepcopy(msg)
-                payload['bbox'] = [x, y, z,
-                        min(data_bbox[3],x+chunk_size[0]),
-                        min(data_bbox[4],y+chunk_size[1]),
-                        min(data_bbox[5],z+chunk_size[2])]
-                tasks.append(json.dumps(payload))
+def _init_local_worker():
+    global _local_worker
+    _local_worker = SynfulWorker(prefetch=False, verbose=False)
 
-    return tasks
+
+def _run_local_task(msg):
+    return _local_worker.process(msg)
+
+
+def run_local(tasks, n_workers=os.cpu_count(), retries=2, skip_done=True, report_every=100):
+    """
+    Run extraction tasks across a local process pool.
+
+    Each process keeps a SynfulWorker, so volume handles are opened once
+    per process. Inputs and outputs can be on any CloudVolume/CloudFiles
+    path, and are typically file:// paths on local disk so a whole region
+    can be processed on one machine.
+
+    tasks: iterable of (index, JSON message) pairs, as from generate_tasks.
+        It is consumed lazily.
+    n_workers: number of processes
+    retries: number of times a failed task is retried before giving up
+    skip_done: skip tasks whose output files all exist already, which
+        makes an interrupted run resumable by simply re-running it
+    report_every: print progress every this many tasks
+
+    Returns a summary dict with task and link counts, throughput (tasks
+    per second and bytes read per second), summed per-task timings and the
+    indices of the tasks that failed.
+    """
+    from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+    totals = {key: 0 for key in ["read_s", "compute_s", "write_s", "bytes_read", "n_links"]}
+    done, skipped, failed = 0, 0, []
+    attempts = {}
+    t_start = time.perf_counter()
+
+    def report():
+        elapsed = time.perf_counter() - t_start
+        print(f"{done} tasks done, {skipped} skipped, {len(failed)} failed; "
+              f"{done / elapsed:.2f} tasks/s, {totals['bytes_read'] / elapsed / 2**20:.1f} MiB/s")
+
+    tasks = iter(tasks)
+    pending = {}
+    with ProcessPoolExecutor(n_workers, initializer=_init_local_worker) as executor:
+        while True:
+            while len(pending) < 2 * n_workers:
+                item = next(tasks, None)
+                if item is None:
+                    break
+                index, msg = item
+                if skip_done and task_is_done(msg):
+                    skipped += 1
+                    continue
+                pending[executor.submit(_run_local_task, msg)] = (index, msg)
+            if not pending:
+                break
+            finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                index, msg = pending.pop(future)
+                try:
+                    timing = future.result()
+                except Exception as e:
+                    attempts[index] = attempts.get(index, 0) + 1
+                    if attempts[index] <= retries:
+                        print(f"Task {index} failed ({e!r}), retrying")
+                        pending[executor.submit(_run_local_task, msg)] = (index, msg)
+                    else:
+                        print(f"Task {index} failed ({e!r}), giving up")
+                        failed.append(index)
+                    continue
+                done += 1
+                for key in totals:
+                    totals[key] += timing[key]
+                if report_every and done % report_every == 0:
+                    report()
+
+    elapsed = time.perf_counter() - t_start
+    report()
+    return dict(tasks=done, skipped=skipped, failed=sorted(failed), seconds=elapsed,
+                tasks_per_s=done / elapsed, bytes_per_s=totals["bytes_read"] / elapsed,
+                **totals)
+
+
+def _as_cloudpath(path):
+    return path if "://" in path else "file://" + os.path.abspath(path)
 
 
 if __name__ == "__main__":
-    tasks = submit_tasks()
-    process_task(tasks[0])
+    import argparse
+    parser = argparse.ArgumentParser(description="Extract synaptic links from synful predictions")
+    subparsers = parser.add_subparsers(dest="command")
+    local = subparsers.add_parser("local", help="Run a region on this machine across a process pool")
+    local.add_argument("--pos", required=True, help="Postsynaptic probability volume (local path or cloudpath)")
+    local.add_argument("--vec", required=True, help="Direction vector volume (local path or cloudpath)")
+    local.add_argument("--out", required=True, help="Folder to write links to (local path or cloudpath)")
+    local.add_argument("--bbox", type=int, nargs=6, required=True, metavar=("X0", "Y0", "Z0", "X1", "Y1", "Z1"))
+    local.add_argument("--voxel-size", type=float, nargs=3, default=[8.6, 8.6, 45])
+    local.add_argument("--scaling-factor", type=float, nargs=3, default=[8, 8, 40])
+    local.add_argument("--chunk-size", type=int, nargs=3, default=[512, 512, 128])
+    local.add_argument("--padding", type=int, nargs=3, default=[128, 128, 16])
+    local.add_argument("--cc-threshold", type=float, default=default_parameters["cc_threshold"])
+    local.add_argument("--score-thr", type=float, default=None,
+                       help="Drop links whose score (the sum, for score type all) is not above this")
+    local.add_argument("--score-columns", nargs="+", default=None, choices=all_score_columns,
+                       metavar="COLUMN", help="Score columns to save, e.g. mean max area sum. Default: all")
+    local.add_argument("--superblock", type=int, nargs=3, default=None)
+    local.add_argument("--start", type=int, default=0, help="Index of the first task to run")
+    local.add_argument("--stop", type=int, default=None, help="Index after the last task to run")
+    local.add_argument("--workers", type=int, default=os.cpu_count())
+    local.add_argument("--retries", type=int, default=2)
+    args = parser.parse_args()
+
+    if args.command == "local":
+        # Integral sizes are written as ints, so the output folder is e.g. 8.6_8.6_45
+        voxel_size = [int(v) if v == int(v) else v for v in args.voxel_size]
+        msg = {
+            "voxel_size": voxel_size,
+            "scaling_factor": args.scaling_factor,
+            "param": dict(default_parameters, cc_threshold=args.cc_threshold,
+                          score_thr=args.score_thr, score_columns=args.score_columns),
+            "cv_pos": _as_cloudpath(args.pos),
+            "cv_vec": _as_cloudpath(args.vec),
+            "cv_out": _as_cloudpath(args.out),
+            "data_bbox": args.bbox,
+            "padding": args.padding,
+        }
+        tasks = generate_tasks(msg, args.chunk_size, superblock=args.superblock,
+                               start=args.start, stop=args.stop)
+        print(json.dumps(run_local(tasks, n_workers=args.workers, retries=args.retries), indent=2))
+    else:
+        tasks = submit_tasks()
+        process_task(next(tasks))
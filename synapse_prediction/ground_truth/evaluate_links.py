@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+
+# Score predicted synaptic links against the ground truth link annotations of
+# the synapse cutouts (see synapse_cutout_utils.py).
+#
+# Predicted and ground truth links are both Nx6 arrays of pre_z, pre_y, pre_x,
+# post_z, post_y, post_x coordinates in nanometers, in the coordinate frame of
+# the cutout, as returned by synapse_cutout_utils.load_annotations().
+#
+# Both sets of links are restricted to a region of the cutout ('validation'
+# by default, or e.g. 'train75') with in_region(), then a predicted link and
+# a ground truth link can be matched if their postsynaptic points (or, with
+# match_on='both', their pre and postsynaptic points) are within tolerance_nm
+# of each other. Each link is matched at most once, and the matching is
+# optimal: as many pairs as possible, then the smallest total distance.
+# Matched predictions are true positives, unmatched predictions are false
+# positives and unmatched ground truth links are false negatives.
+#
+# threshold_sweep() scores every threshold of a list at once. Predictions are
+# added to a maximum matching in order of decreasing score, recording for
+# each one whether it increased the number of matches. The number of true
+# positives at any threshold is then the number of predictions above it that
+# did, so hundreds of thresholds cost no more than one.
+#
+# Example:
+#     import evaluate_links
+#     predictions = {'synapse_cutout2': (links, scores), ...}
+#     sweep = evaluate_links.evaluate_cutouts(predictions,
+#                                             thresholds=np.arange(0, 100))
+#     best = sweep['total']['f1'].argmax()
+
+
+import numpy as np
+from scipy import optimize, sparse, spatial
+
+import synapse_cutout_utils
+
+
+def _candidate_pairs(predicted, gt, tolerance_nm, match_on):
+    """
+    Find every (predicted, ground truth) pair of links that could be
+    matched. Returns the predicted indices, ground truth indices and
+    distances of the pairs.
+    """
+    if len(predicted) == 0 or len(gt) == 0:
+        return np.zeros(0, int), np.zeros(0, int), np.zeros(0)
+    post_distances = spatial.cKDTree(predicted[:, 3:6]).sparse_distance_matrix(
+        spatial.cKDTree(gt[:, 3:6]), tolerance_nm, output_type='ndarray')
+    i, j = post_distances['i'].astype(int), post_distances['j'].astype(int)
+    distance = post_distances['v']
+    if match_on == 'both':
+        pre_distance = np.linalg.norm(predicted[i, 0:3] - gt[j, 0:3], axis=1)
+        ok = pre_distance <= tolerance_nm
+        i, j, distance = i[ok], j[ok], distance[ok] + pre_distance[ok]
+    elif match_on != 'post':
+        raise ValueError("match_on must be 'post' or 'both' but was " + str(match_on))
+    return i, j, distance
+
+
+def match_links(predicted, gt, tolerance_nm=100, match_on='post'):
+    """
+    Given Nx6 predicted links and Mx6 ground truth links (in nm), find the
+    optimal one-to-one matching between them: the largest number of pairs
+    within tolerance_nm, with the smallest total distance.
+    Returns: (predicted_index, gt_index) arrays of the matched pairs.
+    """
+    predicted = np.asarray(predicted, dtype=np.float64).reshape(-1, 6)
+    gt = np.asarray(gt, dtype=np.float64).reshape(-1, 6)
+    i, j, distance = _candidate_pairs(predicted, gt, tolerance_nm, match_on)
+    if len(i) == 0:
+        return np.zeros(0, int), np.zeros(0, int)
+
+    # Split the candidate pairs into independent groups of links, each of
+    # which is assigned separately. Most groups are a single pair.
+    n_pred = len(predicted)
+    graph = sparse.coo_matrix((np.ones(len(i)), (i, n_pred + j)),
+                              shape=(n_pred + len(gt),) * 2)
+    _, component = sparse.csgraph.connected_components(graph, directed=False)
+    pair_component = component[i]
+    pairs_per_component = np.bincount(pair_component)
+    single = pairs_per_component[pair_component] == 1
+    matched_pred, matched_gt = [i[single]], [j[single]]
+
+    order = np.argsort(pair_component, kind='stable')
+    groups = np.split(order, np.cumsum(pairs_per_component)[:-1])
+    for group in groups:
+        if len(group) < 2:
+            continue
+        rows, row = np.unique(i[group], return_inverse=True)
+        cols, col = np.unique(j[group], return_inverse=True)
+        # Every candidate pair is worth more than any total distance, so
+        # the number of pairs is maximized first
+        cost = np.zeros((len(rows), len(cols)))
+        cost[row, col] = distance[group] - (distance[group].sum() + 1)
+        r, c = optimize.linear_sum_assignment(cost)
+        real = cost[r, c] < 0
+        matched_pred.append(rows[r[real]])
+        matched_gt.append(cols[c[real]])
+    return np.concatenate(matched_pred), np.concatenate(matched_gt)
+
+
+def _match_gains(scores, i, j):
+    """
+    Add predictions to a maximum bipartite matching in order of decreasing
+    score, using augmenting paths. Returns a boolean array marking the
+    predictions that increased the size of the matching. The number of those
+    among the k highest scoring predictions is the size of the maximum
+    matching of those k predictions.
+    """
+    n_pred = len(scores)
+    gains = np.zeros(n_pred, dtype=bool)
+    if len(i) == 0:
+        return gains
+    order = np.argsort(i, kind='stable')
+    starts = np.searchsorted(i[order], np.arange(n_pred + 1))
+    neighbours = j[order]
+    match_of_gt = {}
+
+    def augment(p, visited):
+        for g in neighbours[starts[p]:starts[p + 1]]:
+            if g in visited:
+                continue
+            visited.add(g)
+            if g not in match_of_gt or augment(match_of_gt[g], visited):
+                match_of_gt[g] = p
+                return True
+        return False
+
+    for p in np.argsort(-np.asarray(scores), kind='stable'):
+        if starts[p] != starts[p + 1]:
+            gains[p] = augment(p, set())
+    return gains
+
+
+def _scores(tp, fp, fn):
+    """Precision, recall and F1 from counts, which may be arrays"""
+    tp, fp, fn = (np.asarray(x, dtype=np.float64) for x in (tp, fp, fn))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        precision = np.where(tp + fp > 0, tp / (tp + fp), 1.0)
+        recall = np.where(tp + fn > 0, tp / (tp + fn), 1.0)
+        f1 = np.where(precision + recall > 0,
+                      2 * precision * recall / (precision + recall), 0.0)
+    return precision, recall, f1
+
+
+def threshold_sweep(predicted, scores, gt, thresholds, tolerance_nm=100,
+                    match_on='post'):
+    """
+    Given Nx6 predicted links with N scores and Mx6 ground truth links (in
+    nm), evaluate keeping only the predictions with score > threshold, for
+    each of a list of thresholds.
+    Returns: dict of arrays aligned with thresholds: 'threshold', 'tp', 'fp',
+    'fn', 'precision', 'recall', 'f1'
+    """
+    predicted = np.asarray(predicted, dtype=np.float64).reshape(-1, 6)
+    gt = np.asarray(gt, dtype=np.float64).reshape(-1, 6)
+    scores = np.asarray(scores, dtype=np.float64)
+    thresholds = np.asarray(thresholds, dtype=np.float64)
+    assert len(scores) == len(predicted), 'Need one score per predicted link'
+
+    i, j, _ = _candidate_pairs(predicted, gt, tolerance_nm, match_on)
+    gains = _match_gains(scores, i, j)
+    sorted_scores = np.sort(scores)
+    sorted_gain_scores = np.sort(scores[gains])
+    n_kept = len(scores) - np.searchsorted(sorted_scores, thresholds, side='right')
+    tp = len(sorted_gain_scores) - np.searchsorted(sorted_gain_scores, thresholds,
+                                                   side='right')
+    fp = n_kept - tp
+    fn = len(gt) - tp
+    precision, recall, f1 = _scores(tp, fp, fn)
+    return {'threshold': thresholds, 'tp': tp, 'fp': fp, 'fn': fn,
+            'precision': precision, 'recall': recall, 'f1': f1}
+
+
+def evaluate(predicted, gt, tolerance_nm=100, match_on='post'):
+    """
+    Given Nx6 predicted links and Mx6 ground truth links (in nm), match them
+    and count true positives, false positives and false negatives.
+    Returns: dict with 'tp', 'fp', 'fn', 'precision', 'recall', 'f1', and
+    the matched 'predicted_index' and 'gt_index' arrays
+    """
+    predicted = np.asarray(predicted, dtype=np.float64).reshape(-1, 6)
+    gt = np.asarray(gt, dtype=np.float64).reshape(-1, 6)
+    pred_index, gt_index = match_links(predicted, gt, tolerance_nm, match_on)
+    tp = len(pred_index)
+    fp, fn = len(predicted) - tp, len(gt) - tp
+    precision, recall, f1 = _scores(tp, fp, fn)
+    return {'tp': tp, 'fp': fp, 'fn': fn, 'precision': float(precision),
+            'recall': float(recall), 'f1': float(f1),
+            'predicted_index': pred_index, 'gt_index': gt_index}
+
+
+def restrict_to_region(links, cutout_name, region='validation',
+                       validation_target='postsynapse'):
+    """
+    Given Nx6 links (in nm), keep the ones in a region of a cutout, testing
+    the postsynaptic point, the presynaptic point or both, as in
+    synapse_cutout_utils.load_annotations().
+    Returns: boolean mask of length N
+    """
+    links = np.asarray(links).reshape(-1, 6)
+    post = synapse_cutout_utils.in_region(links[:, 3:6], cutout_name, region)
+    pre = synapse_cutout_utils.in_region(links[:, 0:3], cutout_name, region)
+    if validation_target == 'postsynapse':
+        return post
+    elif validation_target == 'presynapse':
+        return pre
+    elif validation_target == 'both':
+        return np.logical_and(pre, post)
+    raise ValueError("validation_target must be 'postsynapse', 'presynapse'"
+                     " or 'both' but was " + str(validation_target))
+
+
+def evaluate_cutouts(predictions, region='validation', thresholds=None,
+                     tolerance_nm=100, match_on='post',
+                     validation_target='postsynapse', gt=None):
+    """
+    Evaluate predicted links in each of the annotated cutouts.
+
+    predictions: dict of cutout name -> Nx6 predicted links (in nm), or
+        -> (links, scores) to also sweep thresholds
+    region: the region of each cutout to evaluate in, e.g. 'validation' or
+        'train75'. Ground truth and predicted links outside it are ignored.
+    thresholds: if given, evaluate keeping predictions with score > each
+        threshold (see threshold_sweep) instead of keeping all of them
+    gt: dict of cutout name -> Mx6 ground truth links, to use instead of
+        loading the annotations (still restricted to the region)
+
+    Returns: dict of cutout name -> results (see evaluate() and
+    threshold_sweep()), plus 'total' for the counts summed over cutouts
+    """
+    results = {}
+    for cutout_name, prediction in predictions.items():
+        if isinstance(prediction, tuple):
+            links, scores = prediction
+        else:
+            links, scores = prediction, None
+        links = np.asarray(links).reshape(-1, 6)
+        if gt is not None and cutout_name in gt:
+            cutout_gt = np.asarray(gt[cutout_name]).reshape(-1, 6)
+            cutout_gt = cutout_gt[restrict_to_region(cutout_gt, cutout_name, region,
+                                                     validation_target)]
+        else:
+            cutout_gt = synapse_cutout_utils.load_annotations(
+                cutout_name, validation_region=region,
+                validation_target=validation_target)
+        keep = restrict_to_region(links, cutout_name, region, validation_target)
+        if thresholds is None:
+            results[cutout_name] = evaluate(links[keep], cutout_gt,
+                                            tolerance_nm, match_on)
+        else:
+            assert scores is not None, 'Need (links, scores) to sweep thresholds'
+            results[cutout_name] = threshold_sweep(
+                links[keep], np.asarray(scores)[keep], cutout_gt, thresholds,
+                tolerance_nm, match_on)
+
+    counts = {key: sum(r[key] for r in results.values()) for key in ['tp', 'fp', 'fn']}
+    precision, recall, f1 = _scores(counts['tp'], counts['fp'], counts['fn'])
+    if thresholds is None:
+        precision, recall, f1 = float(precision), float(recall), float(f1)
+    results['total'] = dict(counts, precision=precision, recall=recall, f1=f1)
+    if thresholds is not None:
+        results['total']['threshold'] = np.asarray(thresholds, dtype=np.float64)
+    return results
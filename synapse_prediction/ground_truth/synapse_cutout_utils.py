@@ -117,13 +117,29 @@ def load_all_annotations(**kwargs):
             for cutout in _synapse_cutouts}
 
 
-def load_segmentation(cutout_name):
+segmentation_path = 'gs://zetta_lee_fly_vnc_001_synapse_cutout/{}/seg_medium_cube'
+default_cache_dir = os.environ.get(
+    'FANC_SYNAPSE_CUTOUT_CACHE',
+    os.path.join(os.path.expanduser('~'), '.cache', 'fanc', 'synapse_cutouts'))
+
+
+def load_segmentation(cutout_name, cache_dir=default_cache_dir, refresh=False):
     """
     Returns the segmentation for a synapse cutout.
     Segmentation is returned as a dict with 3 entries:
         'data': numpy array containing segment IDs for each voxel.
         'voxel_size': list of 3 values representing the voxel size.
         'voxel_offset': list of 3 values representing the voxel offset.
+
+    The first time a cutout is requested, its segmentation is downloaded and
+    saved in cache_dir (by default ~/.cache/fanc/synapse_cutouts, or the
+    FANC_SYNAPSE_CUTOUT_CACHE environment variable). After that, 'data' is a
+    read-only array memory-mapped from the cached file, so loading is
+    instant and voxels are only read from disk when used. A cached file that
+    is missing, truncated or doesn't match the shape and dtype recorded for
+    it is downloaded again. Set cache_dir=None to always download, or
+    refresh=True to download again and replace the cached copy if its
+    contents differ.
     """
     if cutout_name in _no_synapse_cutouts:
         raise ValueError('Only synapse-containing cutouts have segmentations'
@@ -132,14 +148,21 @@ def load_segmentation(cutout_name):
         cutout_name = 'synapse_cutout{}'.format(cutout_name)
     assert cutout_name in _synapse_cutouts, cutout_name + ' is not a valid cutout name.'
 
+    if cache_dir is None:
+        return _download_segmentation(cutout_name)
+    if refresh or not _is_cached(cutout_name, cache_dir):
+        _cache_segmentation(_download_segmentation(cutout_name), cutout_name, cache_dir)
+    return _load_cached_segmentation(cutout_name, cache_dir)
+
+
+def _download_segmentation(cutout_name):
     from cloudvolume import CloudVolume
-    path = 'gs://zetta_lee_fly_vnc_001_synapse_cutout/{}/seg_medium_cube'
     print('Downloading segmentation for ' + cutout_name)
-    vol = CloudVolume(path.format(cutout_name), use_https=True)
+    vol = CloudVolume(segmentation_path.format(cutout_name), use_https=True)
     mip0_info = vol.info['scales'][0]
     #print(mip0_info)
     seg = vol[:]
-    seg = seg.squeeze().T  # CloudVolumes are xyzc. Want zyx for this script
+    seg = np.asarray(seg).squeeze().T  # CloudVolumes are xyzc. Want zyx for this script
     return {
         'data': seg,
         'voxel_size': mip0_info['resolution'][::-1],
@@ -147,8 +170,124 @@ def load_segmentation(cutout_name):
     }
 
 
-def load_all_segmentations():
-    return {name: load_segmentation(name)
+# The segmentation cache holds one <cutout_name>.json file per cutout, which
+# names the <sha256>.npy file holding the cutout's data. Arrays are saved
+# uncompressed, in their own memory layout, so they can be memory-mapped.
+# The sha256 is of the data in C order and little-endian, so it doesn't depend
+# on the memory layout, and is checked whenever a file is written.
+def _entry_path(cutout_name, cache_dir):
+    return os.path.join(cache_dir, cutout_name + '.json')
+
+
+def _read_entry(cutout_name, cache_dir):
+    entry_fn = _entry_path(cutout_name, cache_dir)
+    if not os.path.exists(entry_fn):
+        return None
+    with open(entry_fn) as f:
+        return json.load(f)
+
+
+def _open_cached_array(entry, cache_dir):
+    """
+    Memory-map a cached array, checking its shape and dtype against the
+    entry. Raises ValueError if the file is truncated or doesn't match.
+    """
+    data = np.load(os.path.join(cache_dir, entry['file']), mmap_mode='r')
+    if list(data.shape) != entry['shape'] or data.dtype.str != entry['dtype']:
+        raise ValueError(f"Cached file {entry['file']} has shape {data.shape} and"
+                         f" dtype {data.dtype.str}, expected {entry['shape']}"
+                         f" and {entry['dtype']}")
+    return data
+
+
+def _is_cached(cutout_name, cache_dir):
+    entry = _read_entry(cutout_name, cache_dir)
+    if entry is None or entry.get('source') != segmentation_path.format(cutout_name):
+        return False
+    try:
+        _open_cached_array(entry, cache_dir)
+    except (OSError, ValueError):
+        return False
+    return True
+
+
+def _array_sha256(data, rows_per_update=16):
+    import hashlib
+    dtype = data.dtype.newbyteorder('<')
+    h = hashlib.sha256(f'{dtype.str}{data.shape}'.encode())
+    # A few slices at a time, so a Fortran-ordered array is never copied whole
+    for start in range(0, len(data), rows_per_update):
+        chunk = data[start:start + rows_per_update]
+        h.update(memoryview(np.ascontiguousarray(chunk, dtype=dtype)))
+    return h.hexdigest()
+
+
+def _file_sha256(fn):
+    try:
+        return _array_sha256(np.load(fn, mmap_mode='r'))
+    except (OSError, ValueError):
+        return None
+
+
+def _write_atomically(fn, write, sha256=None):
+    """Write a file through a temporary file, checking its sha256 if given"""
+    tmp_fn = f'{fn}.{os.getpid()}.tmp'
+    write(tmp_fn)
+    if sha256 is not None and _file_sha256(tmp_fn) != sha256:
+        os.remove(tmp_fn)
+        raise IOError(f'Failed to write {fn}: its contents do not match the data')
+    os.replace(tmp_fn, fn)
+
+
+def _cache_segmentation(seg, cutout_name, cache_dir):
+    os.makedirs(cache_dir, exist_ok=True)
+    sha256 = _array_sha256(seg['data'])
+    data_fn = os.path.join(cache_dir, sha256 + '.npy')
+    # Another cutout or an earlier download may have saved the same data
+    if _file_sha256(data_fn) != sha256:
+        def save(fn):
+            with open(fn, 'wb') as f:
+                np.save(f, seg['data'])
+        _write_atomically(data_fn, save, sha256)
+    entry = {
+        'source': segmentation_path.format(cutout_name),
+        'file': sha256 + '.npy',
+        'sha256': sha256,
+        'shape': list(seg['data'].shape),
+        'dtype': seg['data'].dtype.str,
+        'voxel_size': list(seg['voxel_size']),
+        'voxel_offset': list(seg['voxel_offset']),
+    }
+    def save_entry(fn):
+        with open(fn, 'w') as f:
+            json.dump(entry, f, indent=2)
+    _write_atomically(_entry_path(cutout_name, cache_dir), save_entry)
+
+
+def _load_cached_segmentation(cutout_name, cache_dir):
+    entry = _read_entry(cutout_name, cache_dir)
+    return {
+        'data': _open_cached_array(entry, cache_dir),
+        'voxel_size': entry['voxel_size'],
+        'voxel_offset': entry['voxel_offset']
+    }
+
+
+def load_all_segmentations(cache_dir=default_cache_dir, n_workers=len(_synapse_cutouts)):
+    """
+    Returns a dict of cutout name -> segmentation (see load_segmentation()).
+    Cutouts that aren't cached yet are downloaded in parallel threads.
+    """
+    if cache_dir is not None:
+        missing = [name for name in _synapse_cutouts
+                   if not _is_cached(name, cache_dir)]
+        if missing:
+            from concurrent.futures import ThreadPoolExecutor
+            def fetch(name):
+                _cache_segmentation(_download_segmentation(name), name, cache_dir)
+            with ThreadPoolExecutor(max(1, min(n_workers, len(missing)))) as executor:
+                list(executor.map(fetch, missing))
+    return {name: load_segmentation(name, cache_dir=cache_dir)
             for name in _synapse_cutouts}
 
 
@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+"""
+Write synapse tables in the form CAVE ingests them, straight from integer
+coordinate columns.
+
+Two tables are written for each set of links, matching what
+4_final_filter_table.py produced:
+  {prefix}      id, created, deleted, superceded_id, valid,
+                pre_pt_position, post_pt_position, score
+  {prefix}_seg  id, pre_pt_supervoxel_id, pre_pt_root_id,
+                post_pt_supervoxel_id, post_pt_root_id
+in one of these formats:
+  'csv'     Headerless CSV with 'POINTZ(x y z)' positions, identical to the
+            output of 4_final_filter_table.py
+  'csv.gz'  The same, gzip compressed
+  'pgcopy'  PostgreSQL binary COPY format, with positions encoded as PostGIS
+            EWKB 3D points, for `COPY ... FROM ... WITH (FORMAT binary)`.
+            deleted and superceded_id are written as NULL.
+Batches of links are formatted with vectorized numpy operations, optionally
+spread across a process pool, and a {prefix}_manifest.json file records the
+row count, size and sha256 checksum of each output file.
+"""
+
+import datetime
+import gzip
+import hashlib
+import json
+from collections import deque
+
+import numpy as np
+
+
+file_formats = ['csv', 'csv.gz', 'pgcopy']
+table_columns = ['id', 'created', 'deleted', 'superceded_id', 'valid',
+                 'pre_pt_position', 'post_pt_position', 'score']
+seg_table_columns = ['id', 'pre_pt_supervoxel_id', 'pre_pt_root_id',
+                     'post_pt_supervoxel_id', 'post_pt_root_id']
+# Columns that each batch of links must have
+link_columns = ['pre_x', 'pre_y', 'pre_z', 'post_x', 'post_y', 'post_z', 'sum',
+                'pre_sv_id', 'pre_segment_id', 'post_sv_id', 'post_segment_id']
+
+pgcopy_header = b'PGCOPY\n\xff\r\n\x00' + np.array([0, 0], '>i4').tobytes()
+pgcopy_trailer = np.array(-1, '>i2').tobytes()
+postgres_epoch = datetime.datetime(2000, 1, 1)
+
+
+def _ewkb_point_fields(name):
+    return [(f'{name}_length', '>i4'), (f'{name}_byte_order', 'u1'),
+            (f'{name}_type', '<u4'), (f'{name}_xyz', '<f8', (3,))]
+
+
+pgcopy_table_dtype = np.dtype(
+    [('n_fields', '>i2'),
+     ('id_length', '>i4'), ('id', '>i8'),
+     ('created_length', '>i4'), ('created', '>i8'),
+     ('deleted_length', '>i4'),
+     ('superceded_id_length', '>i4'),
+     ('valid_length', '>i4'), ('valid', 'u1')]
+    + _ewkb_point_fields('pre_pt_position')
+    + _ewkb_point_fields('post_pt_position')
+    + [('score_length', '>i4'), ('score', '>f8')])
+pgcopy_seg_table_dtype = np.dtype(
+    [('n_fields', '>i2')]
+    + [field for name in seg_table_columns
+       for field in [(f'{name}_length', '>i4'), (name, '>i8')]])
+
+
+def _concatenate_strings(parts):
+    """Elementwise concatenation of a list of string arrays and scalars"""
+    result = parts[0]
+    for part in parts[1:]:
+        result = np.char.add(result, part)
+    return result
+
+
+def _format_csv(columns, ids, created):
+    """Format one batch of links as the text of the two CSV tables"""
+    positions = {}
+    for prefix in ['pre', 'post']:
+        positions[prefix] = _concatenate_strings(
+            ['POINTZ(', columns[f'{prefix}_x'].astype(str),
+             ' ', columns[f'{prefix}_y'].astype(str),
+             ' ', columns[f'{prefix}_z'].astype(str), ')'])
+    ids = ids.astype(str)
+    table = _concatenate_strings(
+        [ids, f',{created},False,,t,', positions['pre'], ',',
+         positions['post'], ',', np.round(columns['sum'], 2).astype(str), '\n'])
+    seg_table = _concatenate_strings(
+        [ids, ',', columns['pre_sv_id'].astype(str),
+         ',', columns['pre_segment_id'].astype(str),
+         ',', columns['post_sv_id'].astype(str),
+         ',', columns['post_segment_id'].astype(str), '\n'])
+    return ''.join(table.tolist()).encode(), ''.join(seg_table.tolist()).encode()
+
+
+def _format_pgcopy(columns, ids, created):
+    """Encode one batch of links as PostgreSQL binary COPY tuples"""
+    n = len(ids)
+    table = np.zeros(n, dtype=pgcopy_table_dtype)
+    table['n_fields'] = len(table_columns)
+    table['id_length'] = 8
+    table['id'] = ids
+    table['created_length'] = 8
+    table['created'] = (created - postgres_epoch) // datetime.timedelta(microseconds=1)
+    table['deleted_length'] = -1
+    table['superceded_id_length'] = -1
+    table['valid_length'] = 1
+    table['valid'] = 1
+    for prefix in ['pre', 'post']:
+        name = f'{prefix}_pt_position'
+        table[f'{name}_length'] = 1 + 4 + 3 * 8
+        table[f'{name}_byte_order'] = 1  # Little endian
+        table[f'{name}_type'] = 0x80000001  # Point with Z flag
+        table[f'{name}_xyz'] = np.stack([columns[f'{prefix}_{axis}']
+                                         for axis in 'xyz'], axis=1)
+    table['score_length'] = 8
+    table['score'] = np.round(columns['sum'], 2)
+
+    seg_table = np.zeros(n, dtype=pgcopy_seg_table_dtype)
+    seg_table['n_fields'] = len(seg_table_columns)
+    sources = {'id': ids,
+               'pre_pt_supervoxel_id': columns['pre_sv_id'],
+               'pre_pt_root_id': columns['pre_segment_id'],
+               'post_pt_supervoxel_id': columns['post_sv_id'],
+               'post_pt_root_id': columns['post_segment_id']}
+    for name, values in sources.items():
+        seg_table[f'{name}_length'] = 8
+        seg_table[name] = np.asarray(values).astype(np.int64)
+    return table.tobytes(), seg_table.tobytes()
+
+
+def encode_batch(columns, first_id, created, file_format='csv.gz'):
+    """
+    Encode one batch of links, given as a dict of numpy arrays with the
+    columns in link_columns, into the bytes to append to each of the two
+    tables. Links are given sequential IDs starting at first_id.
+    """
+    columns = {name: np.asarray(columns[name]) for name in link_columns}
+    ids = np.arange(first_id, first_id + len(columns['sum']), dtype=np.int64)
+    if file_format == 'pgcopy':
+        return _format_pgcopy(columns, ids, created)
+    table, seg_table = _format_csv(columns, ids, created)
+    if file_format == 'csv.gz':
+        # Concatenated gzip members are themselves a valid gzip file
+        return gzip.compress(table, 6), gzip.compress(seg_table, 6)
+    return table, seg_table
+
+
+def export_cave_tables(batches, output_prefix, file_format='csv.gz',
+                       created=None, n_workers=1):
+    """
+    Write the two CAVE ingestion tables for a stream of links, plus a
+    manifest.
+
+    Arguments
+    ---------
+    batches: iterable of dicts of numpy arrays
+        Each batch must have the columns in link_columns. Links are numbered
+        sequentially from 0 in the order they are given.
+    output_prefix: str
+        Tables are written to {output_prefix}.{ext} and
+        {output_prefix}_seg.{ext}, and the manifest to
+        {output_prefix}_manifest.json.
+    file_format: 'csv', 'csv.gz' (default) or 'pgcopy'
+    created: datetime.datetime
+        Value of the 'created' column. Defaults to now, in UTC.
+    n_workers: int
+        Number of processes used to format batches.
+
+    Returns
+    -------
+    dict: The manifest.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    if file_format not in file_formats:
+        raise ValueError(f'file_format must be one of {file_formats}')
+    if created is None:
+        created = datetime.datetime.utcnow()
+    extension = 'copy' if file_format == 'pgcopy' else file_format
+    paths = [f'{output_prefix}.{extension}', f'{output_prefix}_seg.{extension}']
+    files = [open(path, 'wb') for path in paths]
+    hashes = [hashlib.sha256() for _ in paths]
+    sizes = [0, 0]
+
+    def write(chunks):
+        for i, chunk in enumerate(chunks):
+            files[i].write(chunk)
+            hashes[i].update(chunk)
+            sizes[i] += len(chunk)
+
+    executor = ProcessPoolExecutor(n_workers) if n_workers > 1 else None
+    try:
+        if file_format == 'pgcopy':
+            write([pgcopy_header, pgcopy_header])
+        n_rows = 0
+        # Keep a bounded number of batches in flight, writing them in order
+        pending = deque()
+        for columns in batches:
+            n = len(columns['sum'])
+            if executor is None:
+                write(encode_batch(columns, n_rows, created, file_format))
+            else:
+                pending.append(executor.submit(encode_batch, columns, n_rows,
+                                               created, file_format))
+                if len(pending) >= 2 * n_workers:
+                    write(pending.popleft().result())
+            n_rows += n
+        while pending:
+            write(pending.popleft().result())
+        if file_format == 'pgcopy':
+            write([pgcopy_trailer, pgcopy_trailer])
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        for f in files:
+            f.close()
+
+    manifest = {
+        'format': file_format,
+        'created': str(created),
+        'rows': n_rows,
+        'files': {
+            path: {'columns': columns, 'rows': n_rows, 'bytes': size,
+                   'sha256': h.hexdigest()}
+            for path, columns, size, h in zip(
+                paths, [table_columns, seg_table_columns], sizes, hashes)
+        },
+    }
+    with open(f'{output_prefix}_manifest.json', 'w') as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
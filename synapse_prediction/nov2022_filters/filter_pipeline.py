@@ -0,0 +1,488 @@
+#!/usr/bin/env python3
+"""
+Run all of the nov2022 synapse filters as one pipeline:
+  1. Drop links with a zero supervoxel ID or a score of 12 or less
+     (1_apply_score_threshold.py)
+  2. Drop autapses and duplicate links between the same pair of supervoxels,
+     keeping the highest scoring link of each pair
+     (2_find_autapses_and_duplicates.py, 3_remove_autapses_and_duplicates.py)
+  3. Drop links between the same pair of neurons whose presynaptic points are
+     within 150nm of a link that was kept (4_final_filter_table.py)
+and write the two tables that were uploaded to CAVE (see cave_export.py).
+
+Unlike the individual scripts, the input table is read in chunks and the
+thresholded links are spilled to Parquet files in a work directory. Only the
+handful of columns each filter needs are ever loaded into memory at once, as
+numpy arrays, so the full 83M-link table can be filtered with a few GB of
+RAM. Each stage is checkpointed in the work directory (see stage_runner.py),
+so re-running after a crash or a change of parameters only redoes the stages
+that need it.
+
+Usage:
+    python filter_pipeline.py 20221109_fanc_synapses_filtered_zero_sv.csv \\
+        --work-dir filter_work --output-prefix 20221118_fanc_syn
+"""
+
+import argparse
+import os
+
+import numpy as np
+from scipy import spatial
+
+
+voxel_dims = (4.3, 4.3, 45)
+coordinate_columns = ['pre_x', 'pre_y', 'pre_z', 'post_x', 'post_y', 'post_z']
+input_columns = coordinate_columns + ['sum', 'pre_sv_id', 'post_sv_id',
+                                      'pre_segment_id', 'post_segment_id']
+
+
+def parquet_parts(path):
+    """A Parquet file, or the part files in a directory, in order"""
+    if not os.path.isdir(path):
+        return [path]
+    return sorted(os.path.join(path, fn) for fn in os.listdir(path)
+                  if fn.endswith('.parquet'))
+
+
+def read_columns(path, columns):
+    """Load some columns of a Parquet file or directory as a dict of numpy arrays"""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    table = pa.concat_tables([pq.read_table(fn, columns=columns)
+                              for fn in parquet_parts(path)])
+    return {name: table.column(name).to_numpy() for name in columns}
+
+
+def iter_columns(path, columns, batch_size=10_000_000):
+    """Yield tuples of numpy arrays of some columns of a Parquet file or directory, in batches"""
+    import pyarrow.parquet as pq
+    for fn in parquet_parts(path):
+        for batch in pq.ParquetFile(fn).iter_batches(batch_size, columns=columns):
+            yield tuple(batch.column(name).to_numpy() for name in columns)
+
+
+def csv_byte_ranges(path, chunk_bytes=256 << 20):
+    """
+    Split a CSV file into chunks of about chunk_bytes that start and end on
+    line boundaries. Returns the header line and a list of (start, end) byte
+    offsets.
+    """
+    size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        header = f.readline()
+        starts = [f.tell()]
+        while starts[-1] + chunk_bytes < size:
+            f.seek(starts[-1] + chunk_bytes)
+            f.readline()
+            if f.tell() >= size:
+                break
+            starts.append(f.tell())
+    return header, list(zip(starts, starts[1:] + [size]))
+
+
+def threshold_links(input_csv, output_dir, score_threshold=12,
+                    chunk_bytes=256 << 20, stage=None):
+    """
+    Read a synapse table CSV in chunks, keeping only links with nonzero pre
+    and post supervoxel IDs and a 'sum' score above score_threshold, and
+    write each chunk's links to output_dir/part-NNNNN.parquet.
+
+    If a stage_runner.Stage is given, chunks it records as completed are
+    skipped, and each chunk is recorded as it finishes.
+
+    Returns
+    -------
+    (int, int): Number of links read, number of links kept.
+    """
+    import io
+    import pyarrow as pa
+    import pyarrow.csv as pacsv
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+
+    column_types = {name: pa.int32() for name in coordinate_columns}
+    column_types.update({'sum': pa.float64(),
+                         'pre_sv_id': pa.uint64(), 'post_sv_id': pa.uint64(),
+                         'pre_segment_id': pa.uint64(),
+                         'post_segment_id': pa.uint64()})
+    convert_options = pacsv.ConvertOptions(include_columns=input_columns,
+                                           column_types=column_types)
+
+    completed = stage.completed_chunks if stage is not None else {}
+    os.makedirs(output_dir, exist_ok=True)
+    if not completed:
+        for fn in parquet_parts(output_dir):
+            os.remove(fn)
+
+    header, ranges = csv_byte_ranges(input_csv, chunk_bytes)
+    n_read, n_kept = 0, 0
+    with open(input_csv, 'rb') as f:
+        for i, (start, end) in enumerate(ranges):
+            part = os.path.join(output_dir, f'part-{i:05d}.parquet')
+            if i in completed and os.path.exists(part):
+                n_read += completed[i]['read']
+                n_kept += completed[i]['kept']
+                continue
+            f.seek(start)
+            table = pacsv.read_csv(io.BytesIO(header + f.read(end - start)),
+                                   convert_options=convert_options)
+            keep = pc.and_(pc.greater(table.column('sum'), score_threshold),
+                           pc.and_(pc.not_equal(table.column('pre_sv_id'), 0),
+                                   pc.not_equal(table.column('post_sv_id'), 0)))
+            kept = table.filter(keep)
+            # Write then rename, so a crash never leaves a partial part file
+            pq.write_table(kept, part + '.tmp')
+            os.replace(part + '.tmp', part)
+            n_read += table.num_rows
+            n_kept += kept.num_rows
+            if stage is not None:
+                stage.chunk_done(i, read=table.num_rows, kept=kept.num_rows)
+    return n_read, n_kept
+
+
+link_key_dtype = np.dtype([('pre_sv_id', '<u8'), ('post_sv_id', '<u8'),
+                           ('score', '<f8'), ('index', '<i8')])
+
+
+def _partition_of(pre_sv_ids, post_sv_ids, n_partitions):
+    """Hash supervoxel pairs to partitions, so each pair lands in one partition"""
+    with np.errstate(over='ignore'):
+        h = pre_sv_ids * np.uint64(0x9E3779B97F4A7C15) ^ post_sv_ids
+        h ^= h >> np.uint64(29)
+        h *= np.uint64(0xBF58476D1CE4E5B9)
+        h ^= h >> np.uint64(32)
+    return (h % np.uint64(n_partitions)).astype(np.intp)
+
+
+def _mark_autapses_and_duplicates(keys, is_autapse, is_duplicate):
+    """
+    Sort one partition of link keys by supervoxel pair, then by descending
+    score and original position, and mark everything but the first link of
+    each pair as a duplicate.
+    """
+    order = np.lexsort((keys['index'], -keys['score'],
+                        keys['post_sv_id'], keys['pre_sv_id']))
+    keys = keys[order]
+    first_of_pair = np.ones(len(keys), dtype=bool)
+    first_of_pair[1:] = ((keys['pre_sv_id'][1:] != keys['pre_sv_id'][:-1])
+                         | (keys['post_sv_id'][1:] != keys['post_sv_id'][:-1]))
+    autapse = keys['pre_sv_id'] == keys['post_sv_id']
+    is_autapse[keys['index'][autapse]] = True
+    is_duplicate[keys['index'][~first_of_pair & ~autapse]] = True
+
+
+def autapse_and_duplicate_masks(pre_sv_ids, post_sv_ids=None, scores=None,
+                                n_partitions=1, work_dir=None,
+                                chunksize=10_000_000):
+    """
+    Find autapses (links from a supervoxel to itself) and duplicates (all but
+    the highest scoring link between a given pair of supervoxels, with ties
+    going to the earliest link).
+
+    Links are packed into fixed-size (pre_sv_id, post_sv_id, score, index)
+    records and sorted by supervoxel pair. With n_partitions > 1, the records
+    are first hash-partitioned by supervoxel pair into files in work_dir, one
+    chunk of input at a time, and each partition is then sorted separately,
+    so peak memory is about 1/n_partitions of sorting everything at once.
+
+    Arguments
+    ---------
+    pre_sv_ids, post_sv_ids, scores: array-likes of length N
+        Alternatively, pass an iterable of (pre_sv_ids, post_sv_ids, scores)
+        chunks as the first argument, e.g. record batches read from disk.
+    n_partitions: int
+        Number of partitions to spill records into. 1 sorts in memory.
+    work_dir: str
+        Directory for partition files. A temporary directory is used if None.
+    chunksize: int
+        When passing arrays, number of links to partition at a time.
+
+    Returns
+    -------
+    (np.array of bool, np.array of bool): is_autapse, is_duplicate, both
+    aligned with the input.
+    """
+    import tempfile
+
+    if post_sv_ids is not None:
+        chunks = ((pre_sv_ids[i:i + chunksize], post_sv_ids[i:i + chunksize],
+                   scores[i:i + chunksize])
+                  for i in range(0, len(pre_sv_ids), chunksize))
+    else:
+        chunks = pre_sv_ids
+
+    with tempfile.TemporaryDirectory(dir=work_dir) as tmp:
+        partitions = [os.path.join(tmp, f'partition{i}.bin')
+                      for i in range(n_partitions)]
+        in_memory = []
+        n = 0
+        for pre, post, score in chunks:
+            keys = np.empty(len(pre), dtype=link_key_dtype)
+            keys['pre_sv_id'] = pre
+            keys['post_sv_id'] = post
+            keys['score'] = score
+            keys['index'] = np.arange(n, n + len(pre))
+            n += len(pre)
+            if n_partitions == 1:
+                in_memory.append(keys)
+                continue
+            part = _partition_of(keys['pre_sv_id'], keys['post_sv_id'], n_partitions)
+            order = np.argsort(part, kind='stable')
+            bounds = np.searchsorted(part[order], np.arange(n_partitions + 1))
+            for i in range(n_partitions):
+                if bounds[i + 1] > bounds[i]:
+                    with open(partitions[i], 'ab') as f:
+                        f.write(keys[order[bounds[i]:bounds[i + 1]]].tobytes())
+
+        is_autapse = np.zeros(n, dtype=bool)
+        is_duplicate = np.zeros(n, dtype=bool)
+        if n_partitions == 1:
+            if in_memory:
+                _mark_autapses_and_duplicates(np.concatenate(in_memory),
+                                              is_autapse, is_duplicate)
+        else:
+            for path in partitions:
+                if os.path.exists(path):
+                    _mark_autapses_and_duplicates(
+                        np.fromfile(path, dtype=link_key_dtype),
+                        is_autapse, is_duplicate)
+    return is_autapse, is_duplicate
+
+
+def _greedy_suppression(n, pairs):
+    """
+    Given n points and an array of (i, j) neighbor pairs with i < j, find
+    which points the greedy procedure "visit points in order, keep each point
+    that hasn't been removed and remove its later neighbors" keeps.
+
+    Instead of visiting points one at a time, this decides points in rounds:
+    a point is removed once any earlier neighbor is kept, and kept once all
+    of its earlier neighbors are removed. Each round is a few vectorized
+    operations over the pairs that are still undecided.
+
+    Returns
+    -------
+    np.array of bool: True for points that are kept.
+    """
+    undecided, kept, removed = 0, 1, 2
+    state = np.zeros(n, dtype=np.int8)
+    has_earlier = np.zeros(n, dtype=bool)
+    has_earlier[pairs[:, 1]] = True
+    state[~has_earlier] = kept
+    while len(pairs):
+        # Remove points with a kept earlier neighbor
+        state[pairs[state[pairs[:, 0]] == kept, 1]] = removed
+        pairs = pairs[(state[pairs[:, 0]] != removed) & (state[pairs[:, 1]] == undecided)]
+        # Keep points whose earlier neighbors have all been removed
+        blocked = np.zeros(n, dtype=bool)
+        blocked[pairs[:, 1]] = True
+        state[(state == undecided) & ~blocked] = kept
+    state[state == undecided] = kept
+    return state == kept
+
+
+def _distance_filter_batch(pre_coords, group_ids, r_nm):
+    """
+    Run greedy distance suppression for a batch of links sorted by group,
+    considering only pairs of links in the same group.
+
+    Returns
+    -------
+    np.array of bool: True for links that are kept.
+    """
+    # Separate groups along a 4th dimension by more than r_nm, so a single
+    # KD-tree only ever pairs links that belong to the same group
+    group_offsets = (group_ids - group_ids[0]).astype(np.float64) * (2 * r_nm + 1)
+    points = np.column_stack([pre_coords, group_offsets])
+    pairs = spatial.cKDTree(points).query_pairs(r_nm, output_type='ndarray')
+    return _greedy_suppression(len(points), pairs)
+
+
+def distance_filter_mask(pre_coords, pre_root_ids, post_root_ids, r_nm=150,
+                         n_workers=1, batch_size=1_000_000):
+    """
+    Find links that duplicate a nearby link between the same two neurons.
+
+    Links are visited in order. Each link that hasn't already been removed is
+    kept, and removes every later link between the same pre and post neuron
+    whose presynaptic point is within r_nm of its own. The result is the same
+    as distance_filter in 4_final_filter_table.py, but links are first
+    grouped by (pre, post) neuron pair, and groups are processed in
+    vectorized batches that can be spread across a process pool.
+
+    Arguments
+    ---------
+    pre_coords: Nx3 np.array
+        Presynaptic points in nm
+    pre_root_ids, post_root_ids: np.array of N ints
+    r_nm: float
+        Links within this distance (inclusive) of a kept link are removed.
+    n_workers: int
+        Number of processes to use.
+    batch_size: int
+        Approximate number of links per batch of groups.
+
+    Returns
+    -------
+    np.array of bool: True for links that are kept, aligned with the input.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    pre_coords = np.asarray(pre_coords, dtype=np.float64)
+    pre_root_ids = np.asarray(pre_root_ids)
+    post_root_ids = np.asarray(post_root_ids)
+    keep = np.ones(len(pre_coords), dtype=bool)
+
+    # Stable sort by connection, so links within each group stay in order
+    order = np.lexsort((post_root_ids, pre_root_ids))
+    same = ((pre_root_ids[order[1:]] == pre_root_ids[order[:-1]])
+            & (post_root_ids[order[1:]] == post_root_ids[order[:-1]]))
+    group_ids = np.concatenate([[0], np.cumsum(~same)])
+    group_sizes = np.bincount(group_ids)
+    # Links that are alone in their group are always kept
+    in_group = group_sizes[group_ids] > 1
+    order, group_ids = order[in_group], group_ids[in_group]
+    if len(order) == 0:
+        return keep
+
+    # Split into batches at group boundaries
+    group_starts = np.flatnonzero(np.diff(group_ids, prepend=-1))
+    split_groups = np.unique(np.searchsorted(
+        group_starts, np.arange(batch_size, len(order), batch_size)))
+    # A batch boundary inside the last group has no later group to split at
+    split_groups = split_groups[split_groups < len(group_starts)]
+    splits = group_starts[split_groups]
+    splits = splits[splits > 0]
+    batches = [(pre_coords[idx], gid, r_nm) for idx, gid in
+               zip(np.split(order, splits), np.split(group_ids, splits))]
+
+    if n_workers > 1:
+        with ProcessPoolExecutor(n_workers) as executor:
+            results = list(executor.map(_distance_filter_batch, *zip(*batches)))
+    else:
+        results = [_distance_filter_batch(*batch) for batch in batches]
+    keep[order] = np.concatenate(results)
+    return keep
+
+
+def write_cave_tables(thresholded, keep, output_prefix,
+                      file_format='csv.gz', n_workers=1, batch_size=1_000_000):
+    """
+    Write the kept links as the two tables uploaded to CAVE, plus a manifest.
+    See cave_export.py for the formats.
+
+    Returns
+    -------
+    dict: The manifest.
+    """
+    import pyarrow.parquet as pq
+    from cave_export import export_cave_tables, link_columns
+
+    def batches():
+        offset = 0
+        for fn in parquet_parts(thresholded):
+            for batch in pq.ParquetFile(fn).iter_batches(batch_size,
+                                                         columns=link_columns):
+                batch_keep = keep[offset:offset + batch.num_rows]
+                offset += batch.num_rows
+                yield {name: batch.column(name).to_numpy()[batch_keep]
+                       for name in link_columns}
+
+    return export_cave_tables(batches(), output_prefix, file_format=file_format,
+                              n_workers=n_workers)
+
+
+def run(input_csv, work_dir, output_prefix, score_threshold=12, r_nm=150,
+        n_partitions=16, n_workers=1, file_format='csv.gz'):
+    """
+    Run all filters, checkpointing each stage in work_dir/manifest.json.
+    Stages whose inputs and parameters haven't changed since they last
+    completed are skipped, and the thresholding stage resumes from its last
+    completed chunk.
+    """
+    from stage_runner import StageRunner
+
+    runner = StageRunner(work_dir)
+    thresholded = os.path.join(work_dir, 'thresholded')
+    dedup_keep = os.path.join(work_dir, 'keep_after_deduplication.npy')
+    final_keep = os.path.join(work_dir, 'keep.npy')
+
+    def threshold(stage):
+        n_read, n = threshold_links(input_csv, thresholded, score_threshold,
+                                    stage=stage)
+        return {'read': n_read, 'kept': n}
+    result = runner.run('threshold', threshold, inputs=[input_csv],
+                        outputs=[thresholded],
+                        params={'score_threshold': score_threshold})
+    print(f"{result['read']} links read, {result['kept']} have nonzero"
+          f" supervoxels and score over {score_threshold}")
+
+    def deduplicate(stage):
+        is_autapse, is_duplicate = autapse_and_duplicate_masks(
+            iter_columns(thresholded, ['pre_sv_id', 'post_sv_id', 'sum']),
+            n_partitions=n_partitions, work_dir=work_dir)
+        keep = ~(is_autapse | is_duplicate)
+        np.save(dedup_keep, keep)
+        return {'autapses': int(is_autapse.sum()),
+                'duplicates': int(is_duplicate.sum()), 'kept': int(keep.sum())}
+    result = runner.run('deduplicate', deduplicate, inputs=[thresholded],
+                        outputs=[dedup_keep])
+    print(f"{result['autapses']} autapses, {result['duplicates']} duplicates")
+    print(f"{result['kept']} links left after removing autapses and duplicates")
+
+    def distance_filter(stage):
+        keep = np.load(dedup_keep)
+        columns = read_columns(thresholded, ['pre_x', 'pre_y', 'pre_z',
+                                             'pre_segment_id', 'post_segment_id'])
+        idx = np.flatnonzero(keep)
+        pre_coords = np.stack([columns[c][idx] for c in ['pre_x', 'pre_y', 'pre_z']],
+                              axis=1).astype(np.float32) * voxel_dims
+        keep[idx] = distance_filter_mask(pre_coords,
+                                         columns['pre_segment_id'][idx],
+                                         columns['post_segment_id'][idx],
+                                         r_nm=r_nm, n_workers=n_workers)
+        np.save(final_keep, keep)
+        return {'kept': int(keep.sum())}
+    result = runner.run('distance_filter', distance_filter,
+                        inputs=[thresholded, dedup_keep], outputs=[final_keep],
+                        params={'r_nm': r_nm, 'voxel_dims': voxel_dims})
+    print(f"{result['kept']} links left after the {r_nm}nm distance filter")
+
+    extension = 'copy' if file_format == 'pgcopy' else file_format
+    outputs = [f'{output_prefix}.{extension}', f'{output_prefix}_seg.{extension}',
+               f'{output_prefix}_manifest.json']
+
+    def export(stage):
+        manifest = write_cave_tables(thresholded, np.load(final_keep),
+                                     output_prefix, file_format=file_format,
+                                     n_workers=n_workers)
+        return {'rows': manifest['rows']}
+    result = runner.run('export', export, inputs=[thresholded, final_keep],
+                        outputs=outputs, params={'file_format': file_format,
+                                                 'output_prefix': output_prefix})
+    print(f"Wrote {result['rows']} links to", ' and '.join(outputs[:2]))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('input_csv')
+    parser.add_argument('--work-dir', default='filter_work',
+                        help='Directory for intermediate files')
+    parser.add_argument('--output-prefix', default='fanc_syn')
+    parser.add_argument('--score-threshold', type=float, default=12)
+    parser.add_argument('--radius', type=float, default=150,
+                        help='Distance filter radius in nm')
+    parser.add_argument('--partitions', type=int, default=16,
+                        help='Number of partitions to spill links into when'
+                        ' finding duplicates. More partitions use less memory.')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help='Number of processes for the distance filter'
+                        ' and for formatting the output')
+    parser.add_argument('--format', default='csv.gz',
+                        choices=['csv', 'csv.gz', 'pgcopy'],
+                        help='Format of the output tables, see cave_export.py')
+    args = parser.parse_args()
+    run(args.input_csv, args.work_dir, args.output_prefix,
+        score_threshold=args.score_threshold, r_nm=args.radius,
+        n_partitions=args.partitions, n_workers=args.workers,
+        file_format=args.format)
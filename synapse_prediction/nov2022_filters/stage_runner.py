@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+"""
+Checkpointing for multi-stage synapse filtering runs.
+
+A StageRunner keeps a manifest.json in a work directory that records, for
+each stage, the inputs (size, modification time and sha256 of each file),
+the parameters, the outputs and whatever summary the stage returns (e.g.
+row counts). Re-running a pipeline skips every stage whose inputs,
+parameters and outputs are unchanged since it last completed. Stages that
+process their input in chunks can also record each finished chunk, so a
+crashed stage resumes from the first unfinished chunk instead of starting
+over.
+
+Example:
+    runner = StageRunner('filter_work')
+
+    def threshold(stage):
+        for i, chunk in enumerate(chunks):
+            if i in stage.completed_chunks:
+                continue
+            ...
+            stage.chunk_done(i, rows=n)
+        return {'rows': total}
+
+    result = runner.run('threshold', threshold, inputs=['links.csv'],
+                        outputs=['filter_work/thresholded'],
+                        params={'score_threshold': 12})
+"""
+
+import datetime
+import hashlib
+import json
+import os
+
+
+def file_sha256(path, block_size=1 << 23):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _files_under(path):
+    """A file, or every file in a directory tree, as sorted paths"""
+    if not os.path.isdir(path):
+        return [path]
+    return sorted(os.path.join(root, name)
+                  for root, _, names in os.walk(path) for name in names)
+
+
+class Stage:
+    """
+    Progress of one running stage, passed to the stage function so it can
+    check and record which chunks are done.
+    """
+    def __init__(self, runner, name):
+        self.runner = runner
+        self.name = name
+
+    @property
+    def record(self):
+        return self.runner.manifest[self.name]
+
+    @property
+    def completed_chunks(self):
+        """Dict of chunk index -> the info recorded when it finished"""
+        return {int(i): info for i, info in self.record['chunks'].items()}
+
+    def chunk_done(self, index, **info):
+        """Record that a chunk finished, along with any JSON-able info about it"""
+        self.record['chunks'][str(index)] = info
+        self.runner.save()
+
+
+class StageRunner:
+    def __init__(self, work_dir, manifest_name='manifest.json'):
+        self.work_dir = work_dir
+        os.makedirs(work_dir, exist_ok=True)
+        self.manifest_path = os.path.join(work_dir, manifest_name)
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path) as f:
+                self.manifest = json.load(f)
+        else:
+            self.manifest = {}
+
+    def save(self):
+        tmp = self.manifest_path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.manifest, f, indent=2)
+        os.replace(tmp, self.manifest_path)
+
+    def _known_fingerprints(self):
+        """Fingerprints of every file recorded in the manifest, by path"""
+        known = {}
+        for record in self.manifest.values():
+            for key in ['inputs', 'outputs']:
+                known.update(record.get(key) or {})
+        return known
+
+    def fingerprint(self, paths):
+        """
+        Fingerprint files (directories are expanded to the files in them).
+        A file's sha256 is reused from the manifest if its size and
+        modification time haven't changed, so unchanged files aren't re-read.
+
+        Returns
+        -------
+        dict: path -> {'bytes', 'mtime_ns', 'sha256'}, or None if any path
+        doesn't exist.
+        """
+        known = self._known_fingerprints()
+        fingerprints = {}
+        for path in paths:
+            if not os.path.exists(path):
+                return None
+            for fn in _files_under(path):
+                stat = os.stat(fn)
+                old = known.get(fn)
+                if (old is not None and old['bytes'] == stat.st_size
+                        and old['mtime_ns'] == stat.st_mtime_ns):
+                    sha256 = old['sha256']
+                else:
+                    sha256 = file_sha256(fn)
+                fingerprints[fn] = {'bytes': stat.st_size,
+                                    'mtime_ns': stat.st_mtime_ns,
+                                    'sha256': sha256}
+        return fingerprints
+
+    @staticmethod
+    def _same_files(a, b):
+        if a is None or b is None or a.keys() != b.keys():
+            return False
+        return all(a[fn]['sha256'] == b[fn]['sha256'] for fn in a)
+
+    def is_up_to_date(self, name, inputs, outputs, params):
+        """Whether a stage completed with these inputs and params, and its outputs are intact"""
+        record = self.manifest.get(name)
+        if record is None or record['status'] != 'complete':
+            return False
+        return (record['params'] == params
+                and self._same_files(record['inputs'], self.fingerprint(inputs))
+                and self._same_files(record['outputs'], self.fingerprint(outputs)))
+
+    def run(self, name, func, inputs, outputs, params=None):
+        """
+        Run func(stage) unless the stage is up to date, and return the
+        summary it returned (or the one recorded when it last ran).
+
+        Arguments
+        ---------
+        name: str
+            Stage name, unique within the manifest.
+        func: callable
+            Called with a Stage object. Must return a JSON-able summary.
+        inputs, outputs: lists of file or directory paths
+        params: dict
+            JSON-able parameters of the stage. Changing them re-runs it.
+        """
+        params = json.loads(json.dumps(params or {}))
+        if self.is_up_to_date(name, inputs, outputs, params):
+            print(f'Stage {name}: up to date, skipping')
+            return self.manifest[name]['result']
+
+        input_fingerprints = self.fingerprint(inputs)
+        if input_fingerprints is None:
+            raise FileNotFoundError(f'Stage {name}: missing inputs among {inputs}')
+        record = self.manifest.get(name)
+        resuming = (record is not None and record['status'] == 'running'
+                    and record['params'] == params
+                    and self._same_files(record['inputs'], input_fingerprints))
+        if resuming:
+            print(f'Stage {name}: resuming after {len(record["chunks"])} completed chunks')
+        else:
+            self.manifest[name] = {'chunks': {}}
+        self.manifest[name].update({
+            'status': 'running',
+            'started': str(datetime.datetime.now()),
+            'inputs': input_fingerprints,
+            'params': params,
+            'outputs': None,
+            'result': None,
+        })
+        self.save()
+
+        result = func(Stage(self, name))
+
+        self.manifest[name].update({
+            'status': 'complete',
+            'finished': str(datetime.datetime.now()),
+            'outputs': self.fingerprint(outputs),
+            'result': result,
+        })
+        self.save()
+        return result
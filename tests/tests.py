@@ -87,6 +87,202 @@ def test_annotations():
     assert not fanc.annotations.is_valid_annotation('n mjr mrg rrrs', table_name=table, raise_errors=False)
 
 
+def test_connectome_graph():
+    pre = np.array([1, 1, 1, 2, 2, 3, 1, 4])
+    post = np.array([2, 2, 3, 3, 4, 4, 2, 1])
+    graph = fanc.connectivity.ConnectomeGraph.from_edges(pre, post)
+    assert len(graph) == 4
+    assert graph.num_edges == 6
+
+    partners = graph.partners(1)
+    assert partners.index.tolist() == [2, 3]
+    assert partners.tolist() == [3, 1]
+    assert graph.partners(1, threshold=2).index.tolist() == [2]
+    assert graph.partners(4, direction='inputs').index.tolist() == [2, 3]
+
+    assert graph.downstream(1, hops=1).index.tolist() == [2, 3]
+    assert graph.downstream(1, hops=2).to_dict() == {2: 1, 3: 1, 4: 2}
+    assert graph.upstream(3, hops=1, include_seeds=True).to_dict() == {1: 1, 2: 1, 3: 0}
+
+    assert graph.shortest_path(1, 4) == [1, 2, 4]
+    assert graph.shortest_path(1, 4, cost='hops') in ([1, 2, 4], [1, 3, 4])
+
+    sub = graph.subgraph([1, 2, 3])
+    assert len(sub) == 3
+    assert sub.edges().weight.sum() == 5
+    assert graph.threshold(2).num_edges == 1
+
+
+def test_threshold_synapses():
+    # Partner 1 makes 3 synapses onto neuron 10 and 1 onto neuron 11. Pooling
+    # counts across both query neurons would wrongly keep the 1->11 synapse.
+    synapses = pd.DataFrame({'pre_root':  [1, 1, 1, 1, 2, 2],
+                             'post_root': [10, 10, 10, 11, 11, 11]})
+    kept, edges = fanc.connectivity.get_partner_synapses_csv(
+        [10, 11], synapses, direction='inputs', threshold=2, return_edges=True)
+    assert len(kept) == 5
+    assert not ((kept.pre_root == 1) & (kept.post_root == 11)).any()
+    assert edges.values.tolist() == [[1, 10, 3], [2, 11, 2]]
+
+
+def test_get_synapses_duplicates():
+    from types import SimpleNamespace
+    # Partner 21 makes 3 links onto neuron 10, but 2 of them join the same
+    # supervoxel pair, so it shouldn't pass a threshold of 3
+    table = pd.DataFrame({'pre_pt_root_id':  [20, 20, 20, 21, 21, 21],
+                          'post_pt_root_id': [10, 10, 10, 10, 10, 10],
+                          'pre_pt_supervoxel_id':  [1, 2, 3, 4, 4, 5],
+                          'post_pt_supervoxel_id': [6, 7, 8, 9, 9, 9]})
+    def query_table(table_name, filter_equal_dict):
+        (column, value), = filter_equal_dict.items()
+        return table.loc[table[column] == value]
+    client = SimpleNamespace(
+        info=SimpleNamespace(get_datastack_info=lambda: {'synapse_table': 'synapses'}),
+        materialize=SimpleNamespace(query_table=query_table))
+    kept, edges = fanc.connectivity.get_synapses(10, direction='inputs',
+                                                 threshold=3, return_edges=True,
+                                                 client=client)
+    assert kept.pre_pt_root_id.tolist() == [20, 20, 20]
+    assert edges.values.tolist() == [[20, 10, 3]]
+
+
+def test_load_connectivity_matrix_replaced(tmp_path):
+    import shutil
+    pd.DataFrame({'pre_root': [1, 1, 2], 'post_root': [2, 2, 1]}).to_csv(
+        tmp_path / 'a.csv', index=False)
+    pd.DataFrame({'pre_root': [1, 2, 2, 2], 'post_root': [2, 1, 1, 1]}).to_csv(
+        tmp_path / 'b.csv', index=False)
+    for name in ['a', 'b']:
+        fanc.connectivity.export_connectivity_matrix(
+            str(tmp_path / (name + '.npz')), str(tmp_path / (name + '.csv')),
+            segids=[1, 2])
+    path = str(tmp_path / 'a.npz')
+    matrix, segids = fanc.connectivity.load_connectivity_matrix(path)
+    assert matrix.toarray().tolist() == [[0, 2], [1, 0]]
+    # Replacing the export by a copy, not a re-export, must not reuse the
+    # arrays unpacked from the old one
+    shutil.copy(str(tmp_path / 'b.npz'), path)
+    matrix, segids = fanc.connectivity.load_connectivity_matrix(path)
+    assert matrix.toarray().tolist() == [[0, 1], [3, 0]]
+    assert isinstance(segids, np.memmap)
+
+
+def test_write_ng_annotations():
+    import io
+    import json
+    links = np.array([[10, 20, 30, 11, 21, 31],
+                      [40, 50, 60, 41, 51, 61],
+                      [70, 80, 90, 71, 81, 91]])
+    stream = io.StringIO()
+    n = fanc.synaptic_links.write_ng_annotations(links, stream,
+                                                 voxel_mip_center=0,
+                                                 chunksize=2)
+    annotations = json.loads(stream.getvalue())
+    assert n == len(annotations) == 3
+    assert annotations[1]['pointA'] == [40.5, 50.5, 60]
+    assert annotations[2]['pointB'] == [71.5, 81.5, 91]
+    assert all(a['type'] == 'line' for a in annotations)
+    assert len({a['id'] for a in annotations}) == 3
+
+    stream = io.StringIO()
+    n = fanc.synaptic_links.write_ng_annotations([links[:1], links[1:]], stream,
+                                                 voxel_mip_center=0)
+    assert n == len(json.loads(stream.getvalue())) == 3
+
+
+def test_load_score_columns(tmp_path):
+    # Records written with score_columns=['sum', 'max']: post xyz, pre xyz, sum, max
+    records = np.array([[1, 2, 3, 4, 5, 6, 20, 0.5],
+                        [7, 8, 9, 10, 11, 12, 5, 0.9]])
+    records.tofile(str(tmp_path / '0-1_0-1_0-1'))
+    links, scores = fanc.synaptic_links.load(str(tmp_path), units='nm',
+                                             voxel_size=(1, 1, 1),
+                                             score_columns=['sum', 'max'],
+                                             return_scores=True)
+    assert links.tolist() == [[4, 5, 6, 1, 2, 3]]
+    assert scores['max'].tolist() == [0.5]
+    try:
+        fanc.synaptic_links.load(str(tmp_path))
+        assert False, 'Expected the default record layout to be rejected'
+    except ValueError:
+        pass
+
+
+def test_consolidate_links(tmp_path):
+    import os
+    import sys
+    import pyarrow.parquet as pq
+    sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..',
+                                    'synapse_prediction', 'detection'))
+    import consolidate_links
+    chunks = tmp_path / 'chunks'
+    chunks.mkdir()
+    for i in range(3):
+        records = np.array([[i, 0, 0, 0, 0, 0, 10 * i, 1]], dtype='<f8')
+        records.tofile(str(chunks / f'{i}-{i + 1}_0-1_0-1'))
+    (chunks / '3-4_0-1_0-1').write_bytes(b'')
+    n = consolidate_links.consolidate('file://' + str(chunks),
+                                      'file://' + str(tmp_path / 'table'),
+                                      chunks_per_file=1, progress=False,
+                                      columns=['sum', 'max'])
+    assert n == 3
+    parts = sorted(os.listdir(str(tmp_path / 'table')))
+    assert len(parts) == 4
+    table = pq.read_table([str(tmp_path / 'table' / p) for p in parts])
+    assert table.column('post_x').to_pylist() == [0, 1, 2]
+    assert table.column('sum').to_pylist() == [0, 10, 20]
+
+
+def test_distance_filter_batches():
+    import os
+    import sys
+    sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..',
+                                    'synapse_prediction', 'nov2022_filters'))
+    import filter_pipeline
+    # 10 links between neurons 1 and 2, 100nm apart along x, plus one link
+    # between neurons 1 and 3. Batches of 3 links end inside the big group.
+    pre_coords = np.zeros((11, 3))
+    pre_coords[:10, 0] = np.arange(10) * 100
+    pre_ids = np.array([1] * 11)
+    post_ids = np.array([2] * 10 + [3])
+    for batch_size in [3, 1_000_000]:
+        keep = filter_pipeline.distance_filter_mask(pre_coords, pre_ids, post_ids,
+                                                    r_nm=150, batch_size=batch_size)
+        assert np.flatnonzero(keep).tolist() == [0, 2, 4, 6, 8, 10]
+
+
+def test_cutout_segmentation_cache(tmp_path, monkeypatch):
+    import os
+    import sys
+    sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..',
+                                    'synapse_prediction', 'ground_truth'))
+    import synapse_cutout_utils as scu
+    data = np.arange(24, dtype=np.uint64).reshape(2, 3, 4)
+    downloads = []
+    def download(cutout_name):
+        downloads.append(cutout_name)
+        return {'data': np.asfortranarray(data), 'voxel_size': [40, 4, 4],
+                'voxel_offset': [0, 0, 0]}
+    monkeypatch.setattr(scu, '_download_segmentation', download)
+
+    cache_dir = str(tmp_path)
+    seg = scu.load_segmentation('synapse_cutout2', cache_dir=cache_dir)
+    seg = scu.load_segmentation('synapse_cutout2', cache_dir=cache_dir)
+    assert downloads == ['synapse_cutout2']
+    assert isinstance(seg['data'], np.memmap)
+    assert (seg['data'] == data).all()
+    # The address doesn't depend on memory layout
+    assert scu._array_sha256(data) == scu._array_sha256(np.asfortranarray(data))
+
+    # A truncated file is detected and downloaded again
+    data_fn = os.path.join(cache_dir, scu._array_sha256(data) + '.npy')
+    with open(data_fn, 'r+b') as f:
+        f.truncate(os.path.getsize(data_fn) - 8)
+    seg = scu.load_segmentation('synapse_cutout2', cache_dir=cache_dir)
+    assert len(downloads) == 2
+    assert (seg['data'] == data).all()
+
+
 def test_false():
     assert 0 == 1
 